@@ -0,0 +1,184 @@
+'''
+Воспроизводимый бенчмарк ETL: extract (против локальной заглушки API), transform и load (в локальный Postgres)
+на нескольких размерах данных. По каждому этапу: время, строк/сек, запросов/сек, пиковая память (tracemalloc).
+Результат сохраняется в JSON (benchmarks/results/), с --compare сравнивается с прошлым прогоном.
+
+Пример:
+    python -m benchmarks.run_benchmarks --countries 10 50 200 --years 1990:2024 --host localhost --port 5432
+    python -m benchmarks.run_benchmarks --skip-load --latency 0.05 --rate-429 0.05 --compare benchmarks/results/base.json
+'''
+
+import argparse
+import json
+import os
+import platform
+import sys
+import time
+import tracemalloc
+from datetime import datetime
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import pandas as pd
+
+from benchmarks.wb_stub_server import StubState, country_codes, start_stub_server
+from etl.config import DEFAULT_CFG, validate_cfg
+from etl.extract import extract_data
+from etl.load import get_bd_connection, load_data, load_main_table
+from etl.transform import transform
+
+RESULTS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "results")
+# Насколько этап может замедлиться относительно прошлого прогона, прежде чем считать это регрессией
+REGRESSION_THRESHOLD = 1.2
+# Этапы короче этого в обоих прогонах не сравниваем - там в основном шум
+MIN_COMPARE_SECONDS = 0.2
+
+def measure(func, *args):
+    '''Запускает этап, возвращает результат, время и пиковую память Python-объектов'''
+    tracemalloc.start()
+    started = time.perf_counter()
+    result = func(*args)
+    elapsed = time.perf_counter() - started
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return result, elapsed, peak
+
+def stage_result(rows: int, elapsed: float, peak: int, requests: int | None = None) -> dict:
+    result = {
+        "rows": rows,
+        "seconds": round(elapsed, 4),
+        "rows_per_sec": round(rows / elapsed, 1) if elapsed else None,
+        "peak_mb": round(peak / 1024 / 1024, 2)
+    }
+    if requests is not None:
+        result["requests"] = requests
+        result["requests_per_sec"] = round(requests / elapsed, 1) if elapsed else None
+    return result
+
+def prepare_reference(conn, countries: list, indicators: list):
+    '''Справочники под синтетические коды - иначе main_table не на что ссылаться'''
+    load_data(conn, "country", pd.DataFrame({"id": countries, "name": countries}))
+    load_data(conn, "indicator", pd.DataFrame({"id": indicators, "name": indicators}))
+
+def run_case(args, base_url: str, state: StubState, n_countries: int) -> dict:
+    countries = country_codes(n_countries)
+    indicators = [f"BENCH.IND.{i}" for i in range(args.indicators)]
+    cfg = validate_cfg(dict(
+        DEFAULT_CFG,
+        base_url=base_url,
+        per_page=args.per_page,
+        workers=args.workers,
+        indicator_workers=args.indicator_workers,
+        rate_limit=args.rate_limit,
+        retries=args.retries,
+        pause=0,
+        # Каждый прогон должен реально ходить в API, а не дочитывать страницы прошлого
+        checkpoint=False,
+        countries=countries,
+        indicators=indicators,
+        date_interval=[args.years]
+    ))
+    case = {"countries": n_countries, "indicators": args.indicators, "years": args.years}
+
+    before = state.stats()
+    data, elapsed, peak = measure(extract_data, cfg)
+    after = state.stats()
+    case["extract"] = stage_result(len(data), elapsed, peak, after["requests"] - before["requests"])
+    case["extract"]["errors_429"] = after["errors_429"] - before["errors_429"]
+    case["extract"]["errors_malformed"] = after["errors_malformed"] - before["errors_malformed"]
+
+    df, elapsed, peak = measure(transform, data)
+    case["transform"] = stage_result(len(df), elapsed, peak)
+    del data
+
+    if not args.skip_load:
+        conn = get_bd_connection(dict(cfg, host=args.host, port=args.port, dbname=args.dbname,
+                                      user=args.user, password=args.password))
+        prepare_reference(conn, countries, indicators)
+        _, elapsed, peak = measure(load_main_table, conn, df)
+        case["load"] = stage_result(len(df), elapsed, peak)
+        # Повторная загрузка тех же данных - типичный ежедневный перезапуск
+        _, elapsed, peak = measure(load_main_table, conn, df)
+        case["reload"] = stage_result(len(df), elapsed, peak)
+        conn.close()
+    return case
+
+def compare(current: dict, baseline_path: str) -> list[str]:
+    '''Сравнение времени этапов с прошлым прогоном, возвращает список регрессий'''
+    with open(baseline_path, encoding="utf-8") as f:
+        baseline = json.load(f)
+    base_cases = {case["countries"]: case for case in baseline["cases"]}
+    regressions = []
+    for case in current["cases"]:
+        base = base_cases.get(case["countries"])
+        if base is None:
+            continue
+        for stage in ("extract", "transform", "load", "reload"):
+            if stage not in case or stage not in base or not base[stage]["seconds"]:
+                continue
+            if max(case[stage]["seconds"], base[stage]["seconds"]) < MIN_COMPARE_SECONDS:
+                continue
+            ratio = case[stage]["seconds"] / base[stage]["seconds"]
+            line = f"countries={case['countries']:>4} {stage:<9} {base[stage]['seconds']:>9.3f}s -> {case[stage]['seconds']:>9.3f}s  x{ratio:.2f}"
+            print(line)
+            if ratio > REGRESSION_THRESHOLD:
+                regressions.append(line)
+    return regressions
+
+def main():
+    parser = argparse.ArgumentParser(description="Бенчмарк ETL пайплайна")
+    parser.add_argument("--countries", type=int, nargs="+", default=[10, 50, 200], help="размеры выборки стран")
+    parser.add_argument("--indicators", type=int, default=3)
+    parser.add_argument("--years", default="1960:2024")
+    parser.add_argument("--per-page", type=int, default=500)
+    parser.add_argument("--workers", type=int, default=DEFAULT_CFG["workers"])
+    parser.add_argument("--indicator-workers", type=int, default=DEFAULT_CFG["indicator_workers"])
+    parser.add_argument("--rate-limit", type=float, default=1000)
+    parser.add_argument("--retries", type=int, default=5)
+    parser.add_argument("--latency", type=float, default=0.0, help="задержка ответа заглушки, сек")
+    parser.add_argument("--rate-429", type=float, default=0.0, help="доля ответов 429")
+    parser.add_argument("--malformed", type=float, default=0.0, help="доля ответов с битым JSON")
+    parser.add_argument("--skip-load", action="store_true", help="без этапа загрузки в Postgres")
+    parser.add_argument("--host", default="localhost")
+    parser.add_argument("--port", type=int, default=5432)
+    parser.add_argument("--dbname", default="postgres")
+    parser.add_argument("--user", default="postgres")
+    parser.add_argument("--password", default="")
+    parser.add_argument("--out", default=None, help="файл для результата (по умолчанию benchmarks/results/<время>.json)")
+    parser.add_argument("--compare", default=None, help="JSON прошлого прогона для сравнения")
+    args = parser.parse_args()
+
+    state = StubState(all_countries=max(args.countries), latency=args.latency,
+                      rate_429=args.rate_429, malformed=args.malformed)
+    server, base_url = start_stub_server(state)
+    try:
+        cases = []
+        for n_countries in args.countries:
+            case = run_case(args, base_url, state, n_countries)
+            print(json.dumps(case, ensure_ascii=False))
+            cases.append(case)
+    finally:
+        server.shutdown()
+
+    result = {
+        "started_at": datetime.now().isoformat(timespec="seconds"),
+        "python": platform.python_version(),
+        "params": {k: v for k, v in vars(args).items() if k not in ("password", "out", "compare")},
+        "cases": cases
+    }
+    out = args.out or os.path.join(RESULTS_DIR, f"{datetime.now():%Y%m%d_%H%M%S}.json")
+    os.makedirs(os.path.dirname(out), exist_ok=True)
+    with open(out, "w", encoding="utf-8") as f:
+        json.dump(result, f, ensure_ascii=False, indent=4)
+    print(f"Результат сохранен в {out}")
+
+    if args.compare:
+        regressions = compare(result, args.compare)
+        if regressions:
+            print(f"Регрессии (медленнее в {REGRESSION_THRESHOLD} раза и больше):")
+            for line in regressions:
+                print("  " + line)
+            sys.exit(1)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,165 @@
+'''
+Локальная замена API World Bank для бенчмарков: отдает /v2/country/{коды}/indicator/{индикаторы}
+в том же формате [metadata, data] с пагинацией. Данные синтетические, но детерминированные.
+Можно добавить задержку ответа и с заданной вероятностью отдавать 429 или битый JSON
+'''
+
+import json
+import math
+import random
+import re
+import string
+import threading
+import time
+import zlib
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlsplit
+
+PATH_RE = re.compile(r"^/v2/country/(?P<countries>[^/]+)/indicator/(?P<indicators>[^/]+)/?$")
+INDICATOR_RE = re.compile(r"^/v2/indicator/(?P<indicator>[^/;]+)/?$")
+
+def country_codes(n: int) -> list[str]:
+    '''Синтетические 3-буквенные коды стран: XAA, XAB, ... (до 676 штук)'''
+    letters = string.ascii_uppercase
+    return [f"X{letters[i // 26]}{letters[i % 26]}" for i in range(n)]
+
+class StubState:
+    def __init__(self, all_countries: int = 200, latency: float = 0.0,
+                 rate_429: float = 0.0, malformed: float = 0.0, seed: int = 0):
+        self.all_countries = country_codes(all_countries)
+        self.latency = latency
+        self.rate_429 = rate_429
+        self.malformed = malformed
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        self.requests = 0
+        self.errors_429 = 0
+        self.errors_malformed = 0
+
+    def roll(self) -> str:
+        with self.lock:
+            self.requests += 1
+            x = self.random.random()
+            if x < self.rate_429:
+                self.errors_429 += 1
+                return "429"
+            if x < self.rate_429 + self.malformed:
+                self.errors_malformed += 1
+                return "malformed"
+            return "ok"
+
+    def stats(self) -> dict:
+        with self.lock:
+            return {"requests": self.requests, "errors_429": self.errors_429, "errors_malformed": self.errors_malformed}
+
+def parse_years(date: str | None) -> list[int]:
+    if not date:
+        return list(range(1960, 2025))
+    years = []
+    for part in date.split(","):
+        if ":" in part:
+            first, last = part.split(":")
+            years.extend(range(int(first), int(last) + 1))
+        else:
+            years.append(int(part))
+    return sorted(set(years))
+
+def make_record(country: str, indicator: str, year: int) -> dict:
+    # Детерминированное значение, примерно каждое седьмое наблюдение пустое - как в реальных данных
+    seed = zlib.crc32(f"{country}|{indicator}|{year}".encode()) % 1000
+    value = None if seed % 7 == 0 else round(1000 + seed * 3.7 + (year - 1960) * 12.5, 3)
+    return {
+        "indicator": {"id": indicator, "value": f"Indicator {indicator}"},
+        "country": {"id": country[:2], "value": f"Country {country}"},
+        "countryiso3code": country,
+        "date": str(year),
+        "value": value,
+        "unit": "",
+        "obs_status": "",
+        "decimal": 1
+    }
+
+class StubHandler(BaseHTTPRequestHandler):
+    state: StubState = None
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        pass
+
+    def send_body(self, status: int, body: bytes):
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        url = urlsplit(self.path)
+        indicator_match = INDICATOR_RE.match(url.path)
+        if indicator_match:
+            # Метаданные индикатора - планировщику нужен только source, у всех синтетических он один
+            indicator = indicator_match["indicator"]
+            metadata = {"page": 1, "pages": 1, "per_page": 1, "total": 1}
+            record = {"id": indicator, "name": f"Indicator {indicator}", "source": {"id": "2", "value": "Stub"}}
+            self.send_body(200, json.dumps([metadata, [record]]).encode("utf-8"))
+            return
+        match = PATH_RE.match(url.path)
+        if not match:
+            self.send_body(404, b'{"message": "not found"}')
+            return
+        if self.state.latency:
+            time.sleep(self.state.latency)
+        outcome = self.state.roll()
+        if outcome == "429":
+            self.send_body(429, b'{"message": "too many requests"}')
+            return
+        if outcome == "malformed":
+            self.send_body(200, b'[{"page": 1, "pages"')
+            return
+
+        query = parse_qs(url.query)
+        page = int(query.get("page", ["1"])[0])
+        per_page = int(query.get("per_page", ["50"])[0])
+        countries = match["countries"].split(";")
+        if countries == ["all"]:
+            countries = self.state.all_countries
+        indicators = match["indicators"].split(";")
+        years = parse_years(query.get("date", [None])[0])
+
+        total = len(countries) * len(indicators) * len(years)
+        pages = max(1, math.ceil(total / per_page))
+        records = []
+        # Строки по порядку (индикатор, страна, год по убыванию), как в API - берем только срез страницы
+        for pos in range((page - 1) * per_page, min(page * per_page, total)):
+            i, rest = divmod(pos, len(countries) * len(years))
+            c, y = divmod(rest, len(years))
+            records.append(make_record(countries[c], indicators[i], years[-1 - y]))
+        metadata = {"page": page, "pages": pages, "per_page": per_page, "total": total,
+                    "sourceid": "2", "lastupdated": "2025-01-01"}
+        self.send_body(200, json.dumps([metadata, records]).encode("utf-8"))
+
+def start_stub_server(state: StubState, port: int = 0) -> tuple[ThreadingHTTPServer, str]:
+    '''
+    Запускает сервер в фоновом потоке, возвращает сервер и base_url для конфига (http://127.0.0.1:{port}/v2)
+    '''
+    handler = type("BoundStubHandler", (StubHandler,), {"state": state})
+    server = ThreadingHTTPServer(("127.0.0.1", port), handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, f"http://127.0.0.1:{server.server_address[1]}/v2"
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser(description="Локальная замена API World Bank")
+    parser.add_argument("--port", type=int, default=8099)
+    parser.add_argument("--latency", type=float, default=0.0)
+    parser.add_argument("--rate-429", type=float, default=0.0)
+    parser.add_argument("--malformed", type=float, default=0.0)
+    args = parser.parse_args()
+    server, base_url = start_stub_server(StubState(latency=args.latency, rate_429=args.rate_429,
+                                                   malformed=args.malformed), args.port)
+    print(f"Заглушка API запущена: {base_url}")
+    try:
+        threading.Event().wait()
+    except KeyboardInterrupt:
+        server.shutdown()
@@ -1,17 +1,53 @@
 
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 from copy import deepcopy
-from typing import Tuple
+from itertools import islice
+from typing import Iterator, Tuple
 
 import requests as rq
+from requests.adapters import HTTPAdapter
+from etl.cache import get_response_cache
+from etl.checkpoint import CheckpointStore, get_checkpoint_store
 from etl.logger import get_stage_logger
+from etl.metrics import inc, observe
+from etl.ratelimit import get_rate_limiter
+import threading
 import time
 
 logger = get_stage_logger("extract")
 
+# Запросов в секунду, если в конфиге не задано
+DEFAULT_RATE_LIMIT = 10
+
+_session = None
+_session_pool_size = 0
+_session_lock = threading.Lock()
+
+def get_session(pool_size: int = 10) -> rq.Session:
+    '''
+    Общая keep-alive сессия на весь процесс, чтобы не открывать новое соединение на каждый запрос.
+    Размер пула соединений берем не меньше числа потоков, которые одновременно качают страницы.
+    Если нужен пул больше, создаем новую сессию, а старую не закрываем: ее еще могут использовать
+    потоки, получившие ее раньше, - соединения старой сессии закроются, когда она станет никому не нужна
+    '''
+    global _session, _session_pool_size
+    with _session_lock:
+        if _session is None or _session_pool_size < pool_size:
+            session = rq.Session()
+            adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+            session.mount("https://", adapter)
+            session.mount("http://", adapter)
+            _session = session
+            _session_pool_size = pool_size
+        return _session
+
 def safe_request(processed_cfg:dict) -> Tuple[dict, list[dict]]:
     '''
     Возможно не самая оптимальная и красивая функция в которой происходит прямой запрос к бд
     в целом к любой бд - она универсальная
+    Если в конфиге включен кэш - сначала ищем ответ в локальном кэше (кроме режима refresh),
+    успешный ответ сохраняем в кэш
     '''
     url_endpoint = processed_cfg["url"]
     params = processed_cfg["params"]
@@ -19,27 +55,54 @@ def safe_request(processed_cfg:dict) -> Tuple[dict, list[dict]]:
     pause = processed_cfg["pause"]
     retries = processed_cfg["retries"]
 
+    cache_cfg = processed_cfg.get("cache", {})
+    cache = get_response_cache(cache_cfg) if cache_cfg.get("enabled") else None
+    if cache is not None and not cache_cfg["refresh"]:
+        cached = cache.get(url_endpoint, params)
+        if cached is not None:
+            logger.info(f"Ответ взят из кэша, {url_endpoint}, {params}")
+            inc("requests_total", outcome="cache")
+            return cached[0], cached[1]
+    session = get_session(processed_cfg.get("workers", 1) * processed_cfg.get("indicator_workers", 1))
+    limiter = get_rate_limiter(processed_cfg.get("rate_limit", DEFAULT_RATE_LIMIT))
+
     for i in range(1, 1 + retries):
         logger.info(f"GET-запрос попытка {i}/{retries}, {url_endpoint}, {params}")
+        limiter.acquire()
         # Ловим ошибки
+        started = time.perf_counter()
         try:
-            response = rq.get(url_endpoint, params=params, timeout=timeout)
+            response = session.get(url_endpoint, params=params, timeout=timeout)
+            observe("request_seconds", time.perf_counter() - started)
             response.raise_for_status()
         except rq.exceptions.HTTPError as e:
             status = getattr(e.response, "status_code", None)
 
             if status == 429:
+                # Паузу между попытками здесь держит limiter, он же тормозит все остальные потоки
                 logger.info(f"Слишком много запросов (429). ПОВТОРЯЕМ попытку через {pause} сек...")
+                inc("retries_total", cause="429")
+                limiter.on_throttle(pause)
+                continue
             elif status and 400 <= status < 500:
                 logger.info(f"Клиентская ошибка {e.response.status_code}. ОСТАНОВКА!!!")
+                inc("requests_total", outcome="client_error")
                 break
             else:
                 logger.info(f"HTTPError {status}. ПОВТОРЯЕМ попытку через {pause} сек...")
+                inc("retries_total", cause="5xx")
             if i < retries:
                 time.sleep(pause)
             continue
-        except (rq.exceptions.Timeout, rq.exceptions.ConnectionError) as e:
+        except rq.exceptions.Timeout as e:
+            logger.info(f"Таймаут запроса: {e}. Попытка {i}/{retries}. ПОВТОРЯЕМ попытку через {pause} сек...")
+            inc("retries_total", cause="timeout")
+            if i < retries:
+                time.sleep(pause)
+            continue
+        except rq.exceptions.ConnectionError as e:
             logger.info(f"Ошибка соединения: {e}. Попытка {i}/{retries}. ПОВТОРЯЕМ попытку через {pause} сек...")
+            inc("retries_total", cause="connection")
             if i < retries:
                 time.sleep(pause)
             continue
@@ -51,12 +114,14 @@ def safe_request(processed_cfg:dict) -> Tuple[dict, list[dict]]:
             data = response.json()
         except ValueError:
             logger.info("Ответ не является корректным JSON. ПОВТОРЯЕМ попытку...")
+            inc("retries_total", cause="bad_json")
             if i < retries:
                 time.sleep(pause)
             continue
 
         if not data:
             logger.info("JSON пустой. ПОВТОРЯЕМ попытку...")
+            inc("retries_total", cause="bad_json")
             if i < retries:
                 time.sleep(pause)
             continue
@@ -65,20 +130,28 @@ def safe_request(processed_cfg:dict) -> Tuple[dict, list[dict]]:
 
         if not isinstance(metadata, dict):
             logger.info(f"Некорректный формат данных metadata: {type(metadata)}")
+            inc("retries_total", cause="bad_json")
             if i < retries:
                 time.sleep(pause)
             continue
 
         if not isinstance(data_list, list):
             logger.info(f"Некорректный формат данных data_list: {type(data_list)}")
+            inc("retries_total", cause="bad_json")
             if i < retries:
                 time.sleep(pause)
             continue
 
 
+        limiter.on_success()
+        inc("requests_total", outcome="ok")
+        inc("response_bytes_total", len(response.content))
+        if cache is not None:
+            cache.put(url_endpoint, params, [metadata, data_list])
         return metadata, data_list
 
     logger.info(f"GET-запрос не удался после {i} попыток")
+    inc("requests_total", outcome="failed")
     raise RuntimeError(f"GET-запрос не удался после {i} попыток, {processed_cfg}")
 
 def get_paginated_data(processed_cfg:dict,
@@ -88,40 +161,121 @@ def get_paginated_data(processed_cfg:dict,
     Это тоже универсальная функция, которая отрабатывает пагинацию.
     Есть опция выбирать страницы (она условна мало ли, по умолчанию это всегда с 1 по последнюю страницу
     при этом логика внутри исключает ошибки вызванные некорректным выбором параметров first_page и last_page
+    Сами страницы качает iter_paginated_data, здесь просто собираем их в один список.
+    Если в конфиге включены контрольные точки - страницы по ходу сохраняются на диск (см. get_resumable_data)
     '''
+    checkpoint_cfg = processed_cfg.get("checkpoint", {})
+    if checkpoint_cfg.get("enabled"):
+        return get_resumable_data(processed_cfg, get_checkpoint_store(checkpoint_cfg["dir"]), first_page, last_page)
     full_data = []
-    local_processed_cfg = deepcopy(processed_cfg)
+    pages = 0
+    for data_list in iter_paginated_data(processed_cfg, first_page, last_page):
+        full_data.extend(data_list)
+        pages += 1
+    logger.info(f"Отработали {pages} страниц, всего строк {len(full_data)}")
+    logger.info(f"Запрос успешно отработал!!!")
+    return full_data
+
+def get_resumable_data(processed_cfg: dict,
+                       store: CheckpointStore,
+                       first_page: int = 1,
+                       last_page: int | None = None) -> list[dict]:
+    '''
+    Пагинация с контрольными точками: каждая скачанная страница сразу пишется в store.
+    Если прошлый запуск с теми же параметрами упал, число страниц берем из контрольной точки,
+    качаем только недостающие страницы (непрерывными кусками через first_page/last_page
+    iter_paginated_data), а остальное читаем с диска
+    '''
+    first_page = max(1, first_page)
+    key = store.make_key(processed_cfg["url"], processed_cfg["params"])
+    total_pages = store.get_total_pages(key)
+    if total_pages is None:
+        metadata, data_list = fetch_page(processed_cfg, first_page)
+        total_pages = max(metadata.get("pages") or first_page, first_page)
+        store.start(key, processed_cfg["url"], total_pages)
+        store.put_page(key, first_page, data_list)
+    if last_page is not None:
+        total_pages = min(total_pages, last_page)
+
+    saved = store.saved_pages(key)
+    missing = [page for page in range(first_page, total_pages + 1) if page not in saved]
+    if saved and missing:
+        logger.info(f"Продолжаем выгрузку с контрольной точки: скачано {total_pages - first_page + 1 - len(missing)} "
+                    f"из {total_pages - first_page + 1} страниц, {processed_cfg['url']}")
+    # Недостающие страницы группируем в непрерывные диапазоны
+    ranges = []
+    for page in missing:
+        if ranges and ranges[-1][1] == page - 1:
+            ranges[-1][1] = page
+        else:
+            ranges.append([page, page])
+    for start, end in ranges:
+        for page, data_list in zip(range(start, end + 1), iter_paginated_data(processed_cfg, start, end)):
+            store.put_page(key, page, data_list)
 
+    full_data = []
+    for data_list in store.iter_pages(key, first_page, total_pages):
+        full_data.extend(data_list)
+    logger.info(f"Отработали {total_pages - first_page + 1} страниц, всего строк {len(full_data)}")
+    logger.info(f"Запрос успешно отработал!!!")
+    return full_data
+
+def iter_paginated_data(processed_cfg: dict,
+                        first_page: int = 1,
+                        last_page: int | None = None) -> Iterator[list[dict]]:
+    '''
+    Генератор страниц в порядке их номеров.
+    Первую страницу запрашиваем отдельно - из ее metadata узнаем общее число страниц,
+    остальные качаем параллельно в workers потоков. Одновременно в работе не больше 2 * workers страниц,
+    поэтому память не растет вместе с числом страниц, если потребитель обрабатывает их по мере получения
+    '''
     if first_page < 1:
         logger.warning(f"Некорректный first_page={first_page}, используем 1")
         first_page = 1
-    page = first_page
 
-    while True:
-        local_processed_cfg['params']['page'] = page
-        logger.info(f"Страница номер {page}")
+    metadata, data_list = fetch_page(processed_cfg, first_page)
+    yield data_list
 
-        metadata, data_list = safe_request(local_processed_cfg)
-## Отработать
-        if data_list:
-            full_data.extend(data_list)
-        else:
-            logger.info(f"Страница номер {page} пустая, пропускаем")
-
-        total_pages = metadata.get("pages", page)
-        if last_page is not None:
-            total_pages = min(total_pages, last_page)
-        '''
-        # Универсальная проверка отрабатывающая много исключений (некорректно большое first_page)однако, функция не дает 
-        причину break - возможность выставить номера страниц, нужна условно вызов будет проиисходить внутри другой функции
-        '''
-        logger.info(f"Отработали {page} страниц из {total_pages}, всего строкк ")
-        if page >= total_pages:
-            logger.info("Достигнут конец выбранного диапазона страниц")
-            break
-        page += 1
-    logger.info(f"Запрос успешно отработал!!!")
-    return full_data
+    total_pages = metadata.get("pages", first_page)
+    if last_page is not None:
+        total_pages = min(total_pages, last_page)
+    '''
+    # Универсальная проверка отрабатывающая много исключений (некорректно большое first_page)однако, функция не дает 
+    причину break - возможность выставить номера страниц, нужна условно вызов будет проиисходить внутри другой функции
+    '''
+    rest_pages = range(first_page + 1, total_pages + 1)
+    if not rest_pages:
+        return
+    workers = max(1, min(processed_cfg.get("workers", 1), len(rest_pages)))
+    logger.info(f"Всего страниц {total_pages}, качаем оставшиеся {len(rest_pages)} в {workers} потоков")
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        in_flight = deque()
+        pages = iter(rest_pages)
+        for page in islice(pages, 2 * workers):
+            in_flight.append(executor.submit(fetch_page, processed_cfg, page))
+        # Отдаем страницы строго по порядку, на место каждой отданной ставим в очередь следующую
+        while in_flight:
+            _, data_list = in_flight.popleft().result()
+            page = next(pages, None)
+            if page is not None:
+                in_flight.append(executor.submit(fetch_page, processed_cfg, page))
+            yield data_list
+
+def fetch_page(processed_cfg: dict, page: int) -> Tuple[dict, list[dict]]:
+    '''
+    Запрос одной страницы. Каждому вызову своя копия конфига, так как потоки качают страницы одновременно
+    '''
+    local_processed_cfg = deepcopy(processed_cfg)
+    local_processed_cfg['params']['page'] = page
+    logger.info(f"Страница номер {page}")
+
+    metadata, data_list = safe_request(local_processed_cfg)
+    if not data_list:
+        logger.info(f"Страница номер {page} пустая, пропускаем")
+        data_list = []
+    inc("pages_total")
+    inc("rows_extracted_total", len(data_list))
+    return metadata, data_list
 
 def process_cfg_for_api(raw_cfg:dict) -> dict:
     '''
@@ -146,6 +300,20 @@ def process_cfg_for_api(raw_cfg:dict) -> dict:
         'timeout': raw_cfg["timeout"],
         'pause': raw_cfg["pause"],
         'retries': raw_cfg["retries"],
+        'workers': raw_cfg["workers"],
+        'indicator_workers': raw_cfg["indicator_workers"],
+        'rate_limit': raw_cfg["rate_limit"],
+        'cache': {
+            "enabled": raw_cfg["cache"],
+            "dir": raw_cfg["cache_dir"],
+            "ttl": raw_cfg["cache_ttl"],
+            "max_mb": raw_cfg["cache_max_mb"],
+            "refresh": raw_cfg["cache_refresh"]
+        },
+        'checkpoint': {
+            "enabled": raw_cfg["checkpoint"],
+            "dir": raw_cfg["checkpoint_dir"]
+        },
         'indicators': [""]
     }
     temp_url = raw_cfg["base_url"]
@@ -0,0 +1,115 @@
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+import zlib
+
+from etl.logger import get_stage_logger
+
+logger = get_stage_logger("extract")
+
+class ResponseCache:
+    '''
+    Локальный кэш ответов API в одном sqlite файле.
+    Ключ - хэш от endpoint + параметров запроса, значение - сжатый zlib json ответа.
+    Запись старше ttl секунд считается протухшей, при превышении max_bytes выкидываем
+    записи, к которым дольше всего не обращались (LRU).
+    Суммарный размер записей держим в total_bytes (считается один раз при открытии),
+    чтобы put не пересчитывал SUM(size) по всей таблице
+    '''
+    def __init__(self, cache_dir: str, ttl: int, max_bytes: int):
+        os.makedirs(cache_dir, exist_ok=True)
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(os.path.join(cache_dir, "responses.sqlite"), check_same_thread=False)
+        with self.conn:
+            self.conn.execute("""
+                CREATE TABLE IF NOT EXISTS responses (
+                    key TEXT PRIMARY KEY,
+                    url TEXT,
+                    created_at REAL,
+                    accessed_at REAL,
+                    size INTEGER,
+                    body BLOB
+                )
+            """)
+            self.conn.execute("CREATE INDEX IF NOT EXISTS responses_accessed_at ON responses (accessed_at)")
+        self.total_bytes = self.conn.execute("SELECT COALESCE(SUM(size), 0) FROM responses").fetchone()[0]
+
+    @staticmethod
+    def make_key(url: str, params: dict) -> str:
+        raw = json.dumps([url, sorted((k, str(v)) for k, v in params.items())], ensure_ascii=False)
+        return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+    def get(self, url: str, params: dict):
+        key = self.make_key(url, params)
+        now = time.time()
+        with self.lock:
+            row = self.conn.execute(
+                "SELECT created_at, body FROM responses WHERE key = ?", (key,)
+            ).fetchone()
+            if row is None:
+                return None
+            created_at, body = row
+            if now - created_at > self.ttl:
+                with self.conn:
+                    self._delete(key)
+                return None
+            with self.conn:
+                self.conn.execute("UPDATE responses SET accessed_at = ? WHERE key = ?", (now, key))
+        return json.loads(zlib.decompress(body).decode("utf-8"))
+
+    def put(self, url: str, params: dict, data):
+        key = self.make_key(url, params)
+        body = zlib.compress(json.dumps(data, ensure_ascii=False).encode("utf-8"))
+        now = time.time()
+        with self.lock, self.conn:
+            self._delete(key)
+            self.conn.execute(
+                "INSERT OR REPLACE INTO responses (key, url, created_at, accessed_at, size, body) "
+                "VALUES (?, ?, ?, ?, ?, ?)",
+                (key, url, now, now, len(body), body)
+            )
+            self.total_bytes += len(body)
+            self._evict()
+
+    def _delete(self, key: str):
+        row = self.conn.execute("SELECT size FROM responses WHERE key = ?", (key,)).fetchone()
+        if row is not None:
+            self.conn.execute("DELETE FROM responses WHERE key = ?", (key,))
+            self.total_bytes -= row[0]
+
+    def _evict(self):
+        if self.total_bytes <= self.max_bytes:
+            return
+        removed = 0
+        for key, size in self.conn.execute(
+                "SELECT key, size FROM responses ORDER BY accessed_at").fetchall():
+            if self.total_bytes <= self.max_bytes:
+                break
+            self.conn.execute("DELETE FROM responses WHERE key = ?", (key,))
+            self.total_bytes -= size
+            removed += 1
+        logger.info(f"Кэш превысил лимит, удалено {removed} старых записей")
+
+_caches = {}
+_caches_lock = threading.Lock()
+
+def get_response_cache(cache_cfg: dict) -> ResponseCache:
+    '''
+    Один объект кэша на директорию на весь процесс, ttl и лимит размера берутся из текущего конфига
+    '''
+    cache_dir = os.path.abspath(cache_cfg["dir"])
+    max_bytes = cache_cfg["max_mb"] * 1024 * 1024
+    with _caches_lock:
+        cache = _caches.get(cache_dir)
+        if cache is None:
+            cache = ResponseCache(cache_dir, cache_cfg["ttl"], max_bytes)
+            _caches[cache_dir] = cache
+        else:
+            cache.ttl = cache_cfg["ttl"]
+            cache.max_bytes = max_bytes
+        return cache
@@ -0,0 +1,135 @@
+import json
+import os
+import sqlite3
+import threading
+import time
+import zlib
+
+from etl.cache import ResponseCache
+from etl.logger import get_stage_logger
+
+logger = get_stage_logger("extract")
+
+# Незавершенная выгрузка старше недели считается неактуальной - данные в API могли обновиться
+MAX_AGE = 7 * 24 * 3600
+
+class CheckpointStore:
+    '''
+    Контрольные точки выгрузки в sqlite: по каждому запросу (endpoint + параметры без номера страницы)
+    храним общее число страниц и уже скачанные страницы (сжатый zlib json).
+    Если выгрузка упала на середине, повторный запуск докачивает только недостающие страницы.
+    Точки снимаются (complete), когда данные успешно загружены в БД.
+    Если запуск упал и повторного не было, точки остаются на диске; при следующем открытии
+    хранилища точки старше MAX_AGE удаляются вместе со страницами
+    '''
+    def __init__(self, checkpoint_dir: str):
+        os.makedirs(checkpoint_dir, exist_ok=True)
+        self.lock = threading.Lock()
+        # Запросы, которые трогали в этом процессе - их и снимаем после успешной загрузки
+        self.touched = set()
+        self.conn = sqlite3.connect(os.path.join(checkpoint_dir, "checkpoints.sqlite"), check_same_thread=False)
+        with self.conn:
+            self.conn.execute("""
+                CREATE TABLE IF NOT EXISTS requests (
+                    key TEXT PRIMARY KEY,
+                    url TEXT,
+                    total_pages INTEGER,
+                    created_at REAL
+                )
+            """)
+            self.conn.execute("""
+                CREATE TABLE IF NOT EXISTS pages (
+                    key TEXT,
+                    page INTEGER,
+                    body BLOB,
+                    PRIMARY KEY (key, page)
+                )
+            """)
+        self.purge_stale()
+
+    @staticmethod
+    def make_key(url: str, params: dict) -> str:
+        return ResponseCache.make_key(url, {k: v for k, v in params.items() if k != "page"})
+
+    def get_total_pages(self, key: str) -> int | None:
+        with self.lock:
+            row = self.conn.execute("SELECT total_pages, created_at FROM requests WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                return None
+            if time.time() - row[1] > MAX_AGE:
+                self._delete(key)
+                return None
+            self.touched.add(key)
+            return row[0]
+
+    def start(self, key: str, url: str, total_pages: int):
+        with self.lock, self.conn:
+            self.conn.execute(
+                "INSERT OR REPLACE INTO requests (key, url, total_pages, created_at) VALUES (?, ?, ?, ?)",
+                (key, url, total_pages, time.time())
+            )
+            self.touched.add(key)
+
+    def saved_pages(self, key: str) -> set[int]:
+        with self.lock:
+            return {page for (page,) in self.conn.execute("SELECT page FROM pages WHERE key = ?", (key,))}
+
+    def put_page(self, key: str, page: int, data_list: list):
+        body = zlib.compress(json.dumps(data_list, ensure_ascii=False).encode("utf-8"))
+        with self.lock, self.conn:
+            self.conn.execute("INSERT OR REPLACE INTO pages (key, page, body) VALUES (?, ?, ?)", (key, page, body))
+
+    def iter_pages(self, key: str, first_page: int, last_page: int):
+        with self.lock:
+            rows = self.conn.execute(
+                "SELECT body FROM pages WHERE key = ? AND page BETWEEN ? AND ? ORDER BY page",
+                (key, first_page, last_page)
+            ).fetchall()
+        for (body,) in rows:
+            yield json.loads(zlib.decompress(body).decode("utf-8"))
+
+    def _delete(self, key: str):
+        with self.conn:
+            self.conn.execute("DELETE FROM pages WHERE key = ?", (key,))
+            self.conn.execute("DELETE FROM requests WHERE key = ?", (key,))
+
+    def purge_stale(self):
+        '''Удаляет незавершенные выгрузки старше MAX_AGE - их данные в API могли обновиться'''
+        with self.lock, self.conn:
+            stale = self.conn.execute(
+                "SELECT key FROM requests WHERE created_at < ?", (time.time() - MAX_AGE,)
+            ).fetchall()
+            for (key,) in stale:
+                self._delete(key)
+        if stale:
+            logger.info(f"Удалены устаревшие контрольные точки выгрузки для {len(stale)} запросов")
+
+    def complete(self):
+        with self.lock:
+            for key in self.touched:
+                self._delete(key)
+            removed = len(self.touched)
+            self.touched.clear()
+        if removed:
+            logger.info(f"Сняты контрольные точки выгрузки для {removed} запросов")
+
+_stores = {}
+_stores_lock = threading.Lock()
+
+def get_checkpoint_store(checkpoint_dir: str) -> CheckpointStore:
+    checkpoint_dir = os.path.abspath(checkpoint_dir)
+    with _stores_lock:
+        store = _stores.get(checkpoint_dir)
+        if store is None:
+            store = CheckpointStore(checkpoint_dir)
+            _stores[checkpoint_dir] = store
+        return store
+
+def complete_checkpoints():
+    '''
+    Вызывается после успешной загрузки в БД - скачанные в этом запуске страницы больше не нужны
+    '''
+    with _stores_lock:
+        stores = list(_stores.values())
+    for store in stores:
+        store.complete()
@@ -11,6 +11,42 @@ DEFAULT_CFG = {
     "retries": 3,
     "timeout": 10,
     "pause": 2,
+    # сколько страниц одного запроса качаем одновременно
+    "workers": 4,
+    # сколько индикаторов качаем одновременно
+    "indicator_workers": 4,
+    # потолок запросов в секунду на весь процесс, при 429 скорость снижается автоматически
+    "rate_limit": 10,
+    # локальный кэш ответов API (по умолчанию выключен)
+    # cache_ttl - сколько секунд ответ считается свежим, cache_max_mb - лимит размера кэша
+    # cache_refresh - не читать из кэша, а перекачать и перезаписать
+    "cache": False,
+    "cache_dir": "cache",
+    "cache_ttl": 86400,
+    "cache_max_mb": 500,
+    "cache_refresh": False,
+    # контрольные точки выгрузки - скачанные страницы сохраняются на диск, и если запуск упал,
+    # следующий докачивает только недостающие страницы. Точки снимаются после успешной загрузки в БД.
+    # Каждая страница пишется в sqlite и читается обратно - включать только для долгих выгрузок
+    "checkpoint": False,
+    "checkpoint_dir": "checkpoints",
+    # инкрементальный режим - качаем только то, что поменялось с прошлой загрузки (см. etl/watermark.py)
+    "incremental": False,
+    # потоковый режим - данные обрабатываются и грузятся в БД кусками по chunk_size строк.
+    # Контрольные точки (checkpoint) в нем не пишутся: упавший запуск начинается заново, но куски,
+    # уже загруженные в БД, при повторе отсеиваются по row_hash и не перезаписываются
+    "streaming": False,
+    "chunk_size": 50000,
+    # шардированный режим (piplines/sharded.py): число процессов (0 - по числу ядер)
+    # и сколько лет в одном шарде
+    "processes": 0,
+    "shard_years": 10,
+    # секционирование main_table: "" - без секций, "decade" - по десятилетиям, "indicator" - по индикаторам.
+    # Значение действует при создании таблицы, секции создаются автоматически. Существующая таблица
+    # при загрузке не перестраивается - для смены секционирования: python main.py repartition
+    "partitioning": "",
+    # каталог для локальной копии данных в Parquet (например "export"), пусто - экспорт выключен
+    "export_dir": "",
     # если нужно выбрать все страны пишем просто "all"
     # оставь пустым [] если разрез стран вообще не нужен
     "countries": ["CHN"],
@@ -21,6 +57,9 @@ DEFAULT_CFG = {
     # конкретная дата - "date", перечисление дат "date_1,date_2,..."
     # все даты пишем "all"
     "date_interval": ["2020:2024"],
+    # размер пула соединений к БД и число попыток подключения при ошибках соединения
+    "db_pool_size": 5,
+    "db_retries": 3,
     "host": "aws-1-eu-west-1.pooler.supabase.com",
     "port": 6543,
     "user": "postgres.uuzwbewejtdochhwkaig",
@@ -30,6 +69,9 @@ DEFAULT_CFG = {
 
 logger = get_stage_logger("extract")
 
+# Код страны/агрегата WB - 3 символа (CHN, WLD, EAS, ...)
+COUNTRY_CODE_RE = re.compile(r"^[A-Z0-9]{3}$")
+
 def validate_cfg(cfg:dict) -> dict:
     """
     Функция, которая осуществляет валидацию значений словаря-config, и возвращает словарь-config с валидированными знач.
@@ -60,6 +102,27 @@ def validate_cfg(cfg:dict) -> dict:
         logger.info("Некорректный per_page. Заменяем на значение по умолчанию")
         validated_cfg["per_page"] = deepcopy(DEFAULT_CFG["per_page"])
 
+    # workers, indicator_workers, chunk_size, db_pool_size, db_retries: int > 0
+    for key in ("workers", "indicator_workers", "chunk_size", "db_pool_size", "db_retries"):
+        try:
+            val = int(cfg.get(key, 0))
+            if val <= 0:
+                raise ValueError
+            validated_cfg[key] = val
+        except (ValueError, TypeError):
+            logger.info(f"Некорректный {key}. Заменяем на значение по умолчанию")
+            validated_cfg[key] = deepcopy(DEFAULT_CFG[key])
+
+    # rate_limit: float > 0
+    try:
+        rate_limit = float(cfg.get("rate_limit", 0))
+        if rate_limit <= 0:
+            raise ValueError
+        validated_cfg["rate_limit"] = rate_limit
+    except (ValueError, TypeError):
+        logger.info("Некорректный rate_limit. Заменяем на значение по умолчанию")
+        validated_cfg["rate_limit"] = deepcopy(DEFAULT_CFG["rate_limit"])
+
     # timeout, pause, retries: int >= 0
     for key in ("timeout", "pause", "retries"):
         try:
@@ -71,6 +134,39 @@ def validate_cfg(cfg:dict) -> dict:
             logger.info(f"Некорректный {key}. Заменяем на значение по умолчанию")
             validated_cfg[key] = deepcopy(DEFAULT_CFG[key])
 
+    # cache, cache_refresh, checkpoint, incremental, streaming: bool
+    for key in ("cache", "cache_refresh", "checkpoint", "incremental", "streaming"):
+        if not isinstance(cfg.get(key), bool):
+            logger.info(f"Некорректный {key}. Заменяем на значение по умолчанию")
+            validated_cfg[key] = deepcopy(DEFAULT_CFG[key])
+
+    # cache_dir, checkpoint_dir: str
+    for key in ("cache_dir", "checkpoint_dir"):
+        if not isinstance(cfg.get(key), str) or not cfg[key].strip():
+            logger.info(f"Некорректный {key}. Заменяем на значение по умолчанию")
+            validated_cfg[key] = deepcopy(DEFAULT_CFG[key])
+
+    # export_dir: str
+    if not isinstance(cfg.get("export_dir"), str):
+        logger.info("Некорректный export_dir. Заменяем на значение по умолчанию")
+        validated_cfg["export_dir"] = deepcopy(DEFAULT_CFG["export_dir"])
+
+    # partitioning: "" | "decade" | "indicator"
+    if cfg.get("partitioning") not in ("", "decade", "indicator"):
+        logger.info("Некорректный partitioning. Заменяем на значение по умолчанию")
+        validated_cfg["partitioning"] = deepcopy(DEFAULT_CFG["partitioning"])
+
+    # cache_ttl, processes: int >= 0, cache_max_mb, shard_years: int > 0
+    for key, min_val in (("cache_ttl", 0), ("cache_max_mb", 1), ("processes", 0), ("shard_years", 1)):
+        try:
+            val = int(cfg.get(key, -1))
+            if val < min_val:
+                raise ValueError
+            validated_cfg[key] = val
+        except (ValueError, TypeError):
+            logger.info(f"Некорректный {key}. Заменяем на значение по умолчанию")
+            validated_cfg[key] = deepcopy(DEFAULT_CFG[key])
+
     # countries: list[str] | "all" | []
     # indicators: list[str] | "all" | []
     for key in ("indicators", "countries"):
@@ -145,6 +241,9 @@ def validate_cfg(cfg:dict) -> dict:
     else:
         logger.info(f"Некорректный формат date_interval. Заменяем на значение по умолчанию")
         validated_cfg["date_interval"] = deepcopy(DEFAULT_CFG["date_interval"])
+    if validated_cfg["streaming"] and validated_cfg["checkpoint"]:
+        logger.warning("checkpoint не работает вместе со streaming: в потоковом режиме контрольные точки "
+                       "не пишутся, упавший запуск начнется заново")
     logger.info(f"Валидация прошла успешно")
     return validated_cfg
 
@@ -0,0 +1,91 @@
+import os
+
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+from etl.logger import get_stage_logger
+from etl.transform import KEY_COLUMNS
+
+logger = get_stage_logger("export")
+
+OBSERVATIONS_DIR = "observations"
+REFERENCE_DIR = "reference"
+PART_FILE = "part-0.parquet"
+
+def partition_path(out_dir: str, indicator_id: str, decade: int) -> str:
+    return os.path.join(out_dir, OBSERVATIONS_DIR, f"indicator_id={indicator_id}", f"decade={decade}")
+
+def write_parquet_atomic(table: pa.Table, path: str):
+    '''Пишем во временный файл и подменяем - читатель никогда не увидит недописанный файл'''
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp_path = path + ".tmp"
+    pq.write_table(table, tmp_path, compression="zstd")
+    os.replace(tmp_path, path)
+
+def export_observations(df: pd.DataFrame, out_dir: str) -> int:
+    '''
+    Выгрузка наблюдений (результат transform) в Parquet-датасет, разбитый по indicator_id и десятилетию
+    (hive-разметка indicator_id=.../decade=.../part-0.parquet).
+    Работает как upsert: затрагиваются только партиции из df, строки с теми же ключами заменяются,
+    остальные остаются - поэтому подходит и для потокового режима, и для частичных выгрузок.
+    Возвращает число перезаписанных партиций
+    '''
+    if df.empty:
+        return 0
+    df = df.assign(decade=(df["date"].astype("int32") // 10) * 10)
+    partitions = 0
+    for (indicator_id, decade), part in df.groupby(["indicator_id", "decade"], observed=True, sort=False):
+        path = os.path.join(partition_path(out_dir, indicator_id, decade), PART_FILE)
+        part = part.drop(columns=["indicator_id", "decade"])
+        part = part.assign(country_id=part["country_id"].astype(str))
+        if os.path.exists(path):
+            existing = pq.read_table(path).to_pandas()
+            key_columns = [col for col in KEY_COLUMNS if col != "indicator_id"]
+            new_keys = pd.MultiIndex.from_frame(part[key_columns])
+            keep = ~pd.MultiIndex.from_frame(existing[key_columns]).isin(new_keys)
+            part = pd.concat([existing[keep], part], ignore_index=True)
+        part = part.sort_values(["country_id", "date"]).reset_index(drop=True)
+        write_parquet_atomic(pa.Table.from_pandas(part, preserve_index=False), path)
+        partitions += 1
+    logger.info(f"Экспортировано {len(df)} строк в {partitions} партиций Parquet ({out_dir})")
+    return partitions
+
+def export_reference(tables: dict, out_dir: str):
+    '''Справочные таблицы целиком, по одному файлу на таблицу: reference/{name}.parquet'''
+    for name, ref_df in tables.items():
+        path = os.path.join(out_dir, REFERENCE_DIR, f"{name}.parquet")
+        write_parquet_atomic(pa.Table.from_pandas(ref_df, preserve_index=False), path)
+    logger.info(f"Экспортированы справочники {list(tables)} ({out_dir})")
+
+def read_observations(out_dir: str,
+                      countries: list | None = None,
+                      indicators: list | None = None,
+                      years: tuple[int, int] | None = None,
+                      columns: list | None = None) -> pd.DataFrame:
+    '''
+    Чтение нужного среза наблюдений. Фильтры по индикатору и десятилетию отсекают целые партиции (каталоги),
+    фильтры по стране и году проталкиваются в чтение Parquet (статистика row group), файлы отображаются в память.
+    years - диапазон (с, по) включительно
+    '''
+    filters = []
+    if indicators:
+        filters.append(("indicator_id", "in", list(indicators)))
+    if countries:
+        filters.append(("country_id", "in", list(countries)))
+    if years:
+        first, last = years
+        filters.append(("decade", "in", list(range((first // 10) * 10, last + 1, 10))))
+        filters.append(("date", ">=", first))
+        filters.append(("date", "<=", last))
+    table = pq.read_table(
+        os.path.join(out_dir, OBSERVATIONS_DIR),
+        columns=columns,
+        filters=filters or None,
+        partitioning="hive",
+        memory_map=True
+    )
+    return table.to_pandas()
+
+def read_reference(out_dir: str, name: str) -> pd.DataFrame:
+    return pq.read_table(os.path.join(out_dir, REFERENCE_DIR, f"{name}.parquet"), memory_map=True).to_pandas()
@@ -1,9 +1,16 @@
 
-from etl.api import process_cfg_for_api, get_paginated_data
+from concurrent.futures import ThreadPoolExecutor
+from copy import deepcopy
+from queue import Full, Queue
+from typing import Iterator
+
+from etl.api import process_cfg_for_api, get_paginated_data, iter_paginated_data
 from etl.logger import get_stage_logger
+from etl.planner import build_request_cfgs
+from etl.watermark import plan_incremental
 
-import pandas as pd
 import sys
+import threading
 
 logger = get_stage_logger("extract")
 
@@ -11,15 +18,105 @@ def extract_data(raw_cfg:dict) -> list:
     processed_cfg = process_cfg_for_api(raw_cfg)
     logger.info(f"НАЧИНАЕМ ЗАГРУЖАТЬ ДАННЫЕ!!!")
 
-    url_temp = processed_cfg["url"]
-    full_data = []
-
-    for indicator in processed_cfg["indicators"]:
-        processed_cfg["url"] = url_temp + indicator
-        full_data.extend(get_paginated_data(processed_cfg))
-        processed_cfg["url"] = url_temp
+    # Какие именно запросы делать (объединение индикаторов, размер страницы и тд) решает планировщик
+    full_data = fetch_all(build_request_cfgs(raw_cfg), processed_cfg["indicator_workers"])
     # df = pd.DataFrame(data=full_data)
     if not full_data:
         logger.info(f"Пусто!!! {processed_cfg}")
         sys.exit("Не получено данных для данного набора параметров. ОСТАНОВКА!!!")
-    return full_data
\ No newline at end of file
+    return full_data
+
+def iter_extract_data(raw_cfg: dict) -> Iterator[list[dict]]:
+    '''
+    Потоковый вариант extract_data - отдает данные постранично, не собирая все в один список.
+    Индикаторы качаются параллельно, их страницы складываются в ограниченную очередь,
+    поэтому если потребитель не успевает - загрузчики ждут, а память не растет.
+    Порядок страниц между разными индикаторами не гарантируется
+    '''
+    processed_cfg = process_cfg_for_api(raw_cfg)
+    logger.info(f"НАЧИНАЕМ ПОТОКОВО ЗАГРУЖАТЬ ДАННЫЕ!!!")
+    cfgs = build_request_cfgs(raw_cfg)
+    workers = max(1, min(processed_cfg["indicator_workers"], len(cfgs)))
+    pages = Queue(maxsize=2 * workers)
+    stop = threading.Event()
+    done = object()
+
+    def put(item):
+        # Если потребитель уже остановился (ошибка или break) - не висим на заполненной очереди
+        while not stop.is_set():
+            try:
+                pages.put(item, timeout=1)
+                return
+            except Full:
+                continue
+
+    def produce(cfg):
+        try:
+            for data_list in iter_paginated_data(cfg):
+                if stop.is_set():
+                    return
+                put(data_list)
+        except Exception as e:
+            put(e)
+        finally:
+            put(done)
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        for cfg in cfgs:
+            executor.submit(produce, cfg)
+        try:
+            finished = 0
+            while finished < len(cfgs):
+                item = pages.get()
+                if item is done:
+                    finished += 1
+                elif isinstance(item, Exception):
+                    raise item
+                else:
+                    yield item
+        finally:
+            stop.set()
+
+def extract_incremental(raw_cfg: dict, conn) -> tuple[list, list[dict]]:
+    '''
+    Инкрементальная выгрузка: по водяным знакам из БД качаем только недостающие или обновленные диапазоны лет.
+    Возвращает данные и список выполненных задач - по нему после загрузки сдвигаются водяные знаки.
+    Пустой результат здесь нормальная ситуация (ничего не поменялось), поэтому не останавливаемся
+    '''
+    logger.info(f"НАЧИНАЕМ ИНКРЕМЕНТАЛЬНО ЗАГРУЖАТЬ ДАННЫЕ!!!")
+    tasks = plan_incremental(raw_cfg, conn)
+
+    task_cfgs = []
+    for task in tasks:
+        task_cfg = deepcopy(raw_cfg)
+        task_cfg["countries"] = task["countries"]
+        task_cfg["indicators"] = [task["indicator"]]
+        task_cfg["date_interval"] = task["date_interval"]
+        task_cfgs.extend(split_by_indicator(process_cfg_for_api(task_cfg)))
+
+    full_data = fetch_all(task_cfgs, raw_cfg["indicator_workers"])
+    logger.info(f"Инкрементально получено {len(full_data)} строк")
+    return full_data, tasks
+
+def split_by_indicator(processed_cfg: dict) -> list[dict]:
+    '''
+    Для каждого индикатора своя копия конфига - общий processed_cfg не трогаем, потоки работают параллельно
+    '''
+    indicator_cfgs = []
+    for indicator in processed_cfg["indicators"]:
+        indicator_cfg = deepcopy(processed_cfg)
+        indicator_cfg["url"] = processed_cfg["url"] + indicator
+        indicator_cfgs.append(indicator_cfg)
+    return indicator_cfgs
+
+def fetch_all(cfgs: list[dict], indicator_workers: int) -> list:
+    full_data = []
+    if not cfgs:
+        return full_data
+    workers = max(1, min(indicator_workers, len(cfgs)))
+    logger.info(f"Запросов {len(cfgs)}, качаем в {workers} потоков")
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        # Общую скорость запросов держит rate limiter в safe_request, порядок запросов сохраняется
+        for data in executor.map(get_paginated_data, cfgs):
+            full_data.extend(data)
+    return full_data
@@ -0,0 +1,134 @@
+'''
+Советник по индексам: сравнивает индексы в БД с тем, что нужно запросам витрины (etl/mart.py)
+и BI-представлениям (vew_preaparation.sql), и с внешними ключами, на которые индекса нет.
+Отчет: python main.py indexes, создать недостающие: python main.py indexes --create
+'''
+
+from psycopg2 import sql
+
+from etl.load import create_index, index_name, CHANGE_FEED_TABLE, MAIN_TABLE
+from etl.logger import get_stage_logger
+from etl.mart import MART_TABLE
+
+logger = get_stage_logger("load")
+
+# (таблица, столбцы, какой запрос его использует). Индекс подходит, если его первые столбцы - ровно эти
+RECOMMENDED_INDEXES = [
+    (MAIN_TABLE, ["country_sk", "indicator_sk", "year"], "окна витрины PARTITION BY country_sk, indicator_sk ORDER BY year"),
+    (MAIN_TABLE, ["indicator_sk"], "JOIN indicator в витрине, отбор по индикатору в verify_shards"),
+    ("country", ["sk"], "JOIN country ON c.sk = m.country_sk"),
+    ("indicator", ["sk"], "JOIN indicator ON i.sk = m.indicator_sk"),
+    ("country", ["region_id"], "JOIN region ON c.region_id = r.region_id"),
+    ("country", ["income_level_id"], "JOIN income_level ON c.income_level_id = il.income_level_id"),
+    ("region", ["region_id"], "JOIN region ON c.region_id = r.region_id"),
+    ("income_level", ["income_level_id"], "JOIN income_level ON c.income_level_id = il.income_level_id"),
+    (CHANGE_FEED_TABLE, ["batch_id"], "инкрементальная витрина: WHERE batch_id <= ..."),
+    (MART_TABLE, ["indicator_id", "year"], "v_global, v_country_rank: GROUP BY / PARTITION BY indicator_id, year"),
+    (MART_TABLE, ["region_id", "indicator_id", "year"], "v_region: GROUP BY region_id, indicator_id, year"),
+    (MART_TABLE, ["income_level_id", "indicator_id", "year"], "v_income_level: GROUP BY income_level_id, indicator_id, year"),
+    (MART_TABLE, ["country_id"], "отбор по стране в BI"),
+]
+
+def get_table_columns(conn, schema = 'public') -> dict:
+    '''{таблица: множество столбцов} для таблиц схемы'''
+    with conn.cursor() as cur:
+        cur.execute(
+            "SELECT table_name, column_name FROM information_schema.columns WHERE table_schema = %s;", [schema]
+        )
+        columns = {}
+        for table, column in cur.fetchall():
+            columns.setdefault(table, set()).add(column)
+    return columns
+
+def get_existing_indexes(conn, schema = 'public') -> dict:
+    '''{таблица: [список столбцов каждого индекса по порядку]}, включая индексы pk и unique'''
+    with conn.cursor() as cur:
+        cur.execute("""
+        SELECT t.relname, array_agg(a.attname ORDER BY k.ord)
+        FROM pg_index AS x
+        JOIN pg_class AS t ON t.oid = x.indrelid
+        JOIN pg_namespace AS n ON n.oid = t.relnamespace
+        CROSS JOIN LATERAL unnest(x.indkey::smallint[]) WITH ORDINALITY AS k (attnum, ord)
+        JOIN pg_attribute AS a ON a.attrelid = t.oid AND a.attnum = k.attnum
+        WHERE n.nspname = %s
+        GROUP BY x.indexrelid, t.relname;
+        """, [schema])
+        indexes = {}
+        for table, columns in cur.fetchall():
+            indexes.setdefault(table, []).append(list(columns))
+    return indexes
+
+def get_foreign_keys(conn, schema = 'public') -> list[tuple]:
+    '''[(таблица, [столбцы fk])] для всех внешних ключей схемы'''
+    with conn.cursor() as cur:
+        cur.execute("""
+        SELECT t.relname, array_agg(a.attname ORDER BY k.ord)
+        FROM pg_constraint AS c
+        JOIN pg_class AS t ON t.oid = c.conrelid
+        JOIN pg_namespace AS n ON n.oid = t.relnamespace
+        CROSS JOIN LATERAL unnest(c.conkey) WITH ORDINALITY AS k (attnum, ord)
+        JOIN pg_attribute AS a ON a.attrelid = t.oid AND a.attnum = k.attnum
+        WHERE c.contype = 'f' AND n.nspname = %s
+        GROUP BY c.oid, t.relname;
+        """, [schema])
+        return [(table, list(columns)) for table, columns in cur.fetchall()]
+
+def get_scan_stats(conn, schema = 'public') -> dict:
+    '''{таблица: (seq_scan, idx_scan, живых строк)} из pg_stat_user_tables'''
+    with conn.cursor() as cur:
+        cur.execute(
+            "SELECT relname, seq_scan, COALESCE(idx_scan, 0), n_live_tup FROM pg_stat_user_tables WHERE schemaname = %s;",
+            [schema]
+        )
+        return {table: stats for table, *stats in cur.fetchall()}
+
+def is_covered(columns: list, indexes: list[list]) -> bool:
+    return any(index[:len(columns)] == columns for index in indexes)
+
+def advise_indexes(conn, schema = 'public') -> list[dict]:
+    '''
+    Недостающие индексы: из RECOMMENDED_INDEXES (только для существующих таблиц с нужными столбцами)
+    и на внешние ключи без индекса. Каждый элемент: {"table", "columns", "reason"}
+    '''
+    table_columns = get_table_columns(conn, schema)
+    indexes = get_existing_indexes(conn, schema)
+    wanted = list(RECOMMENDED_INDEXES)
+    wanted += [(table, columns, "внешний ключ") for table, columns in get_foreign_keys(conn, schema)]
+
+    missing = []
+    for table, columns, reason in wanted:
+        if not set(columns) <= table_columns.get(table, set()):
+            continue
+        if is_covered(columns, indexes.get(table, [])):
+            continue
+        if any(item["table"] == table and item["columns"] == columns for item in missing):
+            continue
+        missing.append({"table": table, "columns": columns, "reason": reason})
+    return missing
+
+def create_missing_indexes(conn, missing: list[dict], schema = 'public'):
+    '''
+    Создает индексы из advise_indexes и обновляет статистику таблиц, чтобы планировщик сразу их учел.
+    CREATE INDEX блокирует запись в таблицу на время построения - запускать между загрузками
+    '''
+    with conn.cursor() as cur:
+        for item in missing:
+            logger.info(f"Создаем индекс {index_name(item['table'], item['columns'])}")
+            create_index(cur, item["table"], item["columns"], schema)
+        for table in sorted({item["table"] for item in missing}):
+            cur.execute(sql.SQL("ANALYZE {};").format(sql.Identifier(schema, table)))
+    conn.commit()
+
+def report_indexes(conn, create: bool = False, schema = 'public') -> list[dict]:
+    '''Печатает недостающие индексы и статистику сканирований, при create - создает их'''
+    missing = advise_indexes(conn, schema)
+    stats = get_scan_stats(conn, schema)
+    for item in missing:
+        seq_scan, idx_scan, rows = stats.get(item["table"], (0, 0, 0))
+        print(f"  {item['table']} ({', '.join(item['columns'])}) - {item['reason']}; "
+              f"строк ~{rows}, полных сканирований {seq_scan}, по индексу {idx_scan}")
+    print(f"Недостающих индексов: {len(missing)}")
+    if create and missing:
+        create_missing_indexes(conn, missing, schema)
+        print(f"Создано индексов: {len(missing)}")
+    return missing
@@ -1,25 +1,150 @@
+import io
+import threading
+import time
+from contextlib import contextmanager
+
+import numpy as np
+import pandas as pd
 import psycopg2
-from psycopg2 import sql
+from psycopg2 import pool, sql
 from etl.logger import get_stage_logger
+from etl.metrics import inc, observe
+from etl.transform import row_hashes
 
 logger = get_stage_logger("load")
 
+# Сколько строк за раз сериализуем в CSV для COPY, чтобы не держать в памяти весь CSV целиком
+COPY_BATCH_ROWS = 100000
+
+# Типизированная таблица фактов, см. ensure_main_table
+MAIN_TABLE = "main_table"
+MAIN_TABLE_KEY = ["country_sk", "indicator_sk", "year"]
+MAIN_TABLE_COLUMNS = MAIN_TABLE_KEY + ["value", "obs_status", "unit", "row_hash"]
+PARTITION_KEY = ["country_sk", "indicator_sk"]
+# Секционирование main_table (partitioning в конфиге): "" - одна таблица, "decade" - по годам (десятилетиями),
+# "indicator" - по индикатору. Секции создаются сами по мере прихода данных, см. ensure_partitions
+PARTITIONING = {
+    "decade": sql.SQL("RANGE (year)"),
+    "indicator": sql.SQL("LIST (indicator_sk)"),
+}
+PARTITION_YEARS = 10
+LOAD_BATCH_TABLE = "etl_load_batch"
+CHANGE_FEED_TABLE = "etl_change_feed"
+# справочник: (столбец с кодом в transform, тип sk в справочнике, столбец в main_table, dtype в pandas)
+SURROGATE_KEYS = {
+    "country": ("country_id", "SMALLSERIAL", "country_sk", np.int16),
+    "indicator": ("indicator_id", "SERIAL", "indicator_sk", np.int32),
+}
+
+_pools = {}
+_pools_lock = threading.Lock()
+# Кэш каталога {(dsn, schema): {table: pk}} - живет весь запуск, сбрасывается только после DDL
+_catalog_cache = {}
+_catalog_lock = threading.Lock()
+# Поколение кэша каталога - растет при каждом сбросе. Запрос, начатый до сброса, свой результат в кэш не пишет:
+# он мог прочитать каталог до DDL и вернул бы в кэш уже устаревший список таблиц
+_catalog_generation = 0
+# Справочники, в которых уже проверили наличие sk за этот запуск
+_surrogate_keys_ready = set()
+# (dsn, схема), для которых main_table в этом процессе уже проверена (ensure_main_table)
+_main_table_ready = set()
+# Уже существующие секции main_table {(dsn, schema): {имя секции}}
+_partitions_cache = {}
+
+def with_db_retries(connect, cfg: dict):
+    '''
+    Ретраи на ошибки соединения (OperationalError) с экспоненциальной паузой: pause, 2*pause, 4*pause...
+    '''
+    retries = cfg.get("db_retries", 3)
+    pause = cfg.get("pause", 2)
+    for i in range(1, 1 + retries):
+        try:
+            return connect()
+        except psycopg2.OperationalError as e:
+            logger.info(f"Ошибка подключения к БД (попытка {i}/{retries}): {e}")
+            if i == retries:
+                raise
+            time.sleep(pause * 2 ** (i - 1))
+
 def get_bd_connection(cfg:dict):
-    logger.info("Подключение к БД создано")
-    return psycopg2.connect(
+    conn = with_db_retries(lambda: psycopg2.connect(
         dbname=cfg["dbname"],
         user=cfg["user"],
         password=cfg["password"],
         host=cfg["host"],
         port=cfg["port"]
-    )
+    ), cfg)
+    logger.info("Подключение к БД создано")
+    return conn
 
-def get_existing_tables(conn, schema = 'public') -> dict:
+def get_bd_pool(cfg: dict) -> pool.ThreadedConnectionPool:
+    '''
+    Пул соединений на процесс, один на каждую БД из конфига. Соединения открываются по мере надобности,
+    одновременно не больше db_pool_size
+    '''
+    key = (cfg["host"], cfg["port"], cfg["dbname"], cfg["user"])
+    with _pools_lock:
+        bd_pool = _pools.get(key)
+        if bd_pool is None or bd_pool.closed:
+            bd_pool = pool.ThreadedConnectionPool(
+                0, cfg.get("db_pool_size", 5),
+                dbname=cfg["dbname"],
+                user=cfg["user"],
+                password=cfg["password"],
+                host=cfg["host"],
+                port=cfg["port"]
+            )
+            _pools[key] = bd_pool
+            logger.info("Пул подключений к БД создан")
+        return bd_pool
+
+@contextmanager
+def bd_connection(cfg: dict):
+    '''
+    Берет соединение из пула (с ретраями на ошибки подключения) и гарантированно возвращает его обратно.
+    Незакоммиченная транзакция при выходе откатывается, оборванное соединение выкидывается из пула
+    '''
+    bd_pool = get_bd_pool(cfg)
+    conn = with_db_retries(bd_pool.getconn, cfg)
+    try:
+        yield conn
+    finally:
+        if not conn.closed:
+            conn.rollback()
+        bd_pool.putconn(conn, close=bool(conn.closed))
+
+def close_bd_pools():
+    with _pools_lock:
+        for bd_pool in _pools.values():
+            bd_pool.closeall()
+        _pools.clear()
+    logger.info("Пулы подключений к БД закрыты")
+
+def invalidate_catalog_cache(conn = None, schema = None):
+    '''
+    Сброс кэша каталога - вызывается после DDL (создание таблиц), без аргументов сбрасывает весь кэш
+    '''
+    global _catalog_generation
+    with _catalog_lock:
+        _catalog_generation += 1
+        if conn is None:
+            _catalog_cache.clear()
+        else:
+            for key in [k for k in _catalog_cache if k[0] == conn.dsn and (schema is None or k[1] == schema)]:
+                del _catalog_cache[key]
+
+def get_existing_tables(conn, schema = 'public', use_cache = True) -> dict:
     '''
     Данная функция делает запрос к Postgress бд и возвращает словарь
     ключи которого названия таблиц - значения названия pk столбцов
     эта функция нужная при создании автоматических связей столбцов вновь созданной таблицы
+    Результат кэшируется на запуск (по dsn и схеме), кэш сбрасывается после создания таблиц
     '''
+    key = (conn.dsn, schema)
+    with _catalog_lock:
+        if use_cache and key in _catalog_cache:
+            return dict(_catalog_cache[key])
+        generation = _catalog_generation
 
     query = """
            SELECT 
@@ -39,6 +164,9 @@ def get_existing_tables(conn, schema = 'public') -> dict:
         for table_name, pk_column in cur.fetchall():
             existing_tables[table_name] = pk_column
     logger.info("В данный момент в нашей схеме существуют след таблицы и их PK")
+    with _catalog_lock:
+        if generation == _catalog_generation:
+            _catalog_cache[key] = dict(existing_tables)
     return existing_tables
 
 def create_table(conn, table_name, df, schema = 'public'):
@@ -54,13 +182,15 @@ def create_table(conn, table_name, df, schema = 'public'):
     Также мы пытаемся найти связи с другими таблицами, предположение если есть столбец формаата.
     {table_name}_id - то есть таблица table_name pk, которой связан с нашим столбцом для нахождения актуаальных
     справочных таблиц пользуемся функцией get_existing_tables
-    ***Также мможет сразу сделаем индексами все fk для оптимизации работы дальнейших обращений к нашей бд
+    На каждый найденный fk сразу создается индекс - Postgres сам индексы на fk не строит,
+    и без них соединения со справочниками идут полным перебором
     '''
     logger.info(f"Создаем таблицу {table_name}")
     existing_tables = get_existing_tables(conn, schema)
     columns = []
     primary_keys = []
     foreign_keys = []
+    fk_columns = []
 
     for col, dtype in zip(df.columns, df.dtypes):
         if "int" in str(dtype):
@@ -85,6 +215,7 @@ def create_table(conn, table_name, df, schema = 'public'):
                         ref_pk=sql.Identifier(ref_pk)
                     )
                 )
+                fk_columns.append(col)
 
         columns.append(sql.SQL("{} {}").format(sql.Identifier(col), sql.SQL(pg_type)))
 
@@ -106,57 +237,671 @@ def create_table(conn, table_name, df, schema = 'public'):
         pk_sql,
         sql.SQL(", ") + fk_sql if foreign_keys else sql.SQL("")
     )
+    # Индекс на pk уже есть, на fk, совпадающий с первым столбцом pk, - тоже
+    index_columns = [[col] for col in fk_columns if col not in primary_keys[:1]]
+
     #logger.info(f"Итоговый Sql запрос {query}")
     with conn.cursor() as cur:
         cur.execute(query)
+        for cols in index_columns:
+            create_index(cur, table_name, cols, schema)
         conn.commit()
-        logger.info(f"Таблица {table_name} есть - создана, или уже существовала")
+        logger.info(f"Таблица {table_name} есть - создана, или уже существовала, индексов {len(index_columns)}")
+    invalidate_catalog_cache(conn, schema)
+
+def index_name(table_name, columns) -> str:
+    # Длиннее 63 символов Postgres имя обрежет сам, обрезаем заранее, чтобы IF NOT EXISTS сравнивал то же имя
+    return f"{table_name}_{'_'.join(columns)}_idx"[:63]
+
+def create_index(cur, table_name, columns, schema = 'public'):
+    '''
+    Индекс с предсказуемым именем {таблица}_{столбцы}_idx, повторный вызов ничего не делает.
+    Есть ли индекс, сначала смотрим в каталоге: CREATE INDEX IF NOT EXISTS берет ShareLock на таблицу
+    (ждет и блокирует загрузки) еще до проверки имени
+    '''
+    cur.execute("SELECT to_regclass(%s);", [f'"{schema}"."{index_name(table_name, columns)}"'])
+    if cur.fetchone()[0] is not None:
+        return
+    cur.execute(sql.SQL("CREATE INDEX IF NOT EXISTS {name} ON {table} ({columns});").format(
+        name=sql.Identifier(index_name(table_name, columns)),
+        table=sql.Identifier(schema, table_name),
+        columns=sql.SQL(", ").join(map(sql.Identifier, columns))
+    ))
 
-def load_data(conn, table_name, df, schema = 'public'):
+def load_data(conn, table_name, df, schema = 'public', method = 'copy'):
     '''
     Функция загружает в Postgress БД таблицу с названием {table_name} из pd.df
-    используем множественную вставку executemany()
+    По умолчанию (method='copy') грузим через COPY FROM STDIN во временную таблицу и одним
+    INSERT ... SELECT ... ON CONFLICT переносим в целевую - upsert сохраняется, а строки идут потоком
+    без отдельного запроса на каждую. Если COPY не удался - откатываемся на старый путь
+    method='executemany' - множественная вставка executemany() построчно
     Предварительно с помощью метода get_existing_tables() проверяем есь ли такая таблица в бд
     есмли есть то мы ее не создаем
 
     '''
     logger.info(f"Выполняем заполнение таблицы {table_name} ")
+    started = time.perf_counter()
     columns = list(df.columns)
-    values = list(df.values)
     existing_tables = get_existing_tables(conn, schema)
     if not existing_tables.get(table_name, []):
         logger.info(f"Таблицы {table_name} не существует")
-        create_table(conn, table_name, df)
-
-    existing_tables = get_existing_tables(conn, schema)
+        create_table(conn, table_name, df, schema)
+        # Только что созданная таблица - читаем каталог из БД, а не из кэша
+        existing_tables = get_existing_tables(conn, schema, use_cache=False)
     pk = existing_tables[table_name]
     fields = sql.SQL(", ").join(sql.Identifier(col) for col in columns)
-    placeholders = sql.SQL(", ").join(sql.Placeholder() for _ in columns)
 
+    update_columns = [col for col in columns if col != pk]
     update_assignments = sql.SQL(", ").join(
         sql.SQL("{} = EXCLUDED.{}").format(sql.Identifier(col), sql.Identifier(col))
 
-        for col in columns
-        if col != pk
+        for col in update_columns
+    )
+    # Строки, которые не поменялись, не перезаписываем - иначе каждая загрузка плодит новые версии строк
+    conflict_sql = sql.SQL("ON CONFLICT ({pk}) DO UPDATE SET {updates} WHERE ({current}) IS DISTINCT FROM ({new})").format(
+        pk=sql.Identifier(pk),
+        updates=update_assignments,
+        current=sql.SQL(", ").join(sql.Identifier(table_name, col) for col in update_columns),
+        new=sql.SQL(", ").join(sql.Identifier("excluded", col) for col in update_columns)
     )
+    if all(col == pk for col in columns):
+        conflict_sql = sql.SQL("ON CONFLICT ({pk}) DO NOTHING").format(pk=sql.Identifier(pk))
 
+    if method == 'copy':
+        try:
+            changed = copy_upsert(conn, schema, table_name, df, pk, fields, conflict_sql, returning=[pk])
+            logger.info(f"Таблица {table_name} успешно заполнена через COPY, {len(df)} строк, "
+                        f"без изменений {len(df) - len(changed)}")
+            observe("db_seconds", time.perf_counter() - started, table=table_name)
+            inc("rows_loaded_total", len(df), table=table_name)
+            inc("rows_changed_total", len(changed), table=table_name)
+            inc("rows_unchanged_total", len(df) - len(changed), table=table_name)
+            return
+        except Exception as e:
+            # Не только psycopg2.Error: ошибка сериализации строк в copy_expert тоже оставила бы транзакцию открытой
+            conn.rollback()
+            logger.info(f"COPY-загрузка {table_name} не удалась: {e}. Используем executemany")
+
+    # NaN в NUMERIC записался бы как 'NaN', а не NULL
+    values = list(df.astype(object).where(df.notna(), None).values)
+    placeholders = sql.SQL(", ").join(sql.Placeholder() for _ in columns)
     insert_query = sql.SQL("""
     INSERT INTO {schema}.{table} ({fields})
     VALUES ({placeholders})
-    ON CONFLICT ({pk}) 
-    DO UPDATE SET {updates};
+    {conflict};
     """).format(
         schema=sql.Identifier(schema),
         table=sql.Identifier(table_name),
         placeholders=placeholders,
         fields=fields,
-        pk=sql.Identifier(pk),
-        updates=update_assignments
+        conflict=conflict_sql
     )
+    try:
+        with conn.cursor() as cur:
+            cur.executemany(insert_query, values)
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    logger.info(f"Таблица {table_name}успешно заполнена")
+    observe("db_seconds", time.perf_counter() - started, table=table_name)
+    inc("rows_loaded_total", len(df), table=table_name)
+
+def copy_dataframe(cur, table, df, fields):
+    '''
+    COPY FROM STDIN кусками по COPY_BATCH_ROWS строк, table - sql.Identifier, fields - список столбцов (sql)
+    '''
+    copy_query = sql.SQL("COPY {table} ({fields}) FROM STDIN WITH (FORMAT csv)").format(
+        table=table,
+        fields=fields
+    ).as_string(cur.connection)
+    for start in range(0, len(df), COPY_BATCH_ROWS):
+        buffer = io.StringIO()
+        df.iloc[start:start + COPY_BATCH_ROWS].to_csv(buffer, index=False, header=False)
+        buffer.seek(0)
+        cur.copy_expert(copy_query, buffer)
+
+def copy_upsert(conn, schema, table_name, df, pk, fields, conflict_sql, returning = None, commit = True):
+    '''
+    Потоковая загрузка через COPY во временную таблицу с теми же столбцами (ON COMMIT DROP),
+    затем один set-based INSERT ... SELECT ... ON CONFLICT в целевую таблицу. Все в одной транзакции.
+    Дубли по pk внутри одной загрузки убираем заранее (оставляем последнюю строку, как было бы при executemany),
+    иначе ON CONFLICT DO UPDATE упадет на повторном изменении той же строки
+    returning - столбцы для RETURNING (список), тогда функция вернет вставленные/измененные строки.
+    commit=False - транзакцию закрывает вызывающий (например, чтобы в ней же записать журнал изменений)
+    '''
+    pk_columns = [pk] if isinstance(pk, str) else list(pk)
+    if all(col in df.columns for col in pk_columns):
+        df = df.drop_duplicates(subset=pk_columns, keep="last")
+    staging = sql.Identifier(f"tmp_{table_name}")
+    returning_sql = sql.SQL("")
+    if returning:
+        returning_sql = sql.SQL("RETURNING {}").format(sql.SQL(", ").join(map(sql.Identifier, returning)))
+    rows = None
+    with conn.cursor() as cur:
+        cur.execute(sql.SQL(
+            "CREATE TEMP TABLE {staging} ON COMMIT DROP AS SELECT {fields} FROM {schema}.{table} WITH NO DATA;"
+        ).format(
+            staging=staging,
+            fields=fields,
+            schema=sql.Identifier(schema),
+            table=sql.Identifier(table_name)
+        ))
+        copy_dataframe(cur, staging, df, fields)
+
+        cur.execute(sql.SQL("""
+        INSERT INTO {schema}.{table} ({fields})
+        SELECT {fields} FROM {staging}
+        {conflict}
+        {returning};
+        """).format(
+            schema=sql.Identifier(schema),
+            table=sql.Identifier(table_name),
+            fields=fields,
+            staging=staging,
+            conflict=conflict_sql,
+            returning=returning_sql
+        ))
+        if returning:
+            rows = cur.fetchall()
+    if commit:
+        conn.commit()
+    return rows
+
+def ensure_surrogate_key(conn, ref_table, schema = 'public'):
+    '''
+    В справочнике добавляем суррогатный целочисленный ключ sk (SMALLSERIAL для стран, SERIAL для индикаторов).
+    Факты в main_table ссылаются на него вместо текстовых кодов - меньше места и быстрее соединения
+    '''
+    key = (conn.dsn, schema, ref_table)
+    if key in _surrogate_keys_ready:
+        return
+    if ref_table not in get_existing_tables(conn, schema):
+        raise RuntimeError(
+            f"Справочника {ref_table} нет в БД. Сначала запустите create_ref_tables_con и create_ref_tables_ind"
+        )
+    with conn.cursor() as cur:
+        cur.execute(sql.SQL("ALTER TABLE {schema}.{table} ADD COLUMN IF NOT EXISTS sk {type} UNIQUE;").format(
+            schema=sql.Identifier(schema),
+            table=sql.Identifier(ref_table),
+            type=sql.SQL(SURROGATE_KEYS[ref_table][1])
+        ))
+    conn.commit()
+    _surrogate_keys_ready.add(key)
+
+def resolve_surrogate_keys(conn, ref_table, codes, schema = 'public') -> dict:
+    '''
+    Возвращает словарь {код: sk} по справочнику. Кодов, которых в справочнике нет (например агрегированные
+    регионы, которые мы не грузим в country), добавляем заглушкой из одного id, чтобы не терять наблюдения
+    '''
+    ensure_surrogate_key(conn, ref_table, schema)
+    codes = [str(code) for code in codes]
+    table = sql.Identifier(schema, ref_table)
+    with conn.cursor() as cur:
+        # Вставляем только отсутствующие коды - иначе ON CONFLICT все равно тратит значения последовательности sk
+        cur.execute(sql.SQL(
+            "INSERT INTO {table} (id) SELECT code FROM unnest(%s::text[]) AS code "
+            "WHERE NOT EXISTS (SELECT 1 FROM {table} AS t WHERE t.id = code) ON CONFLICT (id) DO NOTHING;"
+        ).format(table=table), [codes])
+        if cur.rowcount:
+            logger.info(f"В справочник {ref_table} добавлено {cur.rowcount} новых кодов без описания")
+        cur.execute(sql.SQL("SELECT id, sk FROM {table} WHERE id = ANY(%s);").format(table=table), [codes])
+        mapping = dict(cur.fetchall())
+    conn.commit()
+    return mapping
+
+def to_storage_layout(conn, df, schema = 'public'):
+    '''
+    Переводит результат transform в компактный вид main_table:
+    country_id/indicator_id -> country_sk/indicator_sk, date -> year SMALLINT, value остается float (NaN = NULL)
+    '''
+    storage = {}
+    for ref_table, (code_col, _, sk_col, sk_dtype) in SURROGATE_KEYS.items():
+        codes = df[code_col].astype("category")
+        mapping = resolve_surrogate_keys(conn, ref_table, codes.cat.categories, schema)
+        keys = np.array([mapping[str(code)] for code in codes.cat.categories], dtype=sk_dtype)
+        storage[sk_col] = keys[codes.cat.codes.to_numpy()]
+    storage["year"] = df["date"].to_numpy(dtype=np.int16)
+    storage["value"] = df["value"].to_numpy(dtype=np.float64)
+    storage["obs_status"] = df["obs_status"].to_numpy(dtype=object)
+    storage["unit"] = df["unit"].to_numpy(dtype=object)
+    storage["row_hash"] = df["row_hash"].to_numpy() if "row_hash" in df.columns else row_hashes(df)
+    return pd.DataFrame(storage, columns=MAIN_TABLE_COLUMNS)
+
+def ensure_main_table(conn, schema = 'public', partitioning = None):
+    '''
+    Типизированная таблица фактов. Таблица в старом формате (country_id TEXT, date TEXT, value TEXT с 'N/F')
+    переименовывается в main_table_legacy, а ее данные переносятся в новый формат.
+    partitioning - секционирование новой таблицы (ключи PARTITIONING, "" или None - без секций).
+    Существующая таблица при загрузке не перестраивается: если она секционирована иначе, пишем предупреждение
+    и грузим в нее как есть, перестроить - отдельным шагом python main.py repartition (repartition_main_table)
+    Вызывается на каждой загрузке, поэтому DDL по существующей таблице выполняется только если он нужен
+    (ALTER TABLE берет ACCESS EXCLUSIVE на main_table и все секции и блокирует чтение BI и параллельные
+    загрузки шардов), а после первой проверки в процессе таблица больше не проверяется
+    '''
+    ready_key = (conn.dsn, schema)
+    if ready_key in _main_table_ready:
+        return
+    existing_tables = get_existing_tables(conn, schema)
+    legacy = False
+    if MAIN_TABLE in existing_tables and partitioning is not None:
+        current = get_partitioning(conn, schema)
+        if current != partitioning:
+            logger.warning(f"{MAIN_TABLE} секционирована как {current or 'без секций'}, а в конфиге partitioning = "
+                           f"{partitioning!r} - грузим в текущую таблицу. Перестроить: python main.py repartition")
+    if MAIN_TABLE in existing_tables:
+        with conn.cursor() as cur:
+            cur.execute(
+                "SELECT column_name FROM information_schema.columns "
+                "WHERE table_schema = %s AND table_name = %s AND column_name IN ('country_sk', 'row_hash');",
+                [schema, MAIN_TABLE]
+            )
+            columns = {column for column, in cur.fetchall()}
+            if "country_sk" in columns:
+                if "row_hash" not in columns:
+                    # Таблицы до появления row_hash - у старых строк хэш NULL, он заполнится при следующей загрузке
+                    cur.execute(sql.SQL("ALTER TABLE {} ADD COLUMN IF NOT EXISTS row_hash BIGINT;").format(
+                        sql.Identifier(schema, MAIN_TABLE)
+                    ))
+                create_index(cur, MAIN_TABLE, ["indicator_sk"], schema)
+                conn.commit()
+                _main_table_ready.add(ready_key)
+                return
+        legacy = True
+        logger.info(f"Таблица {MAIN_TABLE} в старом формате, переименовываем в {MAIN_TABLE}_legacy")
+
+    for ref_table in ("country", "indicator"):
+        ensure_surrogate_key(conn, ref_table, schema)
+    with conn.cursor() as cur:
+        if legacy:
+            cur.execute(sql.SQL("ALTER TABLE {} RENAME TO {};").format(
+                sql.Identifier(schema, MAIN_TABLE), sql.Identifier(f"{MAIN_TABLE}_legacy")
+            ))
+        # Старую таблицу переносим без секций, секционирование - отдельным шагом (repartition_main_table)
+        if legacy and partitioning:
+            logger.warning(f"{MAIN_TABLE}_legacy переносится без секций. Секционировать: python main.py repartition")
+        create_main_table(cur, None if legacy else partitioning, schema)
+        if legacy:
+            migrate_legacy_main_table(cur, schema)
+    conn.commit()
+    invalidate_catalog_cache(conn, schema)
+    _main_table_ready.add(ready_key)
+    logger.info(f"Таблица {MAIN_TABLE} есть - создана, или уже существовала"
+                + (f", секционирование {partitioning}" if partitioning else ""))
+
+def create_main_table(cur, partitioning = None, schema = 'public'):
+    cur.execute(sql.SQL("""
+    CREATE TABLE IF NOT EXISTS {table} (
+        country_sk SMALLINT NOT NULL REFERENCES {country} (sk),
+        indicator_sk INTEGER NOT NULL REFERENCES {indicator} (sk),
+        year SMALLINT NOT NULL,
+        value DOUBLE PRECISION,
+        obs_status TEXT,
+        unit TEXT,
+        row_hash BIGINT,
+        PRIMARY KEY (country_sk, indicator_sk, year)
+    ){partition_by};
+    """).format(
+        table=sql.Identifier(schema, MAIN_TABLE),
+        country=sql.Identifier(schema, "country"),
+        indicator=sql.Identifier(schema, "indicator"),
+        partition_by=sql.SQL(" PARTITION BY {}").format(PARTITIONING[partitioning]) if partitioning else sql.SQL("")
+    ))
+    # country_sk - первый столбец pk, для него отдельный индекс не нужен, для indicator_sk - нужен
+    create_index(cur, MAIN_TABLE, ["indicator_sk"], schema)
+
+def create_partition(cur, partitioning, key, schema = 'public'):
+    if partitioning == "decade":
+        bounds = sql.SQL("FROM ({}) TO ({})").format(sql.Literal(key), sql.Literal(key + PARTITION_YEARS))
+    else:
+        bounds = sql.SQL("IN ({})").format(sql.Literal(key))
+    cur.execute(sql.SQL("CREATE TABLE IF NOT EXISTS {part} PARTITION OF {table} FOR VALUES {bounds};").format(
+        part=sql.Identifier(schema, partition_name(partitioning, key)),
+        table=sql.Identifier(schema, MAIN_TABLE),
+        bounds=bounds
+    ))
+
+def get_partitioning(conn, schema = 'public') -> str:
+    '''Как сейчас секционирована main_table: ключ PARTITIONING или "" (без секций)'''
     with conn.cursor() as cur:
-        cur.executemany(insert_query, values)
+        cur.execute("""
+        SELECT pt.partstrat, a.attname
+        FROM pg_partitioned_table AS pt
+        JOIN pg_class AS t ON t.oid = pt.partrelid
+        JOIN pg_namespace AS n ON n.oid = t.relnamespace
+        JOIN pg_attribute AS a ON a.attrelid = t.oid AND a.attnum = pt.partattrs[0]
+        WHERE n.nspname = %s AND t.relname = %s;
+        """, [schema, MAIN_TABLE])
+        row = cur.fetchone()
+    if row is None:
+        return ""
+    return {("r", "year"): "decade", ("l", "indicator_sk"): "indicator"}.get(tuple(row), "")
+
+def get_partitions(conn, schema = 'public') -> set:
+    with conn.cursor() as cur:
+        cur.execute(
+            "SELECT c.relname FROM pg_inherits AS i JOIN pg_class AS c ON c.oid = i.inhrelid "
+            "WHERE i.inhparent = %s::regclass;",
+            [f"{schema}.{MAIN_TABLE}"]
+        )
+        return {name for name, in cur.fetchall()}
+
+def partition_keys(partitioning, storage_df) -> np.ndarray:
+    '''Для каждой строки - ключ ее секции: начало десятилетия или indicator_sk'''
+    if partitioning == "decade":
+        return storage_df["year"].to_numpy(dtype=np.int64) // PARTITION_YEARS * PARTITION_YEARS
+    return storage_df["indicator_sk"].to_numpy(dtype=np.int64)
+
+def partition_name(partitioning, key) -> str:
+    return f"{MAIN_TABLE}_y{key}" if partitioning == "decade" else f"{MAIN_TABLE}_i{key}"
+
+def ensure_partitions(conn, partitioning, keys, schema = 'public') -> dict:
+    '''
+    Создает недостающие секции main_table под ключи keys, возвращает {ключ: имя секции}.
+    Каждая секция создается отдельной транзакцией: несколько процессов (шардированная загрузка)
+    могут создавать одну и ту же секцию одновременно - проигравший просто получает уже созданную
+    '''
+    cache_key = (conn.dsn, schema)
+    if cache_key not in _partitions_cache:
+        _partitions_cache[cache_key] = get_partitions(conn, schema)
         conn.commit()
-        logger.info(f"Таблица {table_name}успешно заполнена")
+    existing = _partitions_cache[cache_key]
+
+    names = {}
+    for key in sorted({int(key) for key in keys}):
+        name = partition_name(partitioning, key)
+        names[key] = name
+        if name in existing:
+            continue
+        try:
+            with conn.cursor() as cur:
+                create_partition(cur, partitioning, key, schema)
+            conn.commit()
+            logger.info(f"Создана секция {name}")
+        except (psycopg2.errors.DuplicateTable, psycopg2.errors.UniqueViolation):
+            conn.rollback()
+        existing.add(name)
+    return names
+
+def repartition_main_table(conn, partitioning, schema = 'public') -> bool:
+    '''
+    Перевод main_table на другое секционирование - отдельный шаг администрирования (python main.py repartition),
+    обычная загрузка его не делает. Все в одной транзакции: старая таблица (и ее секции) переименовывается
+    в main_table_before_{partitioning}, создается новая, секции под имеющиеся данные, строки переносятся
+    одним INSERT ... SELECT. Если перенос упал, откатывается все и main_table остается как была.
+    После успешного переноса копия остается, ее можно удалить вручную.
+    Пока идет перенос, main_table заблокирована - запускать между загрузками.
+    Возвращает False, если таблица уже секционирована так
+    '''
+    current = get_partitioning(conn, schema)
+    if current == partitioning:
+        logger.info(f"{MAIN_TABLE} уже секционирована как {partitioning or 'без секций'}")
+        return False
+    backup = f"{MAIN_TABLE}_before_{partitioning or 'unpartitioned'}"
+    if backup in get_existing_tables(conn, schema, use_cache=False):
+        raise RuntimeError(
+            f"Таблица {backup} уже есть (копия от прошлой смены секционирования) - удалите ее и повторите"
+        )
+    logger.info(f"Меняем секционирование {MAIN_TABLE} на {partitioning or 'без секций'}, старая таблица - {backup}")
+    partitions = get_partitions(conn, schema)
+    try:
+        with conn.cursor() as cur:
+            # Секции старой таблицы тоже переименовываем, иначе они займут имена секций новой
+            for name in sorted(partitions):
+                cur.execute(sql.SQL("ALTER TABLE {} RENAME TO {};").format(
+                    sql.Identifier(schema, name), sql.Identifier(backup + name[len(MAIN_TABLE):])
+                ))
+            cur.execute(sql.SQL("ALTER TABLE {} RENAME TO {};").format(
+                sql.Identifier(schema, MAIN_TABLE), sql.Identifier(backup)
+            ))
+            # Имена индексов и pk должны освободиться для новой таблицы
+            cur.execute(sql.SQL("ALTER TABLE {} RENAME CONSTRAINT {} TO {};").format(
+                sql.Identifier(schema, backup), sql.Identifier(f"{MAIN_TABLE}_pkey"), sql.Identifier(f"{backup}_pkey")
+            ))
+            cur.execute(sql.SQL("DROP INDEX IF EXISTS {};").format(
+                sql.Identifier(schema, index_name(MAIN_TABLE, ["indicator_sk"]))
+            ))
+            create_main_table(cur, partitioning, schema)
+            if partitioning:
+                key_sql = sql.SQL("year / {} * {}").format(sql.Literal(PARTITION_YEARS), sql.Literal(PARTITION_YEARS)) \
+                    if partitioning == "decade" else sql.SQL("indicator_sk")
+                cur.execute(sql.SQL("SELECT DISTINCT {} FROM {};").format(key_sql, sql.Identifier(schema, backup)))
+                for key, in cur.fetchall():
+                    create_partition(cur, partitioning, key, schema)
+            fields = sql.SQL(", ").join(map(sql.Identifier, MAIN_TABLE_COLUMNS))
+            cur.execute(sql.SQL("INSERT INTO {table} ({fields}) SELECT {fields} FROM {backup};").format(
+                table=sql.Identifier(schema, MAIN_TABLE), fields=fields, backup=sql.Identifier(schema, backup)
+            ))
+            logger.info(f"Перенесено {cur.rowcount} строк из {backup}")
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        invalidate_catalog_cache(conn, schema)
+        _partitions_cache.pop((conn.dsn, schema), None)
+        _main_table_ready.discard((conn.dsn, schema))
+    return True
+
+def migrate_legacy_main_table(cur, schema = 'public'):
+    legacy = sql.Identifier(schema, f"{MAIN_TABLE}_legacy")
+    for ref_table, code_col in (("country", "country_id"), ("indicator", "indicator_id")):
+        cur.execute(sql.SQL(
+            "INSERT INTO {ref} (id) SELECT DISTINCT l.{code} FROM {legacy} AS l WHERE l.{code} IS NOT NULL "
+            "AND NOT EXISTS (SELECT 1 FROM {ref} AS t WHERE t.id = l.{code}) ON CONFLICT (id) DO NOTHING;"
+        ).format(ref=sql.Identifier(schema, ref_table), code=sql.Identifier(code_col), legacy=legacy))
+    cur.execute(sql.SQL("""
+    INSERT INTO {table} (country_sk, indicator_sk, year, value, obs_status, unit)
+    SELECT DISTINCT ON (c.sk, i.sk, l.date::text::smallint)
+        c.sk
+        , i.sk
+        , l.date::text::smallint
+        , CASE WHEN l.value::text = 'N/F' THEN NULL ELSE l.value::text::double precision END
+        , NULLIF(l.obs_status::text, 'N/F')
+        , NULLIF(l.unit::text, 'N/F')
+    FROM {legacy} AS l
+    JOIN {country} AS c ON c.id = l.country_id
+    JOIN {indicator} AS i ON i.id = l.indicator_id
+    WHERE l.date::text ~ '^[0-9]{{4}}$'
+    ORDER BY c.sk, i.sk, l.date::text::smallint, l.id DESC
+    ON CONFLICT DO NOTHING;
+    """).format(
+        table=sql.Identifier(schema, MAIN_TABLE),
+        legacy=legacy,
+        country=sql.Identifier(schema, "country"),
+        indicator=sql.Identifier(schema, "indicator")
+    ))
+    logger.info(f"Перенесено {cur.rowcount} строк из {MAIN_TABLE}_legacy")
+
+def load_main_table(conn, df, schema = 'public', method = 'copy', partitioning = None) -> pd.DataFrame:
+    '''
+    Загрузка наблюдений (результат transform) в типизированную main_table:
+    коды стран и индикаторов заменяются на суррогатные ключи, дальше тот же COPY + upsert,
+    что и в load_data, с конфликтом по (country_sk, indicator_sk, year).
+    Строки, которые не поменялись, не перезаписываются: каждая строка несет row_hash (считается в transform),
+    строки с тем же хэшем, что уже лежит в БД, отсеиваются еще до COPY (filter_unchanged),
+    а на случай гонки upsert обновляет строку только при другом row_hash.
+    Вставленные/измененные серии (country_sk, indicator_sk) в той же транзакции пишутся в журнал
+    изменений etl_change_feed, по нему витрина обновляется инкрементально (etl.mart.refresh_mart),
+    и там же пересчитываются затронутые группы предагрегатов для дашбордов (etl.rollup.update_rollups).
+    partitioning - секционирование, если main_table еще нет (существующая таблица не перестраивается).
+    Если main_table секционирована (см. ensure_main_table), недостающие секции создаются,
+    а строки пишутся сразу в свою секцию, минуя маршрутизацию через родительскую таблицу.
+    Как и в load_data, если COPY не удался (в том числе на сериализации строк), транзакция откатывается
+    и загрузка повторяется через executemany.
+    Возвращает ключи (country_sk, indicator_sk, year) вставленных/измененных строк
+    '''
+    logger.info(f"Выполняем заполнение таблицы {MAIN_TABLE} ")
+    started = time.perf_counter()
+    # etl.rollup сам импортирует etl.load, поэтому импорт здесь
+    from etl.rollup import ensure_rollup_tables
+    ensure_main_table(conn, schema, partitioning)
+    ensure_change_feed(conn, schema)
+    ensure_rollup_tables(conn, schema)
+    try:
+        changed, rows_loaded, skipped, batch_id = upsert_main_table(conn, df, schema, method)
+    except Exception as e:
+        if method != 'copy':
+            raise
+        logger.warning(f"COPY-загрузка {MAIN_TABLE} не удалась: {e}. Используем executemany")
+        changed, rows_loaded, skipped, batch_id = upsert_main_table(conn, df, schema, 'executemany')
+    logger.info(f"Таблица {MAIN_TABLE} успешно заполнена, {rows_loaded} строк, "
+                f"из них новых или измененных {len(changed)}, без изменений {rows_loaded - len(changed)} "
+                f"(отсеяно до загрузки по row_hash {skipped}) (batch {batch_id})")
+    observe("db_seconds", time.perf_counter() - started, table=MAIN_TABLE)
+    inc("rows_loaded_total", rows_loaded, table=MAIN_TABLE)
+    inc("rows_changed_total", len(changed), table=MAIN_TABLE)
+    inc("rows_unchanged_total", rows_loaded - len(changed), table=MAIN_TABLE)
+    inc("rows_skipped_by_hash_total", skipped, table=MAIN_TABLE)
+    return changed
+
+def upsert_main_table(conn, df, schema = 'public', method = 'copy') -> tuple:
+    '''
+    Запись одной загрузки в main_table, журнал изменений и предагрегаты - одна транзакция.
+    При любой ошибке (в том числе при сериализации строк для COPY, это не psycopg2.Error) транзакция откатывается
+    и исключение пробрасывается дальше. Возвращает (changed, rows_loaded, skipped, batch_id)
+    '''
+    from etl.rollup import update_rollups
+    try:
+        storage_df = to_storage_layout(conn, df, schema)
+        rows_loaded = len(storage_df)
+        current_partitioning = get_partitioning(conn, schema)
+        if current_partitioning:
+            # Секции создаем до чтения хэшей - DDL не должен ждать блокировок, взятых нашей же транзакцией
+            names = ensure_partitions(conn, current_partitioning, partition_keys(current_partitioning, storage_df),
+                                      schema)
+        storage_df = filter_unchanged(conn, storage_df, schema)
+        skipped = rows_loaded - len(storage_df)
+        targets = [(MAIN_TABLE, storage_df)]
+        if current_partitioning and not storage_df.empty:
+            keys = partition_keys(current_partitioning, storage_df)
+            targets = [(names[key], part_df) for key, part_df in storage_df.groupby(keys, sort=True)]
+        fields = sql.SQL(", ").join(sql.Identifier(col) for col in MAIN_TABLE_COLUMNS)
+        value_columns = [col for col in MAIN_TABLE_COLUMNS if col not in MAIN_TABLE_KEY]
+
+        changed_parts = []
+        for table_name, part_df in targets:
+            if part_df.empty:
+                continue
+            conflict_sql = sql.SQL("ON CONFLICT ({pk}) DO UPDATE SET {updates} "
+                                   "WHERE {table}.row_hash IS DISTINCT FROM EXCLUDED.row_hash").format(
+                pk=sql.SQL(", ").join(map(sql.Identifier, MAIN_TABLE_KEY)),
+                updates=sql.SQL(", ").join(
+                    sql.SQL("{} = EXCLUDED.{}").format(sql.Identifier(col), sql.Identifier(col))
+                    for col in value_columns
+                ),
+                table=sql.Identifier(table_name)
+            )
+            if method == 'copy':
+                rows = copy_upsert(conn, schema, table_name, part_df, MAIN_TABLE_KEY, fields, conflict_sql,
+                                   returning=MAIN_TABLE_KEY, commit=False)
+                changed_parts.append(pd.DataFrame(rows, columns=MAIN_TABLE_KEY))
+            else:
+                insert_query = sql.SQL("INSERT INTO {table} ({fields}) VALUES ({placeholders}) {conflict};").format(
+                    table=sql.Identifier(schema, table_name),
+                    fields=fields,
+                    placeholders=sql.SQL(", ").join(sql.Placeholder() for _ in MAIN_TABLE_COLUMNS),
+                    conflict=conflict_sql
+                )
+                with conn.cursor() as cur:
+                    cur.executemany(insert_query, list(part_df.astype(object).where(part_df.notna(), None).values))
+                # executemany не отдает RETURNING - считаем измененным все, что пришло
+                changed_parts.append(part_df[MAIN_TABLE_KEY])
+        if changed_parts:
+            changed = pd.concat(changed_parts, ignore_index=True)
+        else:
+            changed = pd.DataFrame({col: pd.Series(dtype=np.int64) for col in MAIN_TABLE_KEY})
+        batch_id = record_changes(conn, changed, rows_loaded, schema)
+        update_rollups(conn, changed, schema)
+        conn.commit()
+        return changed, rows_loaded, skipped, batch_id
+    except Exception:
+        conn.rollback()
+        raise
+
+def filter_unchanged(conn, storage_df, schema = 'public') -> pd.DataFrame:
+    '''
+    Отсеивает строки, у которых row_hash совпадает с уже сохраненным в main_table.
+    Из БД читаем только ключи и хэши по сериям (country_sk, indicator_sk) из загрузки - по первичному ключу,
+    это намного дешевле, чем гнать неизменившиеся строки через COPY и upsert
+    '''
+    if storage_df.empty:
+        return storage_df
+    series = storage_df[PARTITION_KEY].drop_duplicates()
+    with conn.cursor() as cur:
+        cur.execute(sql.SQL("""
+        SELECT m.country_sk, m.indicator_sk, m.year, m.row_hash
+        FROM {table} AS m
+        JOIN unnest(%s::smallint[], %s::integer[]) AS s (country_sk, indicator_sk)
+          ON m.country_sk = s.country_sk AND m.indicator_sk = s.indicator_sk
+        WHERE m.row_hash IS NOT NULL
+          -- избыточные условия, чтобы в секционированной main_table читались только нужные секции
+          AND m.indicator_sk = ANY(%s::integer[]) AND m.year BETWEEN %s AND %s;
+        """).format(table=sql.Identifier(schema, MAIN_TABLE)), [
+            series["country_sk"].astype(int).tolist(),
+            series["indicator_sk"].astype(int).tolist(),
+            series["indicator_sk"].drop_duplicates().astype(int).tolist(),
+            int(storage_df["year"].min()),
+            int(storage_df["year"].max())
+        ])
+        stored = cur.fetchall()
+    if not stored:
+        return storage_df
+    stored_df = pd.DataFrame(stored, columns=MAIN_TABLE_KEY + ["row_hash"])
+    stored_index = pd.MultiIndex.from_frame(stored_df.astype({col: np.int64 for col in stored_df.columns}))
+    incoming_index = pd.MultiIndex.from_frame(
+        storage_df[MAIN_TABLE_KEY + ["row_hash"]].astype({col: np.int64 for col in MAIN_TABLE_KEY})
+    )
+    return storage_df[~incoming_index.isin(stored_index)].reset_index(drop=True)
+
+def ensure_change_feed(conn, schema = 'public'):
+    '''
+    etl_load_batch - журнал загрузок в main_table (номер загрузки растет монотонно).
+    etl_change_feed - серии (country_sk, indicator_sk), измененные после последнего обновления витрины
+    и номер последней загрузки, которая их затронула
+    '''
+    with conn.cursor() as cur:
+        cur.execute(sql.SQL("""
+        CREATE TABLE IF NOT EXISTS {batch} (
+            batch_id SERIAL PRIMARY KEY,
+            table_name TEXT,
+            rows_loaded INTEGER,
+            rows_changed INTEGER,
+            loaded_at TIMESTAMPTZ DEFAULT now()
+        );
+        CREATE TABLE IF NOT EXISTS {feed} (
+            country_sk SMALLINT,
+            indicator_sk INTEGER,
+            batch_id INTEGER,
+            changed_at TIMESTAMPTZ DEFAULT now(),
+            PRIMARY KEY (country_sk, indicator_sk)
+        );
+        """).format(batch=sql.Identifier(schema, LOAD_BATCH_TABLE), feed=sql.Identifier(schema, CHANGE_FEED_TABLE)))
+    conn.commit()
+
+def record_changes(conn, changed, rows_loaded, schema = 'public') -> int:
+    '''
+    Записывает загрузку в журнал и затронутые ею серии в etl_change_feed. Транзакцию не закрывает -
+    журнал фиксируется вместе с самими данными
+    '''
+    partitions = changed[PARTITION_KEY].drop_duplicates()
+    with conn.cursor() as cur:
+        cur.execute(sql.SQL(
+            "INSERT INTO {} (table_name, rows_loaded, rows_changed) VALUES (%s, %s, %s) RETURNING batch_id;"
+        ).format(sql.Identifier(schema, LOAD_BATCH_TABLE)), [MAIN_TABLE, int(rows_loaded), len(changed)])
+        batch_id = cur.fetchone()[0]
+        if len(partitions):
+            cur.execute(sql.SQL("""
+            INSERT INTO {feed} (country_sk, indicator_sk, batch_id)
+            SELECT unnest(%s::smallint[]), unnest(%s::integer[]), %s
+            ON CONFLICT (country_sk, indicator_sk)
+            DO UPDATE SET batch_id = EXCLUDED.batch_id, changed_at = now();
+            """).format(feed=sql.Identifier(schema, CHANGE_FEED_TABLE)), [
+                partitions["country_sk"].astype(int).tolist(),
+                partitions["indicator_sk"].astype(int).tolist(),
+                batch_id
+            ])
+    return batch_id
 
 # def create_table(conn ,cfg:dict, key:str = None):
 #
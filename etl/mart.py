@@ -0,0 +1,298 @@
+import numpy as np
+import pandas as pd
+from psycopg2 import sql
+
+from etl.load import copy_dataframe, ensure_change_feed, CHANGE_FEED_TABLE, PARTITION_KEY
+from etl.logger import get_stage_logger
+
+logger = get_stage_logger("mart")
+
+MART_TABLE = "main_table_proc"
+# Окно волатильности - как ROWS BETWEEN 4 PRECEDING AND CURRENT ROW в vew_preaparation.sql
+VOL_WINDOW = 5
+
+# Те же соединения, что в CTE template из vew_preaparation.sql
+SOURCE_QUERY = """
+    SELECT m.country_sk
+        , m.indicator_sk
+        , c.id AS country_id
+        , c.name AS country_name
+        , i.id AS indicator_id
+        , i.name AS indicator_name
+        , m.value
+        , c.region_id
+        , r.region_value AS region_name
+        , c.income_level_id
+        , il.income_level_value AS income_level_name
+        , m.year
+    FROM public.main_table AS m
+    LEFT JOIN public.country AS c ON c.sk = m.country_sk
+    LEFT JOIN public.indicator AS i ON i.sk = m.indicator_sk
+    LEFT JOIN public.income_level AS il ON c.income_level_id = il.income_level_id
+    LEFT JOIN public.region AS r ON c.region_id = r.region_id
+"""
+
+# Расчетная часть mv_main_table_proc без справочных соединений - эталон для сверки с compute_mart
+SQL_REFERENCE_QUERY = """
+    WITH interpolation_preparation AS (
+      SELECT country_sk, indicator_sk, year, value
+        , LAST_VALUE(CASE WHEN value IS NOT NULL THEN value END) OVER search_prev_notnull AS prev_value
+        , LAST_VALUE(CASE WHEN value IS NOT NULL THEN year END) OVER search_prev_notnull AS prev_year
+        , FIRST_VALUE(CASE WHEN value IS NOT NULL THEN value END) OVER search_next_notnull AS next_value
+        , FIRST_VALUE(CASE WHEN value IS NOT NULL THEN year END) OVER search_next_notnull AS next_year
+      FROM public.main_table
+      WINDOW search_prev_notnull AS (
+        PARTITION BY country_sk, indicator_sk ORDER BY year
+        ROWS BETWEEN UNBOUNDED PRECEDING AND 1 PRECEDING
+      ),
+      search_next_notnull AS (
+        PARTITION BY country_sk, indicator_sk ORDER BY year
+        ROWS BETWEEN 1 FOLLOWING AND UNBOUNDED FOLLOWING
+      )
+    ),
+    template_interpolation AS (
+      SELECT *
+        , CASE
+          WHEN value IS NOT NULL THEN value
+          WHEN prev_value IS NOT NULL AND next_value IS NOT NULL AND next_year > prev_year
+          THEN prev_value + (next_value - prev_value) * (year - prev_year) / (next_year - prev_year)
+          ELSE NULL
+        END AS value_filled
+      FROM interpolation_preparation
+    )
+    SELECT *
+      , value_filled - LAG(value_filled) OVER search_next AS del_val
+      , (value_filled - LAG(value_filled) OVER search_next) / NULLIF(LAG(value_filled) OVER search_next, 0) AS prcnt_del
+      , STDDEV(value) OVER (
+        PARTITION BY country_sk, indicator_sk ORDER BY year
+        ROWS BETWEEN 4 PRECEDING AND CURRENT ROW
+      ) AS vol_5
+    FROM template_interpolation
+    WINDOW search_next AS (PARTITION BY country_sk, indicator_sk ORDER BY year)
+"""
+
+MART_COLUMNS = [
+    ("country_sk", "SMALLINT"), ("indicator_sk", "INTEGER"),
+    ("country_id", "TEXT"), ("country_name", "TEXT"),
+    ("indicator_id", "TEXT"), ("indicator_name", "TEXT"),
+    ("value", "DOUBLE PRECISION"),
+    ("region_id", "TEXT"), ("region_name", "TEXT"),
+    ("income_level_id", "TEXT"), ("income_level_name", "TEXT"),
+    ("year", "SMALLINT"), ("year_dt", "DATE"), ("decade", "SMALLINT"),
+    ("prev_value", "DOUBLE PRECISION"), ("prev_year", "SMALLINT"),
+    ("next_value", "DOUBLE PRECISION"), ("next_year", "SMALLINT"),
+    ("value_filled", "DOUBLE PRECISION"), ("del_val", "DOUBLE PRECISION"),
+    ("prcnt_del", "DOUBLE PRECISION"), ("vol_5", "DOUBLE PRECISION"),
+]
+CHECK_COLUMNS = ["prev_value", "prev_year", "next_value", "next_year", "value_filled", "del_val", "prcnt_del", "vol_5"]
+
+def compute_mart(df: pd.DataFrame) -> pd.DataFrame:
+    '''
+    То же, что mv_main_table_proc, но векторно в NumPy. Все серии (страна, индикатор) лежат подряд
+    в одном отсортированном массиве, границы серий учитываются через индекс начала/конца серии:
+    - prev/next - значения соседних строк серии (как LAST_VALUE/FIRST_VALUE в SQL-версии)
+    - value_filled - линейная интерполяция между ними
+    - del_val, prcnt_del - изменение к предыдущей строке серии (LAG)
+    - vol_5 - выборочное СКО value по последним 5 строкам серии (STDDEV, NULL если значений меньше двух)
+    '''
+    df = df.sort_values(PARTITION_KEY + ["year"], kind="stable").reset_index(drop=True)
+    n = len(df)
+    idx = np.arange(n)
+    value = df["value"].to_numpy(dtype=np.float64)
+    year = df["year"].to_numpy(dtype=np.float64)
+    country = df["country_sk"].to_numpy()
+    indicator = df["indicator_sk"].to_numpy()
+
+    new_group = np.ones(n, dtype=bool)
+    new_group[1:] = (country[1:] != country[:-1]) | (indicator[1:] != indicator[:-1])
+    group_start = np.maximum.accumulate(np.where(new_group, idx, 0))
+    last_in_group = np.ones(n, dtype=bool)
+    last_in_group[:-1] = new_group[1:]
+
+    notnull = ~np.isnan(value)
+    # LAST_VALUE/FIRST_VALUE в SQL-версии без IGNORE NULLS берут значение соседней строки (рамка кончается
+    # на 1 PRECEDING / начинается с 1 FOLLOWING), поэтому prev/next - это просто соседние строки серии,
+    # а год соседа известен только если его значение не пустое. Пропуски длиннее одной строки остаются NULL
+    has_prev = ~new_group
+    has_prev[has_prev] = notnull[idx[has_prev] - 1]
+    has_next = ~last_in_group
+    has_next[has_next] = notnull[idx[has_next] + 1]
+    prev_value = np.full(n, np.nan)
+    prev_year = np.full(n, np.nan)
+    next_value = np.full(n, np.nan)
+    next_year = np.full(n, np.nan)
+    prev_value[has_prev] = value[idx[has_prev] - 1]
+    prev_year[has_prev] = year[idx[has_prev] - 1]
+    next_value[has_next] = value[idx[has_next] + 1]
+    next_year[has_next] = year[idx[has_next] + 1]
+
+    can_fill = ~notnull & has_prev & has_next & (next_year > prev_year)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        interpolated = prev_value + (next_value - prev_value) * (year - prev_year) / (next_year - prev_year)
+    value_filled = np.where(notnull, value, np.where(can_fill, interpolated, np.nan))
+
+    lag_filled = np.concatenate(([np.nan], value_filled[:-1]))
+    lag_filled[new_group] = np.nan
+    del_val = value_filled - lag_filled
+    with np.errstate(invalid="ignore", divide="ignore"):
+        prcnt_del = np.where(lag_filled != 0, del_val / lag_filled, np.nan)
+
+    # Окно из VOL_WINDOW строк назад: матрица n x 5 со сдвинутыми значениями, вне серии - NaN
+    window = np.full((n, VOL_WINDOW), np.nan)
+    for lag in range(VOL_WINDOW):
+        shifted = idx - lag
+        inside = shifted >= group_start
+        window[inside, lag] = value[shifted[inside]]
+    counts = np.sum(~np.isnan(window), axis=1)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        mean = np.nansum(window, axis=1) / counts
+        squares = np.nansum((window - mean[:, None]) ** 2, axis=1)
+        vol_5 = np.where(counts >= 2, np.sqrt(squares / (counts - 1)), np.nan)
+
+    df["year_dt"] = pd.to_datetime(df["year"].astype(int).astype(str) + "-01-01").dt.date
+    df["decade"] = (df["year"].astype(int) // 10) * 10
+    df["prev_value"] = prev_value
+    df["prev_year"] = pd.array(prev_year, dtype="Int16")
+    df["next_value"] = next_value
+    df["next_year"] = pd.array(next_year, dtype="Int16")
+    df["value_filled"] = value_filled
+    df["del_val"] = del_val
+    df["prcnt_del"] = prcnt_del
+    df["vol_5"] = vol_5
+    return df[[col for col, _ in MART_COLUMNS]]
+
+def series_arrays(series: pd.DataFrame) -> list:
+    '''Столбцы серий (country_sk, indicator_sk) как списки для unnest(%s::smallint[], %s::integer[])'''
+    return [series["country_sk"].astype(int).tolist(), series["indicator_sk"].astype(int).tolist()]
+
+def read_mart_source(conn, series: pd.DataFrame | None = None) -> pd.DataFrame:
+    '''
+    Исходные строки для витрины. Если заданы series (столбцы country_sk, indicator_sk) - только эти серии
+    (серии пересчитываются целиком, окна не выходят за пределы серии)
+    '''
+    query = sql.SQL(SOURCE_QUERY)
+    params = []
+    if series is not None:
+        query = query + sql.SQL(
+            " WHERE (m.country_sk, m.indicator_sk) IN (SELECT * FROM unnest(%s::smallint[], %s::integer[]))"
+        )
+        params = series_arrays(series)
+    with conn.cursor() as cur:
+        cur.execute(query, params)
+        columns = [desc[0] for desc in cur.description]
+        df = pd.DataFrame(cur.fetchall(), columns=columns)
+    df["value"] = pd.to_numeric(df["value"], errors="coerce").astype(np.float64)
+    logger.info(f"Из main_table прочитано {len(df)} строк")
+    return df
+
+def ensure_mart_table(conn, schema = 'public'):
+    columns = sql.SQL(", ").join(
+        sql.SQL("{} {}").format(sql.Identifier(col), sql.SQL(pg_type)) for col, pg_type in MART_COLUMNS
+    )
+    with conn.cursor() as cur:
+        cur.execute(sql.SQL("CREATE TABLE IF NOT EXISTS {table} ({columns}, PRIMARY KEY ({pk}));").format(
+            table=sql.Identifier(schema, MART_TABLE),
+            columns=columns,
+            pk=sql.SQL(", ").join(map(sql.Identifier, PARTITION_KEY + ["year"]))
+        ))
+    conn.commit()
+
+def lock_change_feed(conn, schema = 'public') -> pd.DataFrame:
+    '''
+    Серии из журнала изменений, ожидающие пересчета, - (country_sk, indicator_sk, batch_id).
+    Строки журнала берутся SELECT ... FOR UPDATE и остаются заблокированными до конца транзакции, в которой
+    витрина обновляется: загрузка, которая в это время снова меняет ту же серию, ждет на своем upsert в журнал
+    и после нашего коммита запишет серию заново. Новые серии, закоммиченные после этого чтения, в набор
+    не попадают и остаются в журнале до следующего обновления
+    '''
+    ensure_change_feed(conn, schema)
+    with conn.cursor() as cur:
+        cur.execute(sql.SQL("SELECT country_sk, indicator_sk, batch_id FROM {} FOR UPDATE;").format(
+            sql.Identifier(schema, CHANGE_FEED_TABLE)
+        ))
+        return pd.DataFrame(cur.fetchall(), columns=PARTITION_KEY + ["batch_id"])
+
+def consume_change_feed(cur, consumed: pd.DataFrame | None, schema = 'public'):
+    '''Удаляет из журнала ровно прочитанные строки consumed (из lock_change_feed), а не все до номера загрузки'''
+    if consumed is None or consumed.empty:
+        return
+    cur.execute(sql.SQL("""
+    DELETE FROM {feed} AS f
+    USING unnest(%s::smallint[], %s::integer[], %s::integer[]) AS c(country_sk, indicator_sk, batch_id)
+    WHERE f.country_sk = c.country_sk AND f.indicator_sk = c.indicator_sk AND f.batch_id = c.batch_id;
+    """).format(feed=sql.Identifier(schema, CHANGE_FEED_TABLE)),
+        series_arrays(consumed) + [consumed["batch_id"].astype(int).tolist()])
+
+def load_mart(conn, mart_df: pd.DataFrame, schema = 'public', consumed: pd.DataFrame | None = None):
+    '''
+    Полная перезаливка витрины одной транзакцией: TRUNCATE + COPY, читатели видят либо старую, либо новую версию.
+    consumed - строки журнала изменений (lock_change_feed), уже учтенные в mart_df, они удаляются из журнала
+    '''
+    ensure_mart_table(conn, schema)
+    fields = sql.SQL(", ").join(sql.Identifier(col) for col, _ in MART_COLUMNS)
+    with conn.cursor() as cur:
+        cur.execute(sql.SQL("TRUNCATE {};").format(sql.Identifier(schema, MART_TABLE)))
+        copy_dataframe(cur, sql.Identifier(schema, MART_TABLE), mart_df, fields)
+        consume_change_feed(cur, consumed, schema)
+    conn.commit()
+    logger.info(f"Витрина {MART_TABLE} перезаписана, {len(mart_df)} строк")
+
+def refresh_mart(conn, schema = 'public') -> int:
+    '''
+    Инкрементальное обновление витрины по журналу изменений etl_change_feed: пересчитываем только серии
+    (country_sk, indicator_sk), которые менялись после прошлого обновления, и подменяем их в витрине
+    одной транзакцией (DELETE серий + COPY новых строк + удаление из журнала ровно тех строк, что были прочитаны).
+    Строки журнала заблокированы на всю транзакцию (lock_change_feed), поэтому параллельная загрузка
+    не потеряет свои изменения. Пустая витрина собирается целиком. Возвращает число пересчитанных строк
+    '''
+    ensure_mart_table(conn, schema)
+    with conn.cursor() as cur:
+        cur.execute(sql.SQL("SELECT EXISTS (SELECT 1 FROM {});").format(sql.Identifier(schema, MART_TABLE)))
+        mart_is_empty = not cur.fetchone()[0]
+    consumed = lock_change_feed(conn, schema)
+    if mart_is_empty:
+        logger.info(f"Витрина {MART_TABLE} пустая - собираем целиком")
+        mart_df = compute_mart(read_mart_source(conn))
+        load_mart(conn, mart_df, schema, consumed)
+        return len(mart_df)
+    if consumed.empty:
+        conn.rollback()
+        logger.info("Изменений после прошлого обновления витрины нет")
+        return 0
+
+    mart_df = compute_mart(read_mart_source(conn, consumed))
+    fields = sql.SQL(", ").join(sql.Identifier(col) for col, _ in MART_COLUMNS)
+    with conn.cursor() as cur:
+        cur.execute(sql.SQL("""
+        DELETE FROM {mart} AS m
+        USING unnest(%s::smallint[], %s::integer[]) AS f(country_sk, indicator_sk)
+        WHERE m.country_sk = f.country_sk AND m.indicator_sk = f.indicator_sk;
+        """).format(mart=sql.Identifier(schema, MART_TABLE)), series_arrays(consumed))
+        copy_dataframe(cur, sql.Identifier(schema, MART_TABLE), mart_df, fields)
+        consume_change_feed(cur, consumed, schema)
+    conn.commit()
+    logger.info(f"Витрина {MART_TABLE} обновлена: {len(consumed)} серий, {len(mart_df)} строк")
+    return len(mart_df)
+
+def check_mart_parity(conn, mart_df: pd.DataFrame, rtol: float = 1e-9) -> bool:
+    '''
+    Сверка расчета в NumPy с тем же расчетом в SQL (оконные функции из vew_preaparation.sql) на текущих данных.
+    Возвращает True, если все расчетные столбцы совпадают (NULL = NaN), расхождения пишет в лог
+    '''
+    with conn.cursor() as cur:
+        cur.execute(SQL_REFERENCE_QUERY)
+        columns = [desc[0] for desc in cur.description]
+        sql_df = pd.DataFrame(cur.fetchall(), columns=columns)
+    merged = mart_df.merge(sql_df, on=PARTITION_KEY + ["year"], how="outer", suffixes=("", "_sql"), indicator=True)
+    ok = bool((merged["_merge"] == "both").all())
+    if not ok:
+        logger.info(f"Наборы строк различаются: {int((merged['_merge'] != 'both').sum())} строк без пары")
+    for col in CHECK_COLUMNS:
+        py_values = pd.to_numeric(merged[col], errors="coerce").to_numpy(dtype=np.float64)
+        sql_values = pd.to_numeric(merged[f"{col}_sql"], errors="coerce").to_numpy(dtype=np.float64)
+        same = np.isclose(py_values, sql_values, rtol=rtol, atol=0, equal_nan=True)
+        if not same.all():
+            ok = False
+            logger.info(f"Столбец {col}: {int((~same).sum())} расхождений с SQL")
+    logger.info(f"Сверка витрины с SQL-версией: {'совпадает' if ok else 'ЕСТЬ РАСХОЖДЕНИЯ'}")
+    return ok
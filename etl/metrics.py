@@ -0,0 +1,159 @@
+import json
+import os
+import threading
+import time
+from bisect import bisect_left
+from contextlib import contextmanager
+
+from etl.logger import get_stage_logger
+from etl.profiling import profile_stage, profiling_enabled
+
+logger = get_stage_logger("pipline")
+
+METRICS_DIR = "logs"
+PROM_FILE = "etl_metrics.prom"
+JSON_FILE = "etl_metrics.json"
+PREFIX = "wb_etl_"
+# Границы корзин гистограмм (секунды) - от быстрых ответов из кэша до долгих запросов к API и БД
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+_lock = threading.Lock()
+_counters = {}
+_histograms = {}
+_started_at = time.time()
+
+def _key(name: str, labels: dict) -> tuple:
+    return name, tuple(sorted(labels.items()))
+
+def inc(name: str, value: float = 1, **labels):
+    '''Счетчик: inc("requests_total", outcome="ok")'''
+    key = _key(name, labels)
+    with _lock:
+        _counters[key] = _counters.get(key, 0) + value
+
+def observe(name: str, value: float, **labels):
+    '''Наблюдение в гистограмму (обычно длительность в секундах)'''
+    key = _key(name, labels)
+    with _lock:
+        hist = _histograms.get(key)
+        if hist is None:
+            hist = _histograms[key] = {"buckets": [0] * (len(BUCKETS) + 1), "sum": 0.0, "count": 0}
+        hist["buckets"][bisect_left(BUCKETS, value)] += 1
+        hist["sum"] += value
+        hist["count"] += 1
+
+@contextmanager
+def timed(name: str, **labels):
+    '''Замер длительности блока в гистограмму name'''
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        observe(name, time.perf_counter() - started, **labels)
+
+def stage(stage_name: str):
+    '''
+    Длительность этапа пайплайна: with stage("extract"): ...
+    При включенном профилировании (etl/profiling.py) этап еще и профилируется
+    '''
+    if profiling_enabled():
+        return profiled_stage(stage_name)
+    return timed("stage_seconds", stage=stage_name)
+
+@contextmanager
+def profiled_stage(stage_name: str):
+    with timed("stage_seconds", stage=stage_name), profile_stage(stage_name):
+        yield
+
+def reset_metrics():
+    global _started_at
+    with _lock:
+        _counters.clear()
+        _histograms.clear()
+        _started_at = time.time()
+
+def get_counter(name: str, **labels) -> float:
+    with _lock:
+        return _counters.get(_key(name, labels), 0)
+
+def _stage_seconds() -> dict:
+    return {dict(labels)["stage"]: hist["sum"] for (name, labels), hist in _histograms.items()
+            if name == "stage_seconds"}
+
+def metrics_summary() -> dict:
+    '''
+    Сводка за запуск: счетчики, гистограммы и производные показатели (страниц в секунду на этапе extract)
+    '''
+    with _lock:
+        counters = [{"name": name, "labels": dict(labels), "value": value}
+                    for (name, labels), value in sorted(_counters.items())]
+        histograms = [{"name": name, "labels": dict(labels), "count": hist["count"], "sum": round(hist["sum"], 6),
+                       "buckets": dict(zip([*map(str, BUCKETS), "+Inf"], hist["buckets"]))}
+                      for (name, labels), hist in sorted(_histograms.items())]
+        stages = _stage_seconds()
+        totals = {}
+        for (name, _), value in _counters.items():
+            totals[name] = totals.get(name, 0) + value
+    derived = {}
+    if stages.get("extract"):
+        derived["pages_per_sec"] = round(totals.get("pages_total", 0) / stages["extract"], 3)
+    return {
+        "started_at": _started_at,
+        "finished_at": time.time(),
+        "stages": {name: round(seconds, 6) for name, seconds in stages.items()},
+        "derived": derived,
+        "counters": counters,
+        "histograms": histograms
+    }
+
+def _prom_labels(labels: dict, extra: dict | None = None) -> str:
+    items = {**labels, **(extra or {})}
+    if not items:
+        return ""
+    body = ",".join(f'{k}="{str(v)}"' for k, v in items.items())
+    return "{" + body + "}"
+
+def to_prometheus(summary: dict) -> str:
+    '''Формат textfile collector node_exporter'''
+    lines = []
+    typed = set()
+    for counter in summary["counters"]:
+        name = PREFIX + counter["name"]
+        if name not in typed:
+            lines.append(f"# TYPE {name} counter")
+            typed.add(name)
+        lines.append(f"{name}{_prom_labels(counter['labels'])} {counter['value']}")
+    for hist in summary["histograms"]:
+        name = PREFIX + hist["name"]
+        if name not in typed:
+            lines.append(f"# TYPE {name} histogram")
+            typed.add(name)
+        cumulative = 0
+        for bound, count in hist["buckets"].items():
+            cumulative += count
+            lines.append(f"{name}_bucket{_prom_labels(hist['labels'], {'le': bound})} {cumulative}")
+        lines.append(f"{name}_sum{_prom_labels(hist['labels'])} {hist['sum']}")
+        lines.append(f"{name}_count{_prom_labels(hist['labels'])} {hist['count']}")
+    for name, value in summary["derived"].items():
+        lines.append(f"# TYPE {PREFIX}{name} gauge")
+        lines.append(f"{PREFIX}{name} {value}")
+    lines.append(f"# TYPE {PREFIX}last_run_timestamp_seconds gauge")
+    lines.append(f"{PREFIX}last_run_timestamp_seconds {summary['finished_at']:.0f}")
+    return "\n".join(lines) + "\n"
+
+def write_metrics(out_dir: str = METRICS_DIR) -> dict:
+    '''
+    В конце запуска пишет сводку в out_dir: etl_metrics.json и etl_metrics.prom (для textfile collector).
+    Файлы подменяются атомарно, чтобы коллектор не прочитал недописанный файл
+    '''
+    summary = metrics_summary()
+    os.makedirs(out_dir, exist_ok=True)
+    for file_name, text in ((JSON_FILE, json.dumps(summary, ensure_ascii=False, indent=4)),
+                            (PROM_FILE, to_prometheus(summary))):
+        path = os.path.join(out_dir, file_name)
+        with open(path + ".tmp", "w", encoding="utf-8") as f:
+            f.write(text)
+        os.replace(path + ".tmp", path)
+    stages = ", ".join(f"{name} {seconds:.2f} сек" for name, seconds in summary["stages"].items())
+    logger.info(f"Метрики записаны в {out_dir}: {stages}; {summary['derived']}")
+    return summary
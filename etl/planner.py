@@ -0,0 +1,280 @@
+'''
+Планировщик запросов к API: из конфига строит список запросов (processed_cfg для get_paginated_data)
+с минимумом обращений к API:
+- коды стран проверяются, некорректные (например ISO2 "RU" вместо "RUS") отбрасываются
+- индикаторы одного источника (source) объединяются в один запрос, до MAX_INDICATORS_PER_REQUEST штук;
+  источники берутся из файла в cache_dir, затем из справочника indicator в БД, и только если пробные
+  запросы к API окупаются в этом же плане - из API
+- длинные списки стран режутся на куски, чтобы URL не превысил лимит API
+- per_page подбирается по оценке числа строк: большой ответ делится примерно на workers страниц, которые
+  качаются параллельно, маленький приходит одной страницей
+Пробный запуск без скачивания данных: python -m etl.planner configs/config.json configs/default_config.json
+(источники индикаторов только из файла; --lookup-sources - как при запуске, с БД и API)
+'''
+
+import json
+import math
+import os
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+from copy import deepcopy
+
+from etl.api import process_cfg_for_api, safe_request
+from etl.config import COUNTRY_CODE_RE, load_cfg, validate_cfg
+from etl.logger import get_stage_logger
+from etl.watermark import get_year_range
+
+logger = get_stage_logger("extract")
+
+# Ограничения API: индикаторов в одном запросе (только в пределах одного source) и разумная длина списка стран
+MAX_INDICATORS_PER_REQUEST = 60
+MAX_COUNTRIES_PER_REQUEST = 100
+# Больше строк на страницу API отдает неохотно (долгий ответ, таймауты)
+MAX_PER_PAGE = 10000
+# Стран и агрегатов у WB около 270 - для оценки запросов с countries = ["all"]
+ALL_COUNTRIES_ESTIMATE = 270
+# Источник индикатора у WB практически не меняется - найденные источники храним на диске подолгу
+SOURCES_FILE = "indicator_sources.json"
+SOURCES_TTL = 30 * 24 * 3600
+
+def clean_countries(countries: list) -> list:
+    '''Отбрасывает некорректные коды стран и дубли, порядок сохраняется'''
+    if countries == ["all"]:
+        return countries
+    valid = []
+    for code in countries:
+        if not COUNTRY_CODE_RE.match(code):
+            logger.warning(f"Некорректный код страны {code!r} (нужен 3-символьный код, например RUS) - пропускаем")
+            continue
+        if code not in valid:
+            valid.append(code)
+    return valid
+
+def load_known_sources(raw_cfg: dict) -> dict:
+    '''{индикатор: source id} из файла в cache_dir, записи старше SOURCES_TTL не берем'''
+    try:
+        with open(os.path.join(raw_cfg["cache_dir"], SOURCES_FILE), encoding="utf-8") as f:
+            known = json.load(f)
+    except (OSError, json.JSONDecodeError):
+        return {}
+    now = time.time()
+    return {indicator: source for indicator, (source, saved_at) in known.items() if now - saved_at <= SOURCES_TTL}
+
+def save_known_sources(raw_cfg: dict, sources: dict):
+    path = os.path.join(raw_cfg["cache_dir"], SOURCES_FILE)
+    try:
+        with open(path, encoding="utf-8") as f:
+            known = json.load(f)
+    except (OSError, json.JSONDecodeError):
+        known = {}
+    now = time.time()
+    known.update({indicator: [source, now] for indicator, source in sources.items()})
+    os.makedirs(raw_cfg["cache_dir"], exist_ok=True)
+    with open(f"{path}.tmp", "w", encoding="utf-8") as f:
+        json.dump(known, f, ensure_ascii=False)
+    os.replace(f"{path}.tmp", path)
+
+def read_reference_sources(raw_cfg: dict, indicators: list) -> dict:
+    '''
+    source_id из справочника indicator в БД (его заполняет python main.py refs).
+    Нет БД или справочника - пустой словарь, без ретраев подключения
+    '''
+    import psycopg2
+    from etl.load import bd_connection
+    try:
+        with bd_connection(dict(raw_cfg, db_retries=1)) as conn, conn.cursor() as cur:
+            cur.execute("SELECT id, source_id FROM indicator WHERE id = ANY(%s);", [indicators])
+            return {indicator: source for indicator, source in cur.fetchall() if source not in (None, "N/F")}
+    except psycopg2.Error as e:
+        logger.info(f"Источники индикаторов из справочника indicator недоступны: {e}")
+        return {}
+
+def probes_pay_off(n_unknown: int, requests_per_indicator: int) -> bool:
+    '''
+    Окупаются ли пробные запросы в этом плане: без них каждый индикатор - requests_per_indicator запросов,
+    с ними - по одному пробному на индикатор плюс в лучшем случае общие запросы на всю группу
+    '''
+    batched = math.ceil(n_unknown / MAX_INDICATORS_PER_REQUEST) * requests_per_indicator
+    return n_unknown + batched < n_unknown * requests_per_indicator
+
+def probe_indicator_sources(raw_cfg: dict, indicators: list) -> dict:
+    '''Источники из метаданных API /indicator/{код}, по запросу на индикатор'''
+    def probe(indicator):
+        probe_cfg = process_cfg_for_api(dict(raw_cfg, countries=[], indicators=[indicator]))
+        probe_cfg["url"] += indicator
+        probe_cfg["params"].pop("date")
+        probe_cfg["params"]["per_page"] = 1
+        try:
+            _, data_list = safe_request(probe_cfg)
+            return (data_list[0].get("source") or {}).get("id") if data_list else None
+        except RuntimeError:
+            return None
+
+    with ThreadPoolExecutor(max_workers=max(1, min(raw_cfg["indicator_workers"], len(indicators)))) as executor:
+        return {indicator: source for indicator, source in zip(indicators, executor.map(probe, indicators))
+                if source is not None}
+
+def get_indicator_sources(raw_cfg: dict, indicators: list, requests_per_indicator: int = 1,
+                          cache_only: bool = False) -> dict:
+    '''
+    Источник (source id) индикаторов: файл SOURCES_FILE в cache_dir -> справочник indicator в БД ->
+    пробные запросы к API, если они окупаются (probes_pay_off). Найденное в БД и API дописывается в файл.
+    cache_only - только файл, без подключения к БД и запросов к API.
+    Индикатор с неизвестным источником пойдет отдельным запросом
+    '''
+    known = load_known_sources(raw_cfg)
+    sources = {indicator: known[indicator] for indicator in indicators if indicator in known}
+    found = {}
+    missing = [indicator for indicator in indicators if indicator not in sources]
+    if missing and cache_only:
+        logger.info(f"Источник {len(missing)} индикаторов не найден в {SOURCES_FILE} - "
+                    f"в плане эти индикаторы идут отдельными запросами")
+        return sources
+    if missing:
+        found.update(read_reference_sources(raw_cfg, missing))
+        missing = [indicator for indicator in missing if indicator not in found]
+    if missing and probes_pay_off(len(missing), requests_per_indicator):
+        found.update(probe_indicator_sources(raw_cfg, missing))
+    elif missing:
+        logger.info(f"Источник {len(missing)} индикаторов неизвестен, пробные запросы не окупятся - "
+                    f"эти индикаторы пойдут отдельными запросами")
+    if found:
+        save_known_sources(raw_cfg, found)
+    sources.update(found)
+    return sources
+
+def interval_years(date_interval: list) -> set:
+    '''Множество лет из валидированного date_interval ([] - все годы)'''
+    years = set()
+    for item in date_interval or [None]:
+        first, last = get_year_range([item] if item else [])
+        years.update(range(first, last + 1))
+    return years
+
+def choose_per_page(estimated_rows: int | None, per_page: int, workers: int = 1) -> int:
+    '''
+    Размер страницы под ожидаемый объем: ответ делится примерно на workers страниц - их get_paginated_data
+    качает параллельно, а одна огромная страница шла бы в один поток. Не больше MAX_PER_PAGE
+    и не меньше per_page из конфига, поэтому небольшие ответы по-прежнему приходят одной страницей.
+    Округляем до сотен, чтобы ключи кэша/контрольных точек были стабильными
+    '''
+    if estimated_rows is None:
+        return per_page
+    return max(per_page, min(MAX_PER_PAGE, math.ceil(estimated_rows / max(1, workers) / 100) * 100))
+
+def chunks(items: list, size: int) -> list[list]:
+    return [items[i:i + size] for i in range(0, len(items), size)] or [[]]
+
+def plan_requests(raw_cfg: dict, sources: dict | None = None, cache_only: bool = False) -> list[dict]:
+    '''
+    План запросов по одному конфигу. Каждый пункт плана:
+    {"countries", "indicators", "source", "date_interval", "per_page", "estimated_rows", "pages"}
+    sources - {индикатор: source id}, если не передан - узнаем через get_indicator_sources
+    (только если индикаторов больше одного, иначе объединять нечего), cache_only передается туда же
+    '''
+    countries = clean_countries(raw_cfg["countries"])
+    indicators = raw_cfg["indicators"]
+    if raw_cfg["countries"] and not countries:
+        logger.info("После проверки кодов стран не осталось ни одной страны")
+        return []
+
+    # Справочные выгрузки (/country/all, /indicator/all) и запросы без разреза - один запрос как есть
+    if not countries or not indicators or indicators == ["all"]:
+        return [{
+            "countries": countries,
+            "indicators": indicators,
+            "source": None,
+            "date_interval": raw_cfg["date_interval"],
+            "per_page": raw_cfg["per_page"],
+            "estimated_rows": None,
+            "pages": None
+        }]
+
+    if sources is None and len(indicators) > 1:
+        n_country_chunks = 1 if countries == ["all"] else len(chunks(countries, MAX_COUNTRIES_PER_REQUEST))
+        sources = get_indicator_sources(raw_cfg, indicators, n_country_chunks, cache_only)
+    sources = sources or {}
+    groups = {}
+    for indicator in indicators:
+        source = sources.get(indicator)
+        # Без известного источника объединять нельзя - API требует source для нескольких индикаторов
+        groups.setdefault(source if source is not None else ("single", indicator), []).append(indicator)
+
+    n_years = len(interval_years(raw_cfg["date_interval"]))
+    plan = []
+    for source, group in groups.items():
+        for indicator_chunk in chunks(group, MAX_INDICATORS_PER_REQUEST):
+            country_chunks = [countries] if countries == ["all"] else chunks(countries, MAX_COUNTRIES_PER_REQUEST)
+            for country_chunk in country_chunks:
+                n_countries = ALL_COUNTRIES_ESTIMATE if country_chunk == ["all"] else len(country_chunk)
+                estimated_rows = n_countries * len(indicator_chunk) * n_years
+                per_page = choose_per_page(estimated_rows, raw_cfg["per_page"], raw_cfg["workers"])
+                plan.append({
+                    "countries": country_chunk,
+                    "indicators": indicator_chunk,
+                    "source": source if len(indicator_chunk) > 1 else None,
+                    "date_interval": raw_cfg["date_interval"],
+                    "per_page": per_page,
+                    "estimated_rows": estimated_rows,
+                    "pages": math.ceil(estimated_rows / per_page)
+                })
+    return plan
+
+def to_request_cfg(raw_cfg: dict, item: dict) -> dict:
+    '''Пункт плана -> processed_cfg с готовым url, который можно отдать в get_paginated_data'''
+    item_cfg = deepcopy(raw_cfg)
+    item_cfg["countries"] = item["countries"]
+    item_cfg["indicators"] = item["indicators"]
+    item_cfg["per_page"] = item["per_page"]
+    processed_cfg = process_cfg_for_api(item_cfg)
+    if item["indicators"]:
+        processed_cfg["url"] += ";".join(item["indicators"])
+    if item["source"] is not None:
+        processed_cfg["params"]["source"] = item["source"]
+    return processed_cfg
+
+def build_request_cfgs(raw_cfg: dict) -> list[dict]:
+    plan = plan_requests(raw_cfg)
+    log_plan(plan)
+    return [to_request_cfg(raw_cfg, item) for item in plan]
+
+def log_plan(plan: list[dict]):
+    pages = [item["pages"] for item in plan if item["pages"] is not None]
+    logger.info(f"План: {len(plan)} запросов, ожидаемо страниц {sum(pages) if pages else '?'}")
+
+def format_plan(plan: list[dict]) -> list[str]:
+    lines = []
+    for item in plan:
+        countries = ";".join(item["countries"]) if len(item["countries"]) <= 5 else f"{len(item['countries'])} стран"
+        lines.append(
+            f"  countries={countries or '-'} indicators={';'.join(item['indicators']) or '-'} "
+            f"source={item['source'] or '-'} date={','.join(item['date_interval']) or 'all'} "
+            f"per_page={item['per_page']} rows~{item['estimated_rows'] or '?'} pages~{item['pages'] or '?'}"
+        )
+    return lines
+
+def dry_run(paths: list[str], lookup_sources: bool = False) -> dict:
+    '''
+    Пробный запуск планировщика по нескольким конфигам: печатает запросы каждого конфига и итоговые числа.
+    Конфиги планируются и запускаются независимо, повторы между ними не убираются.
+    По умолчанию источники индикаторов берутся только из файла в cache_dir - ни БД, ни API не нужны,
+    поэтому в плане может быть больше запросов, чем в реальном запуске. lookup_sources - искать неизвестные
+    источники как при запуске (справочник indicator в БД, пробные запросы метаданных к API)
+    '''
+    cfgs = [validate_cfg(load_cfg(path)) for path in paths]
+    plans = [plan_requests(cfg, cache_only=not lookup_sources) for cfg in cfgs]
+    for path, plan in zip(paths, plans):
+        print(f"{path}: запросов {len(plan)}")
+        for line in format_plan(plan):
+            print(line)
+    items = [item for plan in plans for item in plan]
+    known_pages = [item["pages"] for item in items if item["pages"] is not None]
+    unknown = len(items) - len(known_pages)
+    print(f"Итого: запросов {len(items)}, страниц ~{sum(known_pages) + unknown}"
+          + (f" ({unknown} запросов с неизвестным объемом посчитаны как 1 страница)" if unknown else ""))
+    return {"requests": len(items), "pages": sum(known_pages) + unknown}
+
+if __name__ == "__main__":
+    dry_run([arg for arg in sys.argv[1:] if arg != "--lookup-sources"] or ["configs/config.json"],
+            lookup_sources="--lookup-sources" in sys.argv[1:])
@@ -0,0 +1,212 @@
+'''
+Профилирование этапов пайплайна по запросу: python main.py run --profile (или refs --profile).
+Каждый этап (with stage(...) из etl.metrics) выполняется под cProfile и tracemalloc, в конце запуска в logs/ пишутся
+    profile_{запуск}_{этап}.collapsed  - стеки в формате collapsed (flamegraph.pl, speedscope), значения в микросекундах
+    profile_{запуск}_{этап}.pstats.txt - функции с наибольшим cumulative временем
+    profile_{запуск}_{этап}.alloc.txt  - пик памяти, стеки выделений около пика и чистый прирост памяти за этап
+Если этап выполняется несколько раз (потоковый режим), результаты суммируются.
+Выключенное профилирование - одна проверка флага на этап.
+cProfile видит только поток, в котором запущен пайплайн: работа потоков выгрузки страниц видна как ожидание future
+'''
+
+import cProfile
+import io
+import os
+import pstats
+import threading
+import tracemalloc
+from contextlib import contextmanager
+
+from etl.logger import get_stage_logger
+
+logger = get_stage_logger("pipline")
+
+PROFILE_DIR = "logs"
+TOP_FUNCTIONS = 40
+TOP_ALLOCATIONS = 30
+TRACEMALLOC_FRAMES = 10
+# Снимок выделений около пика: фоновый поток раз в PEAK_SAMPLE_SECONDS смотрит на текущий объем памяти и снимает
+# стеки, если он вырос еще в PEAK_SNAPSHOT_GROWTH раз от прошлого снимка (снимок дорогой, не делаем его каждый раз)
+PEAK_SAMPLE_SECONDS = 0.05
+PEAK_SNAPSHOT_GROWTH = 1.1
+# Ветки стеков короче MIN_SHARE времени этапа (но не меньше микросекунды) и глубже MAX_DEPTH
+# в collapsed не попадают - иначе на долгих запусках файл разрастается до сотен мегабайт
+MIN_SECONDS = 1e-6
+MIN_SHARE = 1e-4
+MAX_DEPTH = 100
+
+# Текущий профилируемый запуск, None - профилирование выключено
+_run = None
+
+def profiling_enabled() -> bool:
+    return _run is not None
+
+@contextmanager
+def profiling(enabled: bool, name: str, out_dir: str = PROFILE_DIR):
+    '''Включает профилирование этапов на время блока и пишет отчеты в out_dir, enabled=False - ничего не делает'''
+    global _run
+    if not enabled:
+        yield
+        return
+    started_tracemalloc = not tracemalloc.is_tracing()
+    if started_tracemalloc:
+        tracemalloc.start(TRACEMALLOC_FRAMES)
+    _run = {
+        "name": name,
+        "out_dir": out_dir,
+        "thread": threading.get_ident(),
+        "active": False,
+        "profiles": {},
+        "allocations": {},
+        "peaks": {},
+        "peak_snapshots": {},
+    }
+    logger.info(f"Профилирование этапов включено, отчеты будут в {out_dir}")
+    try:
+        yield
+    finally:
+        run, _run = _run, None
+        if started_tracemalloc:
+            tracemalloc.stop()
+        write_profiles(run)
+
+@contextmanager
+def profile_stage(stage_name: str):
+    '''
+    cProfile и снимки tracemalloc вокруг этапа. Вложенные этапы и этапы из других потоков
+    не профилируются отдельно - они уже внутри внешнего этапа или вне его потока
+    '''
+    run = _run
+    if run is None or run["active"] or threading.get_ident() != run["thread"]:
+        yield
+        return
+    run["active"] = True
+    profile = run["profiles"].setdefault(stage_name, cProfile.Profile())
+    before = take_snapshot()
+    # Пик считаем после снимка - сам снимок тоже занимает память
+    tracemalloc.reset_peak()
+    sampled = {}
+    profile.enable()
+    try:
+        with sample_peak(sampled):
+            yield
+    finally:
+        profile.disable()
+        peak = max(tracemalloc.get_traced_memory()[1], sampled.get("peak", 0))
+        after = take_snapshot()
+        run["active"] = False
+        run["peaks"][stage_name] = max(run["peaks"].get(stage_name, 0), peak)
+        if sampled.get("size", 0) > run["peak_snapshots"].get(stage_name, {}).get("size", 0):
+            run["peak_snapshots"][stage_name] = sampled
+        allocations = run["allocations"].setdefault(stage_name, {})
+        for stat in after.compare_to(before, "lineno"):
+            line = str(stat.traceback[0])
+            size, count = allocations.get(line, (0, 0))
+            allocations[line] = (size + stat.size_diff, count + stat.count_diff)
+
+@contextmanager
+def sample_peak(sampled: dict):
+    '''
+    Пока выполняется блок, фоновый поток снимает стеки выделений (statistics("traceback")) в моменты,
+    когда памяти занято больше всего, и кладет в sampled: size - объем памяти в момент снимка, statistics - топ стеков,
+    peak - пик до снимков (снимок сам занимает память, поэтому после него пик сбрасывается).
+    Снимок делается раз в PEAK_SAMPLE_SECONDS, поэтому совсем короткий всплеск между опросами может не попасть
+    '''
+    stop = threading.Event()
+
+    def sample():
+        while not stop.wait(PEAK_SAMPLE_SECONDS):
+            current, peak = tracemalloc.get_traced_memory()
+            sampled["peak"] = max(sampled.get("peak", 0), peak)
+            if current <= sampled.get("size", 0) * PEAK_SNAPSHOT_GROWTH:
+                continue
+            statistics = take_snapshot().statistics("traceback")[:TOP_ALLOCATIONS]
+            sampled.update(size=current, statistics=statistics)
+            tracemalloc.reset_peak()
+
+    thread = threading.Thread(target=sample, name="profile-peak", daemon=True)
+    thread.start()
+    try:
+        yield
+    finally:
+        stop.set()
+        thread.join()
+
+def take_snapshot() -> tracemalloc.Snapshot:
+    return tracemalloc.take_snapshot().filter_traces([
+        tracemalloc.Filter(False, tracemalloc.__file__),
+        tracemalloc.Filter(False, "<frozen importlib._bootstrap*>"),
+    ])
+
+def frame_label(func: tuple) -> str:
+    filename, lineno, name = func
+    if filename == "~":
+        label = name
+    else:
+        label = f"{name} ({os.path.basename(filename)}:{lineno})"
+    return label.replace(";", ",")
+
+def collapsed_stacks(profile: cProfile.Profile) -> dict:
+    '''
+    Стеки {"f1;f2;f3": секунды собственного времени f3} из графа вызовов cProfile.
+    cProfile хранит только пары вызывающий -> вызываемый, поэтому время функции, которую зовут
+    из разных мест, делится между ветками пропорционально времени каждого вызова
+    '''
+    stats = pstats.Stats(profile).stats
+    children = {}
+    for func, (_, _, _, _, callers) in stats.items():
+        for caller, caller_stats in callers.items():
+            children.setdefault(caller, []).append((func, caller_stats[3]))
+    roots = [(func, cum_time) for func, (_, _, _, cum_time, callers) in stats.items() if not callers]
+    min_seconds = max(MIN_SECONDS, MIN_SHARE * sum(cum_time for _, cum_time in roots))
+    stacks = {}
+
+    def walk(func, seconds, path, on_path):
+        _, _, self_time, cum_time, _ = stats[func]
+        scale = seconds / cum_time if cum_time else 0.0
+        path = path + [frame_label(func)]
+        if self_time * scale >= min_seconds:
+            key = ";".join(path)
+            stacks[key] = stacks.get(key, 0.0) + self_time * scale
+        if len(path) >= MAX_DEPTH:
+            return
+        for child, child_time in children.get(func, []):
+            # Рекурсию разворачиваем один раз, дальше время остается у вызывающего
+            if child in on_path or child_time * scale < min_seconds:
+                continue
+            walk(child, child_time * scale, path, on_path | {child})
+
+    for func, cum_time in roots:
+        walk(func, cum_time, [], {func})
+    return stacks
+
+def write_profiles(run: dict):
+    os.makedirs(run["out_dir"], exist_ok=True)
+    for stage_name, profile in run["profiles"].items():
+        prefix = os.path.join(run["out_dir"], f"profile_{run['name']}_{stage_name}")
+
+        stacks = collapsed_stacks(profile)
+        with open(f"{prefix}.collapsed", "w", encoding="utf-8") as f:
+            for stack, seconds in sorted(stacks.items()):
+                f.write(f"{stack} {round(seconds * 1e6)}\n")
+
+        buffer = io.StringIO()
+        pstats.Stats(profile, stream=buffer).sort_stats("cumulative").print_stats(TOP_FUNCTIONS)
+        with open(f"{prefix}.pstats.txt", "w", encoding="utf-8") as f:
+            f.write(buffer.getvalue())
+
+        allocations = sorted(run["allocations"].get(stage_name, {}).items(), key=lambda item: -item[1][0])
+        with open(f"{prefix}.alloc.txt", "w", encoding="utf-8") as f:
+            f.write(f"Пик памяти за этап: {run['peaks'].get(stage_name, 0) / 2**20:.1f} МБ\n")
+            sampled = run["peak_snapshots"].get(stage_name)
+            if sampled:
+                f.write(f"Выделено около пика (снимок при {sampled['size'] / 2**20:.1f} МБ), по стекам:\n")
+                for stat in sampled["statistics"]:
+                    f.write(f"{stat.size / 2**10:12.1f} КБ {stat.count:10d} блоков\n")
+                    for frame in reversed(stat.traceback):
+                        f.write(f"{'':36}{frame}\n")
+            f.write("Чистый прирост памяти за этап (net growth: что осталось выделенным к концу этапа, "
+                    "временные выделения сюда не попадают):\n")
+            for line, (size, count) in allocations[:TOP_ALLOCATIONS]:
+                f.write(f"{size / 2**10:12.1f} КБ {count:10d} блоков  {line}\n")
+    logger.info(f"Отчеты профилирования по этапам {list(run['profiles'])} записаны в {run['out_dir']}")
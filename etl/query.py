@@ -0,0 +1,219 @@
+'''
+Слой запросов для анализа: набор индикаторов один раз читается из main_table в плотную матрицу NumPy
+(индикатор x страна x год), дальше срезы, корреляции и ранги считаются в памяти без запросов к БД.
+Матрицы лежат в LRU-кэше с лимитом по памяти и сбрасываются, когда в etl_load_batch появляется новая загрузка.
+
+    from etl.query import get_panel
+    panel = get_panel(conn, ["NY.GDP.PCAP.CD", "SP.DYN.LE00.IN"])
+    panel.loc("NY.GDP.PCAP.CD", countries=["CHN", "RUS"], years=range(2000, 2021))
+    panel.corr("NY.GDP.PCAP.CD", "SP.DYN.LE00.IN", year=2020)
+    panel.rank("NY.GDP.PCAP.CD", 2020)
+'''
+
+import threading
+import time
+from collections import OrderedDict
+
+import numpy as np
+from psycopg2 import sql
+
+from etl.load import LOAD_BATCH_TABLE, MAIN_TABLE
+from etl.logger import get_stage_logger
+
+logger = get_stage_logger("query")
+
+QUERY_CACHE_MB = 256
+
+class Panel:
+    '''
+    Плотная матрица values[индикатор, страна, год] (float64, NaN - нет значения).
+    Оси: indicators - коды индикаторов в порядке запроса, countries - коды всех стран справочника country
+    (порядок sk, одинаковый для всех панелей), years - сплошной диапазон лет, в которых есть данные.
+    batch_id - последняя загрузка в main_table на момент чтения
+    '''
+    def __init__(self, indicators: list, countries: np.ndarray, years: np.ndarray, values: np.ndarray, batch_id):
+        self.indicators = list(indicators)
+        self.countries = countries
+        self.years = years
+        self.values = values
+        # Панель общая для всех, кто взял ее из кэша - случайная запись в нее испортила бы кэш
+        self.values.flags.writeable = False
+        self.batch_id = batch_id
+        self.indicator_pos = {code: i for i, code in enumerate(self.indicators)}
+        self.country_pos = {code: i for i, code in enumerate(countries)}
+
+    @property
+    def nbytes(self) -> int:
+        return self.values.nbytes + self.countries.nbytes + self.years.nbytes
+
+    def year_positions(self, years) -> np.ndarray:
+        positions = np.asarray(list(years), dtype=np.int64) - (self.years[0] if len(self.years) else 0)
+        if np.any((positions < 0) | (positions >= len(self.years))):
+            span = f"{self.years[0]}-{self.years[-1]}" if len(self.years) else "пустой"
+            raise KeyError(f"Годы {list(years)} вне диапазона панели ({span})")
+        return positions
+
+    def matrix(self, indicator: str) -> np.ndarray:
+        '''Страна x год по одному индикатору (view, без копирования)'''
+        return self.values[self.indicator_pos[indicator]]
+
+    def series(self, indicator: str, country: str) -> np.ndarray:
+        return self.values[self.indicator_pos[indicator], self.country_pos[country]]
+
+    def loc(self, indicator: str, countries = None, years = None) -> np.ndarray:
+        '''Подматрица по кодам стран и годам (None - все)'''
+        result = self.matrix(indicator)
+        if countries is not None:
+            result = result[[self.country_pos[code] for code in countries]]
+        if years is not None:
+            result = result[:, self.year_positions(years)]
+        return result
+
+    def subset(self, indicators: list) -> "Panel":
+        values = self.values[[self.indicator_pos[code] for code in indicators]]
+        return Panel(indicators, self.countries, self.years, values, self.batch_id)
+
+    def corr(self, indicator_a: str, indicator_b: str, year: int | None = None) -> float:
+        '''
+        Корреляция Пирсона двух индикаторов по странам за год (или по всем парам страна-год, если year=None),
+        учитываются только ячейки, где есть оба значения
+        '''
+        a, b = self.matrix(indicator_a), self.matrix(indicator_b)
+        if year is not None:
+            position = self.year_positions([year])[0]
+            a, b = a[:, position], b[:, position]
+        both = ~np.isnan(a) & ~np.isnan(b)
+        if both.sum() < 2:
+            return float("nan")
+        return float(np.corrcoef(a[both], b[both])[0, 1])
+
+    def rank(self, indicator: str, year: int, ascending: bool = False) -> tuple:
+        '''
+        Страны с значениями за год, отсортированные по значению, и их ранги как RANK() в v_country_rank
+        (равные значения - один ранг). Возвращает (коды стран, значения, ранги)
+        '''
+        column = self.matrix(indicator)[:, self.year_positions([year])[0]]
+        present = np.flatnonzero(~np.isnan(column))
+        keys = column[present] if ascending else -column[present]
+        order = np.argsort(keys, kind="stable")
+        sorted_keys = keys[order]
+        ranks = np.searchsorted(sorted_keys, sorted_keys, side="left") + 1
+        return self.countries[present[order]], column[present[order]], ranks
+
+class PanelCache:
+    '''
+    LRU-кэш панелей в памяти процесса с лимитом max_bytes по суммарному размеру матриц.
+    Ключ - (dsn, схема, набор индикаторов). Панель, набор которой покрывает запрошенный, тоже подходит.
+    При каждом обращении сверяем номер последней загрузки в etl_load_batch (один легкий запрос по pk):
+    если он вырос, все панели устарели и сбрасываются
+    '''
+    def __init__(self, max_bytes: int):
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        self.panels = OrderedDict()
+
+    def get(self, conn, indicators: list, schema = 'public') -> Panel:
+        indicators = list(dict.fromkeys(indicators))
+        batch_id = get_last_batch(conn, schema)
+        with self.lock:
+            for key in [key for key, panel in self.panels.items() if panel.batch_id != batch_id]:
+                del self.panels[key]
+            for key, panel in reversed(self.panels.items()):
+                if key[:2] == (conn.dsn, schema) and set(indicators) <= set(panel.indicators):
+                    self.panels.move_to_end(key)
+                    return panel if panel.indicators == indicators else panel.subset(indicators)
+
+        panel = read_panel(conn, indicators, batch_id, schema)
+        with self.lock:
+            if panel.nbytes > self.max_bytes:
+                logger.info(f"Панель {panel.nbytes // 2**20} МБ больше лимита кэша - не кэшируем")
+                return panel
+            self.panels[(conn.dsn, schema, tuple(indicators))] = panel
+            self._evict()
+        return panel
+
+    def set_limit(self, max_bytes: int):
+        with self.lock:
+            self.max_bytes = max_bytes
+            self._evict()
+
+    def _evict(self):
+        total = sum(panel.nbytes for panel in self.panels.values())
+        while total > self.max_bytes:
+            _, evicted = self.panels.popitem(last=False)
+            total -= evicted.nbytes
+
+    def clear(self):
+        with self.lock:
+            self.panels.clear()
+
+def get_last_batch(conn, schema = 'public'):
+    with conn.cursor() as cur:
+        cur.execute(sql.SQL("SELECT max(batch_id) FROM {};").format(sql.Identifier(schema, LOAD_BATCH_TABLE)))
+        batch_id = cur.fetchone()[0]
+    conn.commit()
+    return batch_id
+
+def read_panel(conn, indicators: list, batch_id, schema = 'public') -> Panel:
+    '''
+    Один запрос по main_table (по индексу indicator_sk, при секционировании по индикатору - только нужные секции)
+    и раскладка строк в матрицу по позициям суррогатных ключей, без pivot в pandas
+    '''
+    started = time.perf_counter()
+    with conn.cursor() as cur:
+        cur.execute(sql.SQL("SELECT sk, id FROM {} WHERE sk IS NOT NULL ORDER BY sk;").format(
+            sql.Identifier(schema, "country")
+        ))
+        country_rows = cur.fetchall()
+        cur.execute(sql.SQL("SELECT id, sk FROM {} WHERE id = ANY(%s);").format(
+            sql.Identifier(schema, "indicator")
+        ), [indicators])
+        indicator_sk = dict(cur.fetchall())
+        cur.execute(sql.SQL(
+            "SELECT indicator_sk, country_sk, year, value FROM {} "
+            "WHERE indicator_sk = ANY(%s) AND value IS NOT NULL;"
+        ).format(sql.Identifier(schema, MAIN_TABLE)), [list(indicator_sk.values())])
+        rows = cur.fetchall()
+    conn.commit()
+
+    countries = np.array([code for _, code in country_rows], dtype=object)
+    country_sks = np.array([sk for sk, _ in country_rows], dtype=np.int64)
+    missing = [code for code in indicators if code not in indicator_sk]
+    if missing:
+        logger.info(f"Индикаторов {missing} нет в справочнике indicator - в панели будут пустыми")
+
+    data = np.array(rows, dtype=np.float64).reshape(-1, 4)
+    years = np.arange(data[:, 2].min(), data[:, 2].max() + 1, dtype=np.int64) if len(data) else np.array([], np.int64)
+    values = np.full((len(indicators), len(countries), len(years)), np.nan)
+    if len(data):
+        # sk -> позиция на оси через таблицы поиска, sk небольшие целые
+        indicator_lookup = np.full(max(indicator_sk.values()) + 1, -1, dtype=np.int64)
+        for i, code in enumerate(indicators):
+            if code in indicator_sk:
+                indicator_lookup[indicator_sk[code]] = i
+        country_lookup = np.full(country_sks.max() + 1, -1, dtype=np.int64)
+        country_lookup[country_sks] = np.arange(len(country_sks))
+        values[
+            indicator_lookup[data[:, 0].astype(np.int64)],
+            country_lookup[data[:, 1].astype(np.int64)],
+            data[:, 2].astype(np.int64) - years[0]
+        ] = data[:, 3]
+    logger.info(f"Панель {len(indicators)} x {len(countries)} x {len(years)} прочитана из {MAIN_TABLE}: "
+                f"{len(rows)} значений за {time.perf_counter() - started:.2f} сек")
+    return Panel(indicators, countries, years, values, batch_id)
+
+_panel_cache = None
+_panel_cache_lock = threading.Lock()
+
+def get_panel_cache(max_mb: int = QUERY_CACHE_MB) -> PanelCache:
+    '''Один кэш панелей на процесс, лимит берется из последнего вызова'''
+    global _panel_cache
+    with _panel_cache_lock:
+        if _panel_cache is None:
+            _panel_cache = PanelCache(max_mb * 1024 * 1024)
+        else:
+            _panel_cache.set_limit(max_mb * 1024 * 1024)
+        return _panel_cache
+
+def get_panel(conn, indicators: list, schema = 'public', max_mb: int = QUERY_CACHE_MB) -> Panel:
+    return get_panel_cache(max_mb).get(conn, indicators, schema)
@@ -0,0 +1,71 @@
+import threading
+import time
+
+from etl.logger import get_stage_logger
+
+logger = get_stage_logger("extract")
+
+class AdaptiveRateLimiter:
+    '''
+    Token bucket один на весь процесс - через него проходят все запросы к API из всех потоков.
+    Скорость адаптивная: на 429 скорость режем вдвое (и делаем паузу на pause секунд),
+    на успешных ответах потихоньку поднимаем обратно до потолка max_rate (AIMD как в TCP)
+    '''
+    def __init__(self, max_rate: float, min_rate: float = 0.5, increase_step: float = 0.5):
+        self.max_rate = max_rate
+        self.min_rate = min(min_rate, max_rate)
+        self.increase_step = increase_step
+        self.rate = max_rate
+        # Запас токенов не больше чем на секунду вперед, чтобы не было всплеска после простоя
+        self.tokens = 1.0
+        self.updated_at = time.monotonic()
+        self.blocked_until = 0.0
+        self.lock = threading.Lock()
+
+    def _refill(self, now: float):
+        self.tokens = min(max(self.rate, 1.0), self.tokens + (now - self.updated_at) * self.rate)
+        self.updated_at = now
+
+    def acquire(self):
+        '''Блокирует поток, пока не появится токен на запрос'''
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self._refill(now)
+                if now >= self.blocked_until and self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = max(self.blocked_until - now, (1 - self.tokens) / self.rate)
+            time.sleep(wait)
+
+    def on_throttle(self, pause: float = 0):
+        '''API ответил 429 - снижаем скорость и все потоки ждут pause секунд'''
+        with self.lock:
+            self.rate = max(self.min_rate, self.rate / 2)
+            self.tokens = 0
+            self.blocked_until = max(self.blocked_until, time.monotonic() + pause)
+            logger.info(f"Снижаем скорость запросов до {self.rate:.2f} запр/сек")
+
+    def on_success(self):
+        '''Успешный ответ - аккуратно возвращаем скорость к потолку'''
+        with self.lock:
+            if self.rate < self.max_rate:
+                self.rate = min(self.max_rate, self.rate + self.increase_step / self.rate)
+
+_limiter = None
+_limiter_lock = threading.Lock()
+
+def get_rate_limiter(max_rate: float) -> AdaptiveRateLimiter:
+    '''
+    Возвращает общий для процесса limiter, при первом вызове создает его.
+    Если потолок скорости в новом конфиге другой - обновляем его
+    '''
+    global _limiter
+    with _limiter_lock:
+        if _limiter is None:
+            _limiter = AdaptiveRateLimiter(max_rate)
+        elif _limiter.max_rate != max_rate:
+            with _limiter.lock:
+                _limiter.max_rate = max_rate
+                _limiter.rate = min(_limiter.rate, max_rate)
+        return _limiter
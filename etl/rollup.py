@@ -0,0 +1,158 @@
+import time
+
+import numpy as np
+from psycopg2 import sql
+
+from etl.load import MAIN_TABLE
+from etl.logger import get_stage_logger
+from etl.metrics import inc, observe
+
+logger = get_stage_logger("load")
+
+# Предагрегаты для дашбордов: {таблица: (столбец периода, длина периода в годах)}
+ROLLUP_TABLES = {
+    "rollup_year": ("year", 1),
+    "rollup_decade": ("decade", 10),
+}
+# Значение region_id/income_level_id в строках "по всем регионам / уровням дохода" (GROUPING SETS),
+# '' - страна без уровня дохода
+ALL_GROUPS = "*"
+# Обновления предагрегатов из разных процессов выполняются по очереди (см. update_rollups)
+ROLLUP_LOCK_KEY = 4207
+
+def ensure_rollup_tables(conn, schema = 'public'):
+    '''
+    Таблицы предагрегатов для дашбордов: несколько тысяч строк вместо соединения всей main_table
+    со справочниками. Заполняются при загрузке (update_rollups), названия - в представлениях vew_preaparation.sql.
+    Считаются только по странам (агрегаты WB вроде WLD, EAS и коды без описания в справочнике не входят)
+    и по наблюдаемым value - v_global/v_region считают по value_filled, с интерполяцией пропусков,
+    поэтому в годах с пропусками числа отличаются
+    '''
+    with conn.cursor() as cur:
+        for table, (period, _) in ROLLUP_TABLES.items():
+            cur.execute(sql.SQL("""
+            CREATE TABLE IF NOT EXISTS {table} (
+                indicator_sk INTEGER NOT NULL,
+                region_id TEXT NOT NULL,
+                income_level_id TEXT NOT NULL,
+                {period} SMALLINT NOT NULL,
+                mean_value DOUBLE PRECISION,
+                median_value DOUBLE PRECISION,
+                min_value DOUBLE PRECISION,
+                max_value DOUBLE PRECISION,
+                n_values INTEGER,
+                PRIMARY KEY (indicator_sk, {period}, region_id, income_level_id)
+            );
+            """).format(table=sql.Identifier(schema, table), period=sql.Identifier(period)))
+    conn.commit()
+
+def rollup_query(table, schema = 'public', touched = True) -> sql.Composed:
+    '''
+    INSERT агрегатов по main_table: mean/median/min/max/count непустых value в разрезе
+    индикатор x регион x уровень дохода x период и те же агрегаты по всем регионам и/или уровням дохода.
+    Строки не-стран отбрасываются: у агрегатов WB и заглушек из ensure_surrogate_key нет региона,
+    иначе мировые и региональные итоги попали бы в общие средние вместе со странами.
+    touched - только пары (индикатор, период) из параметров-массивов %s, иначе вся таблица
+    '''
+    period, width = ROLLUP_TABLES[table]
+    touched_sql = sql.SQL("")
+    if touched:
+        touched_sql = sql.SQL("""
+        JOIN unnest(%s::integer[], %s::smallint[]) AS t (indicator_sk, period)
+          ON m.indicator_sk = t.indicator_sk AND m.year >= t.period AND m.year < t.period + {width}
+        """).format(width=sql.Literal(width))
+    return sql.SQL("""
+    INSERT INTO {table} (indicator_sk, region_id, income_level_id, {period},
+                         mean_value, median_value, min_value, max_value, n_values)
+    SELECT indicator_sk
+        , CASE WHEN GROUPING(region_id) = 1 THEN {all} ELSE region_id END
+        , CASE WHEN GROUPING(income_level_id) = 1 THEN {all} ELSE income_level_id END
+        , period
+        , AVG(value)
+        , PERCENTILE_CONT(0.5) WITHIN GROUP (ORDER BY value)
+        , MIN(value)
+        , MAX(value)
+        , COUNT(*)
+    FROM (
+        SELECT m.indicator_sk
+            , c.region_id
+            , COALESCE(c.income_level_id, '') AS income_level_id
+            , m.year / {width} * {width} AS period
+            , m.value
+        FROM {main} AS m
+        {touched}
+        JOIN {country} AS c ON c.sk = m.country_sk
+        WHERE m.value IS NOT NULL AND c.region_id IS NOT NULL
+    ) AS s
+    GROUP BY GROUPING SETS (
+        (indicator_sk, period, region_id, income_level_id),
+        (indicator_sk, period, region_id),
+        (indicator_sk, period, income_level_id),
+        (indicator_sk, period)
+    );
+    """).format(
+        table=sql.Identifier(schema, table),
+        period=sql.Identifier(period),
+        all=sql.Literal(ALL_GROUPS),
+        width=sql.Literal(width),
+        main=sql.Identifier(schema, MAIN_TABLE),
+        touched=touched_sql,
+        country=sql.Identifier(schema, "country")
+    )
+
+def rebuild_rollups(conn, schema = 'public'):
+    '''
+    Полная пересборка предагрегатов одной транзакцией - при первом запуске и после изменения
+    справочника стран (страна сменила регион или уровень дохода)
+    '''
+    started = time.perf_counter()
+    ensure_rollup_tables(conn, schema)
+    with conn.cursor() as cur:
+        cur.execute("SELECT pg_advisory_xact_lock(%s);", [ROLLUP_LOCK_KEY])
+        fill_rollups(cur, schema)
+    conn.commit()
+    observe("db_seconds", time.perf_counter() - started, table="rollup")
+
+def fill_rollups(cur, schema = 'public'):
+    for table in ROLLUP_TABLES:
+        cur.execute(sql.SQL("TRUNCATE {};").format(sql.Identifier(schema, table)))
+        cur.execute(rollup_query(table, schema, touched=False))
+        logger.info(f"Предагрегаты {table} собраны по всей {MAIN_TABLE}, {cur.rowcount} строк")
+
+def update_rollups(conn, changed, schema = 'public'):
+    '''
+    Инкрементальное обновление предагрегатов по ключам (country_sk, indicator_sk, year), измененным загрузкой:
+    группы затронутых пар (индикатор, год) и (индикатор, десятилетие) удаляются и считаются заново
+    по main_table (медиану по частям не пересчитать, поэтому группа всегда пересчитывается целиком).
+    Транзакцию не закрывает - вызывается из load_main_table, предагрегаты фиксируются вместе с данными.
+    Advisory lock выстраивает параллельные загрузки (шарды) в очередь: следующая видит уже зафиксированные
+    строки предыдущей, и пересчет одной группы из двух процессов не теряет ничьих строк
+    '''
+    if changed.empty:
+        return
+    started = time.perf_counter()
+    with conn.cursor() as cur:
+        cur.execute("SELECT pg_advisory_xact_lock(%s);", [ROLLUP_LOCK_KEY])
+        cur.execute(sql.SQL("SELECT NOT EXISTS (SELECT 1 FROM {});").format(
+            sql.Identifier(schema, next(iter(ROLLUP_TABLES)))
+        ))
+        if cur.fetchone()[0]:
+            # Предагрегатов еще нет, а в main_table могут быть ранее загруженные строки - считаем по всей таблице
+            fill_rollups(cur, schema)
+            observe("db_seconds", time.perf_counter() - started, table="rollup")
+            return
+
+        for table, (period, width) in ROLLUP_TABLES.items():
+            keys = changed[["indicator_sk", "year"]].astype(np.int64)
+            keys["year"] = keys["year"] // width * width
+            keys = keys.drop_duplicates()
+            params = [keys["indicator_sk"].tolist(), keys["year"].tolist()]
+            cur.execute(sql.SQL("""
+            DELETE FROM {table} AS r
+            USING unnest(%s::integer[], %s::smallint[]) AS t (indicator_sk, period)
+            WHERE r.indicator_sk = t.indicator_sk AND r.{period} = t.period;
+            """).format(table=sql.Identifier(schema, table), period=sql.Identifier(period)), params)
+            cur.execute(rollup_query(table, schema), params)
+            inc("rollup_groups_total", len(keys), table=table)
+        logger.info(f"Предагрегаты обновлены по {len(changed)} измененным строкам")
+    observe("db_seconds", time.perf_counter() - started, table="rollup")
@@ -0,0 +1,73 @@
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+from etl.logger import get_stage_logger
+from etl.metrics import observe
+
+logger = get_stage_logger("pipline")
+
+def check_dag(tasks: dict):
+    '''Все зависимости объявлены и циклов нет - иначе планировщик бы просто завис'''
+    for name, (_, deps) in tasks.items():
+        unknown = [dep for dep in deps if dep not in tasks]
+        if unknown:
+            raise ValueError(f"Задача {name} зависит от необъявленных задач {unknown}")
+    visited = set()
+    while len(visited) < len(tasks):
+        ready = [name for name, (_, deps) in tasks.items() if name not in visited and all(d in visited for d in deps)]
+        if not ready:
+            raise ValueError(f"Циклическая зависимость между задачами {sorted(set(tasks) - visited)}")
+        visited.update(ready)
+
+def run_dag(tasks: dict, workers: int) -> dict:
+    '''
+    Простой планировщик задач с зависимостями.
+    tasks - {имя: (функция, [имена задач, от которых зависит])}, функция получает словарь результатов
+    уже выполненных задач и возвращает свой результат.
+    Задача запускается, как только выполнены все ее зависимости, независимые задачи идут параллельно
+    в workers потоков - общее время стремится к длине критического пути, а не к сумме всех шагов.
+    Если задача упала, зависящие от нее пропускаются, остальные доделываются, в конце - RuntimeError
+    '''
+    check_dag(tasks)
+    results = {}
+    errors = {}
+    pending = dict(tasks)
+    started_at = time.perf_counter()
+
+    def run_task(name, func):
+        logger.info(f"Задача {name} запущена")
+        started = time.perf_counter()
+        result = func(results)
+        elapsed = time.perf_counter() - started
+        observe("task_seconds", elapsed, task=name)
+        logger.info(f"Задача {name} выполнена за {elapsed:.2f} сек")
+        return result
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        running = {}
+        while pending or running:
+            for name, (func, deps) in list(pending.items()):
+                if any(dep in errors for dep in deps):
+                    logger.info(f"Задача {name} пропущена - не выполнены зависимости")
+                    errors[name] = None
+                    del pending[name]
+                elif all(dep in results for dep in deps):
+                    running[executor.submit(run_task, name, func)] = name
+                    del pending[name]
+            if not running:
+                continue
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                name = running.pop(future)
+                try:
+                    results[name] = future.result()
+                except (Exception, SystemExit) as e:
+                    logger.info(f"Задача {name} упала: {e!r}")
+                    errors[name] = e
+
+    logger.info(f"Выполнено {len(results)} из {len(tasks)} задач за {time.perf_counter() - started_at:.2f} сек")
+    if errors:
+        failed = [name for name, e in errors.items() if e is not None]
+        skipped = [name for name, e in errors.items() if e is None]
+        raise RuntimeError(f"Упали задачи {failed}, пропущены {skipped}")
+    return results
@@ -1,13 +1,87 @@
 import re
+import numpy as np
 import pandas as pd
 from etl.logger import get_stage_logger
+from etl.metrics import inc
+
+logger = get_stage_logger("transform")
+
+# Ключ одного наблюдения WB: страна, индикатор, год
+KEY_COLUMNS = ["country_id", "indicator_id", "date"]
+OBSERVATION_COLUMNS = KEY_COLUMNS + ["value", "obs_status", "unit"]
+# По этим столбцам считается row_hash - если хэш совпал с сохраненным в БД, строку не перезаписываем
+HASH_COLUMNS = ["value", "obs_status", "unit"]
 
 def transform(data: list) -> pd.DataFrame:
-    df = pd.json_normalize(data)
-    df.info()
-    df = normalize_reference_from_key(df)
+    '''
+    Основная трансформация наблюдений. Структура ответа WB по индикаторам известна заранее, поэтому
+    вместо json_normalize по всем вложенным полям сразу собираем нужные типизированные столбцы
+    '''
+    df = transform_observations(data)
+    logger.info(f"Трансформировано {len(df)} строк")
+    inc("rows_transformed_total", len(df))
+    inc("rows_dropped_total", len(data) - len(df))
     return df
 
+def transform_observations(data: list) -> pd.DataFrame:
+    '''
+    Один проход по записям вида
+    {"indicator": {"id", "value"}, "country": {"id", "value"}, "countryiso3code", "date", "value", "unit", "obs_status"}
+    Типы: value float64 (пропуски NaN), date int16, country_id/indicator_id категориальные.
+    Пустые obs_status/unit - None (в БД будут NULL), дубли убираем только по ключевым столбцам.
+    В конце добавляется row_hash - хэш содержимого строки (см. row_hashes)
+    '''
+    country = []
+    indicator = []
+    dates = []
+    values = []
+    obs_status = []
+    unit = []
+    for record in data:
+        # Хардкод того что при в запросе country.id не iso3 a iso2 - берем iso3, если его нет то что есть
+        country.append(record.get("countryiso3code") or (record.get("country") or {}).get("id"))
+        indicator.append((record.get("indicator") or {}).get("id"))
+        dates.append(record.get("date"))
+        values.append(record.get("value"))
+        obs_status.append(record.get("obs_status") or None)
+        unit.append(record.get("unit") or None)
+
+    years = pd.to_numeric(pd.Series(dates, dtype=object), errors="coerce").to_numpy()
+    df = pd.DataFrame({
+        "country_id": pd.Categorical(country),
+        "indicator_id": pd.Categorical(indicator),
+        "date": years,
+        "value": pd.to_numeric(pd.Series(values, dtype=object), errors="coerce").to_numpy(dtype=np.float64),
+        "obs_status": pd.Series(obs_status, dtype=object),
+        "unit": pd.Series(unit, dtype=object),
+    }, columns=OBSERVATION_COLUMNS)
+
+    # Годы вида "2020Q1"/"2020M01" у годовых индикаторов не встречаются, такие строки отбрасываем
+    valid = df["date"].notna() & df["country_id"].notna() & df["indicator_id"].notna()
+    if not valid.all():
+        logger.info(f"Отброшено {int((~valid).sum())} строк без страны, индикатора или года")
+        df = df[valid]
+    df = df.astype({"date": np.int16})
+    df = df.drop_duplicates(subset=KEY_COLUMNS, keep="last").reset_index(drop=True)
+    df["row_hash"] = row_hashes(df)
+    return df
+
+def row_hashes(df: pd.DataFrame) -> np.ndarray:
+    '''
+    Хэш содержимого строки (без ключа) - int64, чтобы хранить в BIGINT.
+    hash_pandas_object с фиксированным ключом, поэтому хэш одинаковый между запусками.
+    Перед хэшированием столбцы приводятся к виду из transform_observations (value float64 с NaN,
+    obs_status/unit object с None), иначе одни и те же данные в другом dtype (object, Float64, category)
+    дали бы другой хэш и перезаписывались бы при каждой загрузке
+    '''
+    hashed = pd.DataFrame({
+        "value": pd.to_numeric(df["value"], errors="coerce").to_numpy(dtype=np.float64, na_value=np.nan),
+        "obs_status": df["obs_status"].astype(object).where(df["obs_status"].notna(), None).to_numpy(),
+        "unit": df["unit"].astype(object).where(df["unit"].notna(), None).to_numpy(),
+    }, columns=HASH_COLUMNS)
+    hashes = pd.util.hash_pandas_object(hashed, index=False).to_numpy()
+    return hashes.view(np.int64)
+
 def to_snake(name: str) -> str:
     name = name.replace(".", "_")
     name = re.sub(r'([0-9])([a-zA-Z])', r'\1_\2', name)
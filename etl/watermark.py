@@ -0,0 +1,182 @@
+from copy import deepcopy
+from datetime import date
+
+from etl.api import process_cfg_for_api, safe_request
+from etl.logger import get_stage_logger
+
+logger = get_stage_logger("extract")
+
+WATERMARK_TABLE = "etl_watermark"
+# Если в date_interval стоит "all" - берем весь период, за который у WB бывают данные
+FIRST_YEAR = 1960
+
+def get_year_range(date_interval: list) -> tuple[int, int]:
+    '''
+    Из валидированного date_interval (["2020:2024"], ["2020", "2022"], [] = все даты) получаем общий диапазон лет
+    '''
+    years = []
+    for item in date_interval:
+        years.extend(int(part) for part in item.split(":"))
+    if not years:
+        return FIRST_YEAR, date.today().year
+    return min(years), max(years)
+
+def ensure_watermark_table(conn):
+    '''
+    Служебная таблица с водяными знаками по каждой серии (страна, индикатор):
+    какой диапазон лет уже загружен и какое значение lastupdated отдавало API на момент загрузки
+    '''
+    with conn.cursor() as cur:
+        cur.execute(f"""
+            CREATE TABLE IF NOT EXISTS {WATERMARK_TABLE} (
+                country_id TEXT,
+                indicator_id TEXT,
+                first_year INTEGER,
+                last_year INTEGER,
+                last_updated TEXT,
+                updated_at TIMESTAMPTZ DEFAULT now(),
+                PRIMARY KEY (country_id, indicator_id)
+            );
+        """)
+    conn.commit()
+
+def get_watermarks(conn, indicators: list) -> dict:
+    '''Возвращает словарь {(country_id, indicator_id): (first_year, last_year, last_updated)}'''
+    ensure_watermark_table(conn)
+    with conn.cursor() as cur:
+        cur.execute(
+            f"SELECT country_id, indicator_id, first_year, last_year, last_updated "
+            f"FROM {WATERMARK_TABLE} WHERE indicator_id = ANY(%s)",
+            [list(indicators)]
+        )
+        return {(c, i): (first, last, upd) for c, i, first, last, upd in cur.fetchall()}
+
+def probe_last_updated(raw_cfg: dict, indicators: list) -> dict:
+    '''
+    Дешевые запросы одной записи, только чтобы достать из metadata дату lastupdated: {индикатор: lastupdated}.
+    lastupdated в ответе WB - дата обновления источника (source), общая для всех его индикаторов,
+    поэтому индикаторы с известным источником (etl.planner.get_indicator_sources) проверяем одним запросом
+    на источник, остальные - по запросу на индикатор
+    '''
+    # etl.planner сам импортирует etl.watermark, поэтому импорт здесь
+    from etl.planner import MAX_INDICATORS_PER_REQUEST, chunks, get_indicator_sources
+    sources = get_indicator_sources(raw_cfg, indicators) if len(indicators) > 1 else {}
+    groups = {}
+    for indicator in indicators:
+        source = sources.get(indicator)
+        groups.setdefault(source if source is not None else ("single", indicator), []).append(indicator)
+
+    last_updated = {}
+    for source, group in groups.items():
+        for indicator_chunk in chunks(group, MAX_INDICATORS_PER_REQUEST):
+            probe_cfg = deepcopy(raw_cfg)
+            probe_cfg["indicators"] = indicator_chunk
+            processed_cfg = process_cfg_for_api(probe_cfg)
+            processed_cfg["url"] += ";".join(indicator_chunk)
+            processed_cfg["params"]["per_page"] = 1
+            processed_cfg["params"]["page"] = 1
+            if len(indicator_chunk) > 1:
+                processed_cfg["params"]["source"] = source
+            metadata, _ = safe_request(processed_cfg)
+            for indicator in indicator_chunk:
+                last_updated[indicator] = metadata.get("lastupdated")
+    logger.info(f"lastupdated для {len(indicators)} индикаторов проверен за "
+                f"{sum(len(chunks(group, MAX_INDICATORS_PER_REQUEST)) for group in groups.values())} запросов")
+    return last_updated
+
+def missing_ranges(start: int, end: int, first: int, last: int) -> list[tuple[int, int]]:
+    '''
+    Что докачать, чтобы загруженное покрывало [min(start, first), max(end, last)] без дыр.
+    Водяной знак - один отрезок, поэтому если запрошенный диапазон не примыкает к загруженному
+    (2020-2024 при загруженных 1990-2000), разрыв между ними (2001-2019) качаем тоже:
+    иначе он числился бы загруженным и больше никогда не запрашивался
+    '''
+    ranges = []
+    if start < first:
+        ranges.append((start, first - 1))
+    if end > last:
+        ranges.append((last + 1, end))
+    return ranges
+
+def plan_incremental(raw_cfg: dict, conn) -> list[dict]:
+    '''
+    Строит список задач для инкрементальной выгрузки. Для каждой серии (страна, индикатор):
+    - водяного знака нет или lastupdated в API поменялся - качаем весь настроенный диапазон заново
+    - lastupdated тот же - качаем только годы, которые еще не загружались, если таких нет - серию пропускаем
+    Серии одного индикатора с одинаковым диапазоном объединяем в один запрос по нескольким странам.
+    Для countries = ["all"] серией считаем индикатор целиком (по всем странам, что уже есть в водяных знаках)
+    '''
+    start, end = get_year_range(raw_cfg["date_interval"])
+    indicators = raw_cfg["indicators"]
+    countries = raw_cfg["countries"]
+    watermarks = get_watermarks(conn, indicators)
+    probed = probe_last_updated(raw_cfg, indicators)
+
+    tasks = []
+    for indicator in indicators:
+        last_updated = probed[indicator]
+        if countries == ["all"]:
+            marks = [wm for (c, i), wm in watermarks.items() if i == indicator]
+            # Покрытие "всех стран" - пересечение отрезков серий, пустое пересечение - качаем заново
+            if (marks and all(upd == last_updated for _, _, upd in marks)
+                    and max(m[0] for m in marks) <= min(m[1] for m in marks)):
+                series = {"all": (max(m[0] for m in marks), min(m[1] for m in marks), last_updated)}
+            else:
+                series = {"all": None}
+        else:
+            series = {country: watermarks.get((country, indicator)) for country in countries}
+
+        groups = {}
+        for country, wm in series.items():
+            if wm is None or wm[2] != last_updated:
+                ranges, coverage = [(start, end)], (start, end)
+            else:
+                first, last, _ = wm
+                ranges, coverage = missing_ranges(start, end, first, last), (min(start, first), max(end, last))
+            for year_range in ranges:
+                groups.setdefault((year_range, coverage), []).append(country)
+
+        if not groups:
+            logger.info(f"Индикатор {indicator} не изменился (lastupdated {last_updated}), пропускаем")
+        for ((date_st, date_end), (first, last)), group_countries in groups.items():
+            tasks.append({
+                "indicator": indicator,
+                "countries": group_countries,
+                "date_interval": [f"{date_st}:{date_end}"],
+                "first_year": first,
+                "last_year": last,
+                "last_updated": last_updated
+            })
+    logger.info(f"Инкрементальный план: {len(tasks)} запросов по {len(indicators)} индикаторам")
+    return tasks
+
+def update_watermarks(conn, tasks: list[dict], df):
+    '''
+    Вызывается после успешной загрузки в БД - сдвигаем водяные знаки по всем сериям из выполненных задач.
+    Для countries = ["all"] серии берем по странам, которые реально пришли в данных (df может быть None)
+    '''
+    rows = {}
+    for task in tasks:
+        countries = task["countries"]
+        if countries == ["all"]:
+            if df is None:
+                continue
+            countries = df.loc[df["indicator_id"] == task["indicator"], "country_id"].unique().tolist()
+        for country in countries:
+            rows[(country, task["indicator"])] = (task["first_year"], task["last_year"], task["last_updated"])
+
+    if not rows:
+        return
+    ensure_watermark_table(conn)
+    with conn.cursor() as cur:
+        cur.executemany(f"""
+            INSERT INTO {WATERMARK_TABLE} (country_id, indicator_id, first_year, last_year, last_updated)
+            VALUES (%s, %s, %s, %s, %s)
+            ON CONFLICT (country_id, indicator_id)
+            DO UPDATE SET first_year = EXCLUDED.first_year,
+                          last_year = EXCLUDED.last_year,
+                          last_updated = EXCLUDED.last_updated,
+                          updated_at = now();
+        """, [(c, i, *wm) for (c, i), wm in rows.items()])
+    conn.commit()
+    logger.info(f"Обновлены водяные знаки для {len(rows)} серий")
@@ -1,9 +1,188 @@
-from etl.logger import setup_logging, get_stage_logger
-from etl.extract import extract_data
-from piplines.pipline import run_pipline
-from piplines.create_ref_tables import create_ref_tables_con, create_ref_tables_ind
+'''
+Точка входа ETL:
+    python main.py [run]             - основной пайплайн по configs/config.json
+    python main.py refs [--only ...] - справочные таблицы стран и индикаторов
+    (run и refs с --profile - профилирование этапов, отчеты в logs/, см. etl/profiling.py)
+    python main.py all               - справочники и main_table за один запуск (см. piplines/refresh_all.py)
+    python main.py shard             - большая выгрузка в несколько процессов (см. piplines/sharded.py)
+    python main.py mart              - пересборка витрины (см. piplines/build_mart.py)
+    python main.py validate [files]  - проверка config-файлов
+    python main.py plan [files]      - пробный запуск планировщика запросов, без скачивания данных и без БД
+    python main.py indexes [--create] - недостающие индексы под запросы витрины и BI (см. etl/index_advisor.py)
+    python main.py rollups           - полная пересборка предагрегатов для дашбордов (см. etl/rollup.py)
+    python main.py repartition [--to ...] - перестроить main_table под другое секционирование
+Тяжелые модули (pandas, psycopg2, requests) импортируются только внутри подкоманд, которым они нужны,
+поэтому validate и plan стартуют быстро
+'''
+
+import argparse
+import sys
+
+CONFIGS = [
+    "configs/config.json",
+    "configs/config_ref_tables_countries.json",
+    "configs/config_ref_tables_indicators.json",
+]
+
+def cmd_run(args):
+    from piplines.pipline import run_pipline
+    run_pipline(profile=getattr(args, "profile", False))
+
+def cmd_refs(args):
+    from piplines.create_ref_tables import create_ref_tables_con, create_ref_tables_ind
+    if args.only in (None, "countries"):
+        create_ref_tables_con(profile=args.profile)
+    if args.only in (None, "indicators"):
+        create_ref_tables_ind(profile=args.profile)
+
+def cmd_all(args):
+    from piplines.refresh_all import refresh_all
+    refresh_all()
+
+def cmd_shard(args):
+    from piplines.sharded import run_sharded
+    run_sharded(args.config)
+
+def cmd_mart(args):
+    from piplines.build_mart import build_mart, refresh_mart_incremental
+    if args.incremental:
+        refresh_mart_incremental()
+    else:
+        build_mart(check_parity=args.check_parity)
+
+def cmd_validate(args) -> int:
+    '''
+    Проверяет config-файлы, ничего не запуская: печатает значения, которые валидация заменила бы
+    на значения по умолчанию, и некорректные коды стран. С -v еще и недостающие ключи и мелкие исправления.
+    Код возврата 1, если есть замечания
+    '''
+    import json
+    from copy import deepcopy
+    from etl.config import COUNTRY_CODE_RE, DEFAULT_CFG, validate_cfg
+
+    problems = 0
+    for path in args.configs:
+        try:
+            with open(path, encoding="utf-8") as f:
+                raw = json.load(f)
+        except (OSError, json.JSONDecodeError) as e:
+            print(f"{path}: не удалось прочитать ({e})")
+            problems += 1
+            continue
+        if not isinstance(raw, dict):
+            print(f"{path}: ожидается JSON-объект")
+            problems += 1
+            continue
+
+        # validate_cfg меняет словарь на месте, исходный нужен для сравнения
+        cfg = validate_cfg(dict(deepcopy(DEFAULT_CFG), **deepcopy(raw)))
+        errors, notes = [], []
+        for key, value in cfg.items():
+            if key == "password":
+                continue
+            if key not in raw:
+                notes.append(f"{key}: нет в файле, берем {value!r}")
+            elif raw[key] != value:
+                if value == DEFAULT_CFG[key]:
+                    errors.append(f"{key}: некорректное значение {raw[key]!r}, берем {value!r}")
+                else:
+                    notes.append(f"{key}: {raw[key]!r} -> {value!r}")
+        for code in cfg["countries"]:
+            if code != "all" and not COUNTRY_CODE_RE.match(code):
+                errors.append(f"countries: некорректный код {code!r} (нужен 3-символьный код, например RUS)")
+
+        problems += len(errors)
+        print(f"{path}: {f'замечаний {len(errors)}' if errors else 'OK'}")
+        for line in errors + (notes if args.verbose else []):
+            print(f"  {line}")
+    return 1 if problems else 0
+
+def cmd_plan(args):
+    from etl.planner import dry_run
+    dry_run(args.configs, lookup_sources=args.lookup_sources)
+
+def cmd_indexes(args):
+    from etl.config import load_cfg, validate_cfg
+    from etl.index_advisor import report_indexes
+    from etl.load import bd_connection
+    cfg = validate_cfg(load_cfg(CONFIGS[0]))
+    with bd_connection(cfg) as conn:
+        report_indexes(conn, create=args.create)
+
+def cmd_rollups(args):
+    from etl.config import load_cfg, validate_cfg
+    from etl.load import bd_connection
+    from etl.rollup import rebuild_rollups
+    cfg = validate_cfg(load_cfg(CONFIGS[0]))
+    with bd_connection(cfg) as conn:
+        rebuild_rollups(conn)
+
+def cmd_repartition(args):
+    from etl.config import load_cfg, validate_cfg
+    from etl.load import bd_connection, repartition_main_table
+    cfg = validate_cfg(load_cfg(CONFIGS[0]))
+    partitioning = cfg["partitioning"] if args.to is None else {"none": ""}.get(args.to, args.to)
+    with bd_connection(cfg) as conn:
+        repartition_main_table(conn, partitioning)
+
+def main(argv: list | None = None) -> int:
+    parser = argparse.ArgumentParser(prog="main.py", description="ETL World Bank API -> PostgreSQL")
+    commands = parser.add_subparsers(dest="command")
+
+    profile_help = "профилировать этапы (cProfile + tracemalloc), отчеты в logs/profile_*"
+    run = commands.add_parser("run", help="основной пайплайн (по умолчанию)")
+    run.add_argument("--profile", action="store_true", help=profile_help)
+    run.set_defaults(func=cmd_run)
+
+    refs = commands.add_parser("refs", help="справочные таблицы стран и индикаторов")
+    refs.add_argument("--only", choices=["countries", "indicators"], help="только одна группа справочников")
+    refs.add_argument("--profile", action="store_true", help=profile_help)
+    refs.set_defaults(func=cmd_refs)
+
+    commands.add_parser("all", help="справочники и main_table за один запуск").set_defaults(func=cmd_all)
+
+    shard = commands.add_parser("shard", help="выгрузка в несколько процессов")
+    shard.add_argument("--config", default=CONFIGS[0])
+    shard.set_defaults(func=cmd_shard)
+
+    mart = commands.add_parser("mart", help="пересборка витрины")
+    mart.add_argument("--incremental", action="store_true", help="только серии, поменявшиеся с прошлого обновления")
+    mart.add_argument("--check-parity", action="store_true", help="сверить результат с SQL-версией расчета")
+    mart.set_defaults(func=cmd_mart)
+
+    validate = commands.add_parser("validate", help="проверка config-файлов")
+    validate.add_argument("configs", nargs="*", default=CONFIGS)
+    validate.add_argument("-v", "--verbose", action="store_true", help="показать и недостающие ключи, и исправления")
+    validate.set_defaults(func=cmd_validate)
+
+    plan = commands.add_parser("plan", help="пробный запуск планировщика запросов")
+    plan.add_argument("configs", nargs="*", default=CONFIGS)
+    plan.add_argument("--lookup-sources", action="store_true",
+                      help="искать источники индикаторов в справочнике БД и API (по умолчанию - только файл в cache_dir)")
+    plan.set_defaults(func=cmd_plan)
+
+    indexes = commands.add_parser("indexes", help="недостающие индексы под запросы витрины и BI")
+    indexes.add_argument("--create", action="store_true", help="создать недостающие индексы")
+    indexes.set_defaults(func=cmd_indexes)
+
+    commands.add_parser(
+        "rollups", help="пересобрать предагрегаты (после изменения регионов/уровней дохода стран)"
+    ).set_defaults(func=cmd_rollups)
+
+    repartition = commands.add_parser(
+        "repartition", help="перестроить main_table под другое секционирование (копия остается как *_before_*)"
+    )
+    repartition.add_argument("--to", choices=["none", "decade", "indicator"],
+                             help="секционирование, по умолчанию partitioning из configs/config.json")
+    repartition.set_defaults(func=cmd_repartition)
+
+    args = parser.parse_args(argv)
+    try:
+        return getattr(args, "func", cmd_run)(args) or 0
+    finally:
+        # Пулы соединений создаются только подкомандами, которые ходили в БД
+        if "etl.load" in sys.modules:
+            sys.modules["etl.load"].close_bd_pools()
 
 if __name__ == "__main__":
-    run_pipline()
-    #create_ref_tables_con()
-    #create_ref_tables_ind()
\ No newline at end of file
+    sys.exit(main())
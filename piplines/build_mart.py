@@ -0,0 +1,34 @@
+from etl.logger import setup_logging, get_stage_logger
+from etl.config import load_cfg, validate_cfg
+from etl.load import bd_connection
+from etl.mart import read_mart_source, compute_mart, load_mart, check_mart_parity, lock_change_feed, refresh_mart
+
+logger = get_stage_logger("pipline")
+
+def build_mart(check_parity: bool = False):
+    '''
+    Пересборка аналитической витрины main_table_proc в Python вместо REFRESH mv_main_table_proc в Postgres:
+    читаем main_table со справочниками, считаем интерполяцию и метрики в NumPy, заливаем таблицей.
+    check_parity - дополнительно сверить результат с SQL-версией расчета
+    '''
+    setup_logging()
+    logger.info("Запуск пересборки витрины")
+    cfg = validate_cfg(load_cfg("configs/config.json"))
+    with bd_connection(cfg) as conn:
+        consumed = lock_change_feed(conn)
+        mart_df = compute_mart(read_mart_source(conn))
+        if check_parity:
+            check_mart_parity(conn, mart_df)
+        load_mart(conn, mart_df, consumed=consumed)
+    logger.info("Пересборка витрины окончена")
+
+def refresh_mart_incremental():
+    '''
+    Обновление витрины только по сериям, которые поменялись в main_table после прошлого обновления
+    '''
+    setup_logging()
+    logger.info("Запуск инкрементального обновления витрины")
+    cfg = validate_cfg(load_cfg("configs/config.json"))
+    with bd_connection(cfg) as conn:
+        refresh_mart(conn)
+    logger.info("Инкрементальное обновление витрины окончено")
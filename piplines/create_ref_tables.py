@@ -3,12 +3,16 @@ from etl.extract import extract_data
 from etl.config import load_cfg, validate_cfg
 import pandas as pd
 from etl.transform import transform, normalize_reference_from_key
-from etl.load import load_data, get_bd_connection
+from etl.load import load_data, bd_connection
+from etl.checkpoint import complete_checkpoints
+from etl.metrics import stage
+from etl.profiling import profiling
 
 
 logger = get_stage_logger("pipline")
 
-def create_ref_tables_con():
+def create_ref_tables_con(profile: bool = False):
+    '''profile - профилировать этапы, отчеты в logs/profile_refs_countries_*'''
     setup_logging()
     logger.info("Запуск пайплайна для создания/обновления справочных таблиц для стран")
 
@@ -16,41 +20,70 @@ def create_ref_tables_con():
     cfg = load_cfg("configs/config_ref_tables_countries.json")
     # По сути валидация не обязательна
     cfg = validate_cfg(cfg)
-    data = extract_data(cfg)
-    df = pd.json_normalize(data)
-
-    # Страны содержат столицы, агрегированные регионы нет
-    df_c = df[df["capitalCity"] != ""]
-    df_region = normalize_reference_from_key(df_c, "region")
-    df_adminregion = normalize_reference_from_key(df_c, "adminregion")
-    df_income_level= normalize_reference_from_key(df_c, "incomeLevel")
-    df_lending_type = normalize_reference_from_key(df_c, "lendingType")
-    df_country = normalize_reference_from_key(df_c, "country")
-    # Однако можно делать запрос с использованием кода агрегированного региона и использовать
-    # возможно данные использовать дальше
-    df_r = df[df["capitalCity"] == ""]
-    df_agr_region = normalize_reference_from_key(df_r[["id", "iso2Code", "name"]], "")
-
-    conn = get_bd_connection(cfg)
-    load_data(conn, "region", df_region)
-    load_data(conn, "adminregion", df_adminregion)
-    load_data(conn, "income_level", df_income_level)
-    load_data(conn, "lending_type", df_lending_type)
-    load_data(conn, "country", df_country)
+    with profiling(profile, "refs_countries"):
+        tables = extract_country_tables(cfg)
+
+        with stage("load"), bd_connection(cfg) as conn:
+            # Порядок важен - country ссылается на остальные справочники
+            for name, df_ref in tables.items():
+                load_data(conn, name, df_ref)
+    complete_checkpoints()
+    if cfg["export_dir"]:
+        from etl.export import export_reference
+        export_reference(tables, cfg["export_dir"])
     logger.info("Пайплайн - Создание/ обновление справочных таблиц для стран окончено")
 
-def create_ref_tables_ind():
+def create_ref_tables_ind(profile: bool = False):
+    '''profile - профилировать этапы, отчеты в logs/profile_refs_indicators_*'''
     setup_logging()
     cfg = load_cfg("configs/config_ref_tables_indicators.json")
     logger.info("ПЗапуск пайплайна для создания/обновления справочных таблиц для индикаторов")
     #-------------------Indicators-------------------
     # По сути валидация не обязательна
     cfg = validate_cfg(cfg)
-    data = extract_data(cfg)
-    df = pd.json_normalize(data)
-    df_indicator = normalize_reference_from_key(df, "indicator")
-    df_source = normalize_reference_from_key(df, "source")
-    conn = get_bd_connection(cfg)
-    load_data(conn, "source", df_source)
-    load_data(conn, "indicator", df_indicator)
+    with profiling(profile, "refs_indicators"):
+        tables = extract_indicator_tables(cfg)
+        with stage("load"), bd_connection(cfg) as conn:
+            for name, df_ref in tables.items():
+                load_data(conn, name, df_ref)
+    complete_checkpoints()
+    if cfg["export_dir"]:
+        from etl.export import export_reference
+        export_reference(tables, cfg["export_dir"])
     logger.info("Пайплайн - Создание/ обновление справочных таблиц для индикаторов окончено")
+
+def extract_country_tables(cfg: dict) -> dict:
+    '''
+    Выгрузка стран и разбор на справочники. Словарь {таблица: df} в порядке загрузки (country последней)
+    '''
+    with stage("extract"):
+        data = extract_data(cfg)
+    with stage("transform"):
+        df = pd.json_normalize(data)
+
+        # Страны содержат столицы, агрегированные регионы нет
+        df_c = df[df["capitalCity"] != ""]
+        # Однако можно делать запрос с использованием кода агрегированного региона и использовать
+        # возможно данные использовать дальше
+        df_r = df[df["capitalCity"] == ""]
+        df_agr_region = normalize_reference_from_key(df_r[["id", "iso2Code", "name"]], "")
+        return {
+            "region": normalize_reference_from_key(df_c, "region"),
+            "adminregion": normalize_reference_from_key(df_c, "adminregion"),
+            "income_level": normalize_reference_from_key(df_c, "incomeLevel"),
+            "lending_type": normalize_reference_from_key(df_c, "lendingType"),
+            "country": normalize_reference_from_key(df_c, "country")
+        }
+
+def extract_indicator_tables(cfg: dict) -> dict:
+    '''
+    Выгрузка индикаторов и разбор на справочники source и indicator (indicator ссылается на source)
+    '''
+    with stage("extract"):
+        data = extract_data(cfg)
+    with stage("transform"):
+        df = pd.json_normalize(data)
+        return {
+            "source": normalize_reference_from_key(df, "source"),
+            "indicator": normalize_reference_from_key(df, "indicator")
+        }
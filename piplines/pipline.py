@@ -1,24 +1,124 @@
 from etl.logger import setup_logging, get_stage_logger
-from etl.extract import extract_data
+from etl.extract import extract_data, extract_incremental, iter_extract_data
 from etl.config import load_cfg, validate_cfg
-import pandas as pd
-import logging
+import sys
 from etl.transform import transform
-from etl.load import load_data, get_bd_connection
+from etl.load import load_main_table, bd_connection
+from etl.checkpoint import complete_checkpoints
+from etl.metrics import reset_metrics, stage, write_metrics
+from etl.profiling import profiling
+from etl.watermark import update_watermarks
 
 logger = get_stage_logger("pipline")
 
-def run_pipline():
+def run_pipline(profile: bool = False):
+    '''profile - профилировать этапы (cProfile + tracemalloc), отчеты в logs/profile_run_*'''
     setup_logging()
     logger.info("Запуск ETL пайплайна")
+    reset_metrics()
+    # Метрики по этапам пишем в logs/ в любом случае, в том числе если запуск упал
+    try:
+        with profiling(profile, "run"):
+            run_pipline_stages()
+    finally:
+        write_metrics()
 
+def run_pipline_stages():
     cfg = load_cfg("configs/config.json")
     cfg = validate_cfg(cfg)
-    data = extract_data(cfg)
-    df = transform(data)
-    conn = get_bd_connection(cfg)
-
-    load_data(conn, "main_table", df)
+    if cfg["incremental"] and cfg["countries"] and cfg["indicators"] and cfg["indicators"] != ["all"]:
+        run_incremental(cfg)
+        return
+    if cfg["streaming"]:
+        run_streaming(cfg)
+        return
+    with stage("extract"):
+        data = extract_data(cfg)
+    with stage("transform"):
+        df = transform(data)
+    with stage("load"), bd_connection(cfg) as conn:
+        load_main_table(conn, df, partitioning=cfg["partitioning"])
+    complete_checkpoints()
+    export_stage(cfg, df)
     logger.info("ETL пайплайн завершен")
     print(df)
-    conn.close()
\ No newline at end of file
+
+def run_streaming(cfg: dict):
+    '''
+    Потоковый вариант пайплайна: страницы из API копим только до chunk_size строк,
+    затем нормализуем и загружаем этот кусок в БД и освобождаем память.
+    Пиковая память определяется chunk_size, а не объемом всей выгрузки.
+    Контрольные точки здесь не пишутся - упавший запуск начинается заново
+    '''
+    chunk_size = cfg["chunk_size"]
+    buffer = []
+    total_rows = 0
+    chunks = 0
+
+    def flush(conn):
+        nonlocal total_rows, chunks
+        with stage("transform"):
+            df = transform(buffer)
+        with stage("load"):
+            load_main_table(conn, df, partitioning=cfg["partitioning"])
+        export_stage(cfg, df)
+        total_rows += len(df)
+        chunks += 1
+        logger.info(f"Загружен кусок {chunks}: {len(df)} строк, всего {total_rows}")
+        buffer.clear()
+
+    with bd_connection(cfg) as conn:
+        pages = iter_extract_data(cfg)
+        while True:
+            # Время extract в потоковом режиме - только ожидание очередной страницы
+            with stage("extract"):
+                data_list = next(pages, None)
+            if data_list is None:
+                break
+            buffer.extend(data_list)
+            if len(buffer) >= chunk_size:
+                flush(conn)
+        if buffer:
+            flush(conn)
+
+    if not chunks:
+        logger.info(f"Пусто!!! {cfg}")
+        sys.exit("Не получено данных для данного набора параметров. ОСТАНОВКА!!!")
+    logger.info(f"Потоковый ETL пайплайн завершен, {chunks} кусков, {total_rows} строк")
+
+def run_incremental(cfg: dict):
+    '''
+    Инкрементальный вариант пайплайна: качаем только изменившиеся серии и недостающие годы,
+    после загрузки сдвигаем водяные знаки. Для indicators = ["all"] и пустых списков стран/индикаторов
+    режим не имеет смысла - там run_pipline работает как обычно
+    '''
+    with bd_connection(cfg) as conn:
+        with stage("extract"):
+            data, tasks = extract_incremental(cfg, conn)
+        if not data:
+            # Годы запрашивали, но данных за них еще нет - отмечаем это, чтобы не спрашивать повторно,
+            # пока у индикатора не поменяется lastupdated
+            logger.info("Новых или обновленных данных нет, загружать нечего")
+            update_watermarks(conn, tasks, None)
+            complete_checkpoints()
+            return
+        with stage("transform"):
+            df = transform(data)
+        with stage("load"):
+            load_main_table(conn, df, partitioning=cfg["partitioning"])
+            update_watermarks(conn, tasks, df)
+    complete_checkpoints()
+    export_stage(cfg, df)
+    logger.info("Инкрементальный ETL пайплайн завершен")
+
+def export_stage(cfg: dict, df):
+    '''
+    Если в конфиге задан export_dir - дописываем загруженные наблюдения в локальный Parquet-датасет
+    для аналитики (см. etl/export.py, чтение - read_observations)
+    '''
+    if not cfg["export_dir"]:
+        return
+    # pyarrow нужен только для экспорта, поэтому импортируем здесь
+    from etl.export import export_observations
+    with stage("export"):
+        export_observations(df, cfg["export_dir"])
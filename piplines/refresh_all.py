@@ -0,0 +1,77 @@
+from etl.logger import setup_logging, get_stage_logger
+from etl.config import load_cfg, validate_cfg
+from etl.extract import extract_data
+from etl.transform import transform
+from etl.load import load_data, load_main_table, bd_connection
+from etl.checkpoint import complete_checkpoints
+from etl.metrics import reset_metrics, write_metrics
+from etl.scheduler import run_dag
+from piplines.create_ref_tables import extract_country_tables, extract_indicator_tables
+from piplines.pipline import export_stage
+
+logger = get_stage_logger("pipline")
+
+# Справочники и их внешние ключи: таблица грузится только после тех, на которые она ссылается
+REF_DEPENDENCIES = {
+    "region": [],
+    "adminregion": [],
+    "income_level": [],
+    "lending_type": [],
+    "country": ["region", "adminregion", "income_level", "lending_type"],
+    "source": [],
+    "indicator": ["source"],
+}
+COUNTRY_TABLES = ["region", "adminregion", "income_level", "lending_type", "country"]
+
+def refresh_all():
+    '''
+    Полное обновление за один запуск: справочники стран и индикаторов и main_table.
+    Шаги собраны в граф по внешним ключам (region, adminregion, income_level, lending_type -> country,
+    source -> indicator, country + indicator -> main_table) и выполняются планировщиком run_dag:
+    три выгрузки из API идут параллельно, каждая таблица грузится как только готовы ее данные и справочники,
+    на которые она ссылается. Каждая загрузка берет свое соединение из пула, поэтому потоков
+    не больше db_pool_size
+    '''
+    setup_logging()
+    logger.info("Запуск полного обновления: справочники и main_table")
+    reset_metrics()
+    try:
+        cfg = validate_cfg(load_cfg("configs/config.json"))
+        con_cfg = validate_cfg(load_cfg("configs/config_ref_tables_countries.json"))
+        ind_cfg = validate_cfg(load_cfg("configs/config_ref_tables_indicators.json"))
+
+        def extract_main(results):
+            return transform(extract_data(cfg))
+
+        def load_main(results):
+            with bd_connection(cfg) as conn:
+                load_main_table(conn, results["extract_main"], partitioning=cfg["partitioning"])
+
+        tasks = {
+            "extract_countries": (lambda results: extract_country_tables(con_cfg), []),
+            "extract_indicators": (lambda results: extract_indicator_tables(ind_cfg), []),
+            "extract_main": (extract_main, []),
+            "load_main_table": (load_main, ["extract_main", "load_country", "load_indicator"]),
+        }
+        for table, deps in REF_DEPENDENCIES.items():
+            extract_task = "extract_countries" if table in COUNTRY_TABLES else "extract_indicators"
+            tasks[f"load_{table}"] = (load_reference_task(cfg, extract_task, table),
+                                      [extract_task] + [f"load_{dep}" for dep in deps])
+
+        results = run_dag(tasks, cfg["db_pool_size"])
+        complete_checkpoints()
+
+        for ref_cfg, extract_task in ((con_cfg, "extract_countries"), (ind_cfg, "extract_indicators")):
+            if ref_cfg["export_dir"]:
+                from etl.export import export_reference
+                export_reference(results[extract_task], ref_cfg["export_dir"])
+        export_stage(cfg, results["extract_main"])
+        logger.info("Полное обновление окончено")
+    finally:
+        write_metrics()
+
+def load_reference_task(cfg: dict, extract_task: str, table: str):
+    def load(results):
+        with bd_connection(cfg) as conn:
+            load_data(conn, table, results[extract_task][table])
+    return load
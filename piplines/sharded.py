@@ -0,0 +1,201 @@
+import multiprocessing
+import os
+import time
+
+import psycopg2
+from psycopg2 import sql
+
+from etl.logger import setup_logging, get_stage_logger
+from etl.config import load_cfg, validate_cfg
+from etl.extract import fetch_all
+from etl.planner import plan_requests, to_request_cfg, log_plan
+from etl.transform import transform
+from etl.load import (get_bd_connection, ensure_main_table, ensure_change_feed, ensure_partitions,
+                      ensure_surrogate_key, get_partitioning, load_main_table, MAIN_TABLE, PARTITION_YEARS, SURROGATE_KEYS)
+from etl.checkpoint import complete_checkpoints
+from etl.rollup import ensure_rollup_tables
+from etl.metrics import inc, reset_metrics, metrics_summary, stage, write_metrics
+from etl.watermark import get_year_range
+
+logger = get_stage_logger("pipline")
+
+def make_shards(cfg: dict) -> list[dict]:
+    '''
+    Режем пространство (страны x индикаторы x годы) на независимые куски: пункты плана запросов
+    (индикаторы одного источника x кусок списка стран), каждый еще и по диапазонам лет в shard_years лет.
+    Шарды не пересекаются по ключу (страна, индикатор, год), поэтому их можно грузить параллельно
+    '''
+    plan = plan_requests(cfg)
+    log_plan(plan)
+    first, last = get_year_range(cfg["date_interval"])
+    shards = []
+    for item in plan:
+        for start in range(first, last + 1, cfg["shard_years"]):
+            end = min(start + cfg["shard_years"] - 1, last)
+            shards.append(dict(item, date_interval=[f"{start}:{end}"], shard_id=len(shards)))
+    return shards
+
+def init_worker():
+    setup_logging()
+
+def run_shard(args: tuple) -> dict:
+    '''
+    Один шард целиком в отдельном процессе: extract -> transform -> load со своим соединением к БД.
+    Ошибку не пробрасываем, а возвращаем - остальные шарды доделываются, упавшие видно в итоговой проверке.
+    Вместе с результатом отдаем счетчики метрик процесса, родитель их суммирует
+    '''
+    cfg, shard = args
+    reset_metrics()
+    started = time.perf_counter()
+    result = {"shard_id": shard["shard_id"], "indicators": shard["indicators"], "countries": shard["countries"],
+              "date_interval": shard["date_interval"], "rows": 0, "changed": 0, "error": None}
+    try:
+        shard_cfg = dict(cfg, date_interval=shard["date_interval"])
+        data = fetch_all([to_request_cfg(shard_cfg, shard)], 1)
+        if data:
+            df = transform(data)
+            result["rows"] = len(df)
+            result["changed"] = load_shard(cfg, df)
+        # Шард в БД - его контрольные точки (они в этом процессе) больше не нужны
+        complete_checkpoints()
+    except Exception as e:
+        logger.info(f"Шард {shard['shard_id']} упал: {e!r}")
+        result["error"] = repr(e)
+    result["seconds"] = round(time.perf_counter() - started, 3)
+    result["counters"] = metrics_summary()["counters"]
+    return result
+
+def load_shard(cfg: dict, df) -> int:
+    '''
+    Загрузка шарда своим соединением. Шарды по одной серии (страна, индикатор), но разным годам
+    одновременно обновляют одну строку журнала изменений - на взаимоблокировку просто повторяем
+    '''
+    conn = get_bd_connection(cfg)
+    try:
+        for i in range(1, cfg["db_retries"] + 1):
+            try:
+                return len(load_main_table(conn, df, partitioning=cfg["partitioning"]))
+            except (psycopg2.errors.DeadlockDetected, psycopg2.errors.SerializationFailure) as e:
+                conn.rollback()
+                logger.info(f"Конфликт транзакций при загрузке шарда (попытка {i}/{cfg['db_retries']}): {e}")
+                if i == cfg["db_retries"]:
+                    raise
+                time.sleep(i)
+    finally:
+        conn.close()
+
+def prepare_database(cfg: dict):
+    '''
+    DDL один раз в родительском процессе до запуска шардов - CREATE/ALTER ... IF NOT EXISTS
+    из нескольких процессов одновременно падают на гонке в системном каталоге.
+    При секционировании по годам сразу создаем секции под весь диапазон лет
+    '''
+    conn = get_bd_connection(cfg)
+    try:
+        ensure_main_table(conn, partitioning=cfg["partitioning"])
+        ensure_change_feed(conn)
+        ensure_rollup_tables(conn)
+        for ref_table in SURROGATE_KEYS:
+            ensure_surrogate_key(conn, ref_table)
+        # Секции - под фактическое секционирование таблицы, конфиг действует только на новую таблицу
+        if get_partitioning(conn) == "decade":
+            first, last = get_year_range(cfg["date_interval"])
+            decades = range(first // PARTITION_YEARS * PARTITION_YEARS, last + 1, PARTITION_YEARS)
+            ensure_partitions(conn, "decade", list(decades))
+    finally:
+        conn.close()
+
+def verify_shards(cfg: dict, results: list[dict]) -> list[str]:
+    '''
+    Итоговая проверка: все шарды отработали, и по каждому шарду в main_table строк не меньше,
+    чем он получил из API. Шарды не пересекаются по ключу (страна, индикатор, год), поэтому строки считаем
+    по ключам самого шарда (его индикаторы, страны и годы): недостача одного шарда не прячется за лишними
+    строками другого, как при сравнении общих сумм. Возвращает список проблем
+    '''
+    problems = [f"шард {r['shard_id']} ({';'.join(r['indicators'])}, {r['date_interval'][0]}): {r['error']}"
+                for r in results if r["error"]]
+    done = [r for r in results if r["error"] is None and r["rows"]]
+    if not done:
+        return problems
+
+    # Шард раскладываем на строки (шард, индикатор, годы, страны), страны - через ";" (NULL - все страны)
+    shard_ids, indicators, first_years, last_years, countries = [], [], [], [], []
+    for r in done:
+        first, last = get_year_range(r["date_interval"])
+        for indicator in r["indicators"]:
+            shard_ids.append(r["shard_id"])
+            indicators.append(indicator)
+            first_years.append(first)
+            last_years.append(last)
+            countries.append(None if r["countries"] == ["all"] else ";".join(r["countries"]))
+    conn = get_bd_connection(cfg)
+    try:
+        with conn.cursor() as cur:
+            cur.execute(sql.SQL("""
+            SELECT s.shard_id, count(*)
+            FROM unnest(%s::integer[], %s::text[], %s::smallint[], %s::smallint[], %s::text[])
+                AS s(shard_id, indicator_id, first_year, last_year, countries)
+            JOIN {indicator} AS i ON i.id = s.indicator_id
+            JOIN {main} AS m ON m.indicator_sk = i.sk AND m.year BETWEEN s.first_year AND s.last_year
+            JOIN {country} AS c ON c.sk = m.country_sk
+            WHERE s.countries IS NULL OR c.id = ANY(string_to_array(s.countries, ';'))
+            GROUP BY s.shard_id;
+            """).format(
+                main=sql.Identifier(MAIN_TABLE),
+                country=sql.Identifier("country"),
+                indicator=sql.Identifier("indicator")
+            ), [shard_ids, indicators, first_years, last_years, countries])
+            loaded = dict(cur.fetchall())
+    finally:
+        conn.close()
+
+    for r in done:
+        if loaded.get(r["shard_id"], 0) < r["rows"]:
+            problems.append(f"шард {r['shard_id']} ({';'.join(r['indicators'])}, {r['date_interval'][0]}): "
+                            f"в {MAIN_TABLE} {loaded.get(r['shard_id'], 0)} строк, а из API пришло {r['rows']}")
+    logger.info(f"Проверка: из API {sum(r['rows'] for r in done)} строк, "
+                f"в {MAIN_TABLE} по ключам шардов {sum(loaded.values())}")
+    return problems
+
+def run_sharded(cfg_path: str = "configs/config.json"):
+    '''
+    Параллельная выгрузка больших объемов (например countries = ["all"] по многим индикаторам):
+    шарды (см. make_shards) раздаются процессам из общей очереди - освободившийся процесс берет следующий.
+    Каждый процесс сам ходит в API, разбирает JSON, нормализует и грузит в БД, поэтому
+    пропускная способность растет с числом ядер (processes в конфиге, 0 - по числу ядер).
+    В конце сверяем результат с БД и перечисляем упавшие шарды. Контрольные точки успешных шардов
+    снимаются сразу, упавших - остаются, и повторный запуск докачает только недостающие страницы
+    '''
+    setup_logging()
+    logger.info("Запуск шардированного ETL пайплайна")
+    reset_metrics()
+    try:
+        cfg = validate_cfg(load_cfg(cfg_path))
+        processes = cfg["processes"] or os.cpu_count() or 1
+        # rate limiter у каждого процесса свой - делим общий лимит запросов к API между ними
+        cfg["rate_limit"] = cfg["rate_limit"] / processes
+        shards = make_shards(cfg)
+        with stage("prepare"):
+            prepare_database(cfg)
+        logger.info(f"Шардов {len(shards)}, процессов {processes}")
+
+        results = []
+        # spawn - чистые процессы без унаследованных потоков, сессий и соединений родителя
+        context = multiprocessing.get_context("spawn")
+        with stage("shards"), context.Pool(processes, initializer=init_worker) as workers:
+            for result in workers.imap_unordered(run_shard, [(cfg, shard) for shard in shards], chunksize=1):
+                results.append(result)
+                for counter in result["counters"]:
+                    inc(counter["name"], counter["value"], **counter["labels"])
+                logger.info(f"Шард {result['shard_id']} готов ({len(results)}/{len(shards)}): "
+                            f"{result['rows']} строк, изменено {result['changed']}, {result['seconds']} сек")
+
+        with stage("verify"):
+            problems = verify_shards(cfg, results)
+        if problems:
+            for problem in problems:
+                logger.info(f"Проблема: {problem}")
+            raise RuntimeError(f"Шардированная загрузка завершилась с ошибками: {len(problems)}")
+        logger.info(f"Шардированный ETL пайплайн завершен, {sum(r['rows'] for r in results)} строк")
+    finally:
+        write_metrics()
@@ -0,0 +1,82 @@
+'''
+Расчет витрины в NumPy (etl.mart.compute_mart) против семантики mv_main_table_proc из vew_preaparation.sql.
+Ожидаемые значения посчитаны вручную по правилам SQL-версии, БД не нужна:
+    python -m pytest tests
+'''
+
+import numpy as np
+import pandas as pd
+
+from etl.mart import CHECK_COLUMNS, MART_COLUMNS, compute_mart
+
+nan = np.nan
+
+def make_source(series: dict) -> pd.DataFrame:
+    '''{(country_sk, indicator_sk): (первый год, [значения])} -> строки как из read_mart_source'''
+    rows = []
+    for (country_sk, indicator_sk), (first_year, values) in series.items():
+        for offset, value in enumerate(values):
+            rows.append({
+                "country_sk": country_sk, "indicator_sk": indicator_sk,
+                "country_id": f"C{country_sk}", "country_name": f"Country {country_sk}",
+                "indicator_id": f"I{indicator_sk}", "indicator_name": f"Indicator {indicator_sk}",
+                "value": value,
+                "region_id": "R", "region_name": "Region", "income_level_id": "L", "income_level_name": "Level",
+                "year": first_year + offset,
+            })
+    # Порядок строк на входе не важен - compute_mart сортирует сам
+    return pd.DataFrame(rows).sample(frac=1, random_state=0).reset_index(drop=True)
+
+def column(mart: pd.DataFrame, country_sk: int, indicator_sk: int, name: str) -> np.ndarray:
+    rows = mart[(mart["country_sk"] == country_sk) & (mart["indicator_sk"] == indicator_sk)]
+    return pd.to_numeric(rows[name], errors="coerce").to_numpy(dtype=np.float64)
+
+def assert_column(mart, country_sk, indicator_sk, name, expected):
+    np.testing.assert_allclose(column(mart, country_sk, indicator_sk, name), expected, rtol=1e-12, equal_nan=True)
+
+MART = compute_mart(make_source({
+    # Идет первой: ее последнее значение не должно попасть в prev/LAG/окно следующей серии
+    (1, 1): (2000, [0.0, 2.0, 4.0]),
+    # Ведущий и хвостовой NULL, одиночный пропуск и пропуск в две строки
+    (1, 2): (2000, [nan, 1.0, nan, 3.0, nan, nan, 6.0, nan]),
+    # Больше пяти значений подряд - окно vol_5 должно отбрасывать старые строки
+    (2, 1): (2000, [1.0, 2.0, 3.0, 4.0, 5.0, 6.0, 100.0]),
+}))
+
+def test_columns_and_order():
+    assert list(MART.columns) == [col for col, _ in MART_COLUMNS]
+    assert len(MART) == 18
+    assert MART[["country_sk", "indicator_sk", "year"]].equals(
+        MART[["country_sk", "indicator_sk", "year"]].sort_values(["country_sk", "indicator_sk", "year"])
+    )
+
+def test_neighbours_stop_at_series_boundary():
+    assert_column(MART, 1, 2, "prev_value", [nan, nan, 1.0, nan, 3.0, nan, nan, 6.0])
+    assert_column(MART, 1, 2, "prev_year", [nan, nan, 2001, nan, 2003, nan, nan, 2006])
+    assert_column(MART, 1, 2, "next_value", [1.0, nan, 3.0, nan, nan, 6.0, nan, nan])
+    assert_column(MART, 1, 2, "next_year", [2001, nan, 2003, nan, nan, 2006, nan, nan])
+    assert_column(MART, 1, 1, "next_value", [2.0, 4.0, nan])
+
+def test_value_filled_interpolates_single_gaps_only():
+    # LAST_VALUE/FIRST_VALUE без IGNORE NULLS видят только соседнюю строку: пропуск в две строки остается NULL,
+    # ведущий и хвостовой NULL не заполняются
+    assert_column(MART, 1, 2, "value_filled", [nan, 1.0, 2.0, 3.0, nan, nan, 6.0, nan])
+
+def test_del_val_and_prcnt_del():
+    assert_column(MART, 1, 2, "del_val", [nan, nan, 1.0, 1.0, nan, nan, nan, nan])
+    assert_column(MART, 1, 2, "prcnt_del", [nan, nan, 1.0, 0.5, nan, nan, nan, nan])
+    # Предыдущее значение 0 - NULLIF(..., 0) дает NULL, а не inf
+    assert_column(MART, 1, 1, "del_val", [nan, 2.0, 2.0])
+    assert_column(MART, 1, 1, "prcnt_del", [nan, nan, 1.0])
+
+def test_vol_5_window():
+    # STDDEV (выборочное) по исходному value в окне ROWS BETWEEN 4 PRECEDING AND CURRENT ROW, NULL при < 2 значений
+    sqrt2, sqrt45 = np.sqrt(2.0), np.sqrt(4.5)
+    assert_column(MART, 1, 2, "vol_5", [nan, nan, nan, sqrt2, sqrt2, sqrt2, sqrt45, sqrt45])
+    assert_column(MART, 1, 1, "vol_5", [nan, sqrt2, 2.0])
+    values = [1.0, 2.0, 3.0, 4.0, 5.0, 6.0, 100.0]
+    expected = [nan] + [np.std(values[max(0, i - 4):i + 1], ddof=1) for i in range(1, len(values))]
+    assert_column(MART, 2, 1, "vol_5", expected)
+
+def test_check_columns_are_computed():
+    assert set(CHECK_COLUMNS) <= set(MART.columns)
@@ -0,0 +1,48 @@
+'''
+Хэш содержимого строки (etl.transform.row_hashes): по нему загрузка отсеивает неизменившиеся строки,
+поэтому он не должен зависеть от dtype и вида пропусков и должен меняться при изменении value, obs_status, unit.
+БД не нужна:
+    python -m pytest tests
+'''
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from etl.transform import row_hashes
+
+BASE = pd.DataFrame({
+    "value": [1.5, np.nan, 3.0, 0.0],
+    "obs_status": pd.Series(["E", None, None, "F"], dtype=object),
+    "unit": pd.Series([None, "USD", None, "USD"], dtype=object),
+})
+HASHES = row_hashes(BASE)
+
+@pytest.mark.parametrize("variant", [
+    # Пропуски как NaN вместо None
+    BASE.assign(obs_status=pd.Series(["E", np.nan, np.nan, "F"], dtype=object),
+                unit=pd.Series([np.nan, "USD", np.nan, "USD"], dtype=object)),
+    # Категориальные obs_status/unit
+    BASE.assign(obs_status=BASE["obs_status"].astype("category"), unit=BASE["unit"].astype("category")),
+    BASE.assign(obs_status=BASE["obs_status"].astype("string"), unit=BASE["unit"].astype("string")),
+    # value как object с None и как nullable Float64
+    BASE.assign(value=pd.Series([1.5, None, 3.0, 0.0], dtype=object)),
+    BASE.assign(value=pd.array([1.5, None, 3.0, 0.0], dtype="Float64")),
+    # Лишние столбцы и другой индекс на хэш не влияют
+    BASE.assign(country_id="RUS", date=2020).set_index(pd.Index([10, 11, 12, 13])),
+], ids=["nan", "category", "string", "object_value", "nullable_value", "extra_columns"])
+def test_hash_is_stable_across_representations(variant):
+    np.testing.assert_array_equal(row_hashes(variant), HASHES)
+
+def test_hash_is_stable_between_calls():
+    np.testing.assert_array_equal(row_hashes(BASE.copy()), HASHES)
+    assert row_hashes(BASE).dtype == np.int64
+
+@pytest.mark.parametrize("column, values", [
+    ("value", [1.25, 0.0, 2.0, np.nan]),
+    ("obs_status", ["F", "E", "", None]),
+    ("unit", ["USD", None, "EUR", None]),
+])
+def test_hash_changes_with_content(column, values):
+    changed = BASE.assign(**{column: pd.Series(values, dtype=BASE[column].dtype)})
+    assert (row_hashes(changed) != HASHES).all()
@@ -0,0 +1,68 @@
+'''
+Докачка по водяным знакам (etl.watermark): загруженное покрытие серии - один отрезок [first, last],
+поэтому докачка должна оставлять его без дыр. БД и API не нужны:
+    python -m pytest tests
+'''
+
+import pytest
+
+from etl import watermark
+from etl.config import DEFAULT_CFG
+from etl.watermark import missing_ranges, plan_incremental
+
+def covered(start, end, first, last) -> set:
+    years = set(range(first, last + 1))
+    for range_start, range_end in missing_ranges(start, end, first, last):
+        years.update(range(range_start, range_end + 1))
+    return years
+
+@pytest.mark.parametrize("start, end, first, last, expected", [
+    # Внутри загруженного - качать нечего
+    (1992, 1998, 1990, 2000, []),
+    (1990, 2000, 1990, 2000, []),
+    # Примыкает справа и слева
+    (2001, 2005, 1990, 2000, [(2001, 2005)]),
+    (1980, 1989, 1990, 2000, [(1980, 1989)]),
+    # Перекрывается
+    (1995, 2005, 1990, 2000, [(2001, 2005)]),
+    (1985, 1995, 1990, 2000, [(1985, 1989)]),
+    (1985, 2005, 1990, 2000, [(1985, 1989), (2001, 2005)]),
+    # Не примыкает - разрыв качается вместе с запрошенным
+    (2020, 2024, 1990, 2000, [(2001, 2024)]),
+    (1960, 1970, 1990, 2000, [(1960, 1989)]),
+])
+def test_missing_ranges(start, end, first, last, expected):
+    assert missing_ranges(start, end, first, last) == expected
+
+@pytest.mark.parametrize("start, end", [(2020, 2024), (1960, 1970), (1995, 2005), (1992, 1998), (2001, 2003)])
+def test_coverage_stays_contiguous(start, end):
+    first, last = 1990, 2000
+    assert covered(start, end, first, last) == set(range(min(start, first), max(end, last) + 1))
+
+def plan(monkeypatch, date_interval, watermarks, last_updated = "2024-01-01"):
+    monkeypatch.setattr(watermark, "get_watermarks", lambda conn, indicators: watermarks)
+    monkeypatch.setattr(watermark, "probe_last_updated",
+                        lambda raw_cfg, indicators: {indicator: last_updated for indicator in indicators})
+    cfg = dict(DEFAULT_CFG, countries=["RUS", "CHN"], indicators=["NY.GDP.PCAP.CD"], date_interval=date_interval)
+    return plan_incremental(cfg, conn=None)
+
+def test_plan_disjoint_range_records_what_was_fetched(monkeypatch):
+    tasks = plan(monkeypatch, ["2020:2024"], {
+        ("RUS", "NY.GDP.PCAP.CD"): (1990, 2000, "2024-01-01"),
+        ("CHN", "NY.GDP.PCAP.CD"): (1990, 2000, "2024-01-01"),
+    })
+    assert len(tasks) == 1
+    task = tasks[0]
+    assert sorted(task["countries"]) == ["CHN", "RUS"]
+    assert task["date_interval"] == ["2001:2024"]
+    assert (task["first_year"], task["last_year"]) == (1990, 2024)
+
+def test_plan_skips_covered_and_refetches_updated(monkeypatch):
+    watermarks = {
+        ("RUS", "NY.GDP.PCAP.CD"): (1990, 2024, "2024-01-01"),
+        # API обновил индикатор после загрузки - серию качаем заново целиком
+        ("CHN", "NY.GDP.PCAP.CD"): (1990, 2024, "2023-01-01"),
+    }
+    tasks = plan(monkeypatch, ["2000:2010"], watermarks)
+    assert [(task["countries"], task["date_interval"]) for task in tasks] == [(["CHN"], ["2000:2010"])]
+    assert (tasks[0]["first_year"], tasks[0]["last_year"]) == (2000, 2010)
@@ -2,25 +2,25 @@
 
 CREATE MATERIALIZED VIEW mv_main_table_proc AS
 WITH template AS (
-  SELECT m.country_id
+  -- main_table хранит суррогатные ключи и типизированные year/value - приведения типов больше не нужны
+  SELECT m.country_sk
+    , m.indicator_sk
+    , c.id AS country_id
     , c.name AS country_name
-    , m.indicator_id
+    , i.id AS indicator_id
     , i.name AS indicator_name
-    , CASE
-      WHEN m.value = 'N/F' THEN NULL
-      ELSE m.value::numeric
-    END AS value
+    , m.value
     , c.region_id 
     , r.region_value AS region_name
     , c.income_level_id 
     , il.income_level_value AS income_level_name
-    , m.date::int AS year
-    , MAKE_DATE(m.date::int, 1, 1) AS year_dt
-    , (m.date::int / 10) * 10 AS decade
+    , m.year
+    , MAKE_DATE(m.year, 1, 1) AS year_dt
+    , (m.year / 10) * 10 AS decade
   
   FROM public.main_table AS m
-  LEFT JOIN public.country AS c ON c.id = m.country_id
-  LEFT JOIN public.indicator AS i ON i.id = m.indicator_id
+  LEFT JOIN public.country AS c ON c.sk = m.country_sk
+  LEFT JOIN public.indicator AS i ON i.sk = m.indicator_sk
   LEFT JOIN public.income_level AS il ON c.income_level_id = il.income_level_id
   LEFT JOIN public.region AS r ON c.region_id = r.region_id
 ), 
@@ -34,12 +34,12 @@ interpolation_preparation AS (
     , FIRST_VALUE(CASE WHEN value IS NOT NULL THEN year END) OVER search_next_notnull AS next_year
   FROM template
   WINDOW search_prev_notnull AS (
-    PARTITION BY country_id, indicator_id
+    PARTITION BY country_sk, indicator_sk
     ORDER BY year
     ROWS BETWEEN UNBOUNDED PRECEDING AND 1 PRECEDING
   ),
   search_next_notnull AS (
-    PARTITION BY country_id, indicator_id
+    PARTITION BY country_sk, indicator_sk
     ORDER BY year
     ROWS BETWEEN 1 FOLLOWING AND UNBOUNDED FOLLOWING
   )
@@ -61,13 +61,13 @@ calculation AS (
     , value_filled - LAG(value_filled) OVER search_next AS del_val
     , (value_filled - LAG(value_filled) OVER search_next) / NULLIF(LAG(value_filled) OVER search_next, 0) AS prcnt_del
     , STDDEV(value) OVER (
-      PARTITION BY country_id, indicator_id
+      PARTITION BY country_sk, indicator_sk
       ORDER BY year
       ROWS BETWEEN 4 PRECEDING AND CURRENT ROW
       ) AS vol_5
   FROM template_interpolation
   WINDOW search_next AS (
-    PARTITION BY country_id, indicator_id
+    PARTITION BY country_sk, indicator_sk
     ORDER BY year
   )
 )
@@ -137,3 +137,44 @@ SELECT country_id
   ) AS countries_in_year
 FROM mv_main_table_proc
 WHERE value IS NOT NULL;
+
+-- Предагрегаты, которые ETL обновляет при каждой загрузке (etl/rollup.py): дашбордам не нужно
+-- сканировать витрину. region_id / income_level_id = '*' - по всем регионам / уровням дохода,
+-- income_level_id = '' - страны без уровня дохода. Считаются только по странам (без агрегатов WB вроде WLD, EAS)
+-- и по наблюдаемым value (без интерполяции), поэтому с v_global / v_region по value_filled совпадают не везде
+CREATE OR REPLACE VIEW v_rollup_year AS
+SELECT i.id AS indicator_id
+    , i.name AS indicator_name
+    , ry.region_id
+    , r.region_value AS region_name
+    , ry.income_level_id
+    , il.income_level_value AS income_level_name
+    , ry.year
+    , MAKE_DATE(ry.year, 1, 1) AS year_dt
+    , ry.mean_value
+    , ry.median_value
+    , ry.min_value
+    , ry.max_value
+    , ry.n_values
+FROM public.rollup_year AS ry
+LEFT JOIN public.indicator AS i ON i.sk = ry.indicator_sk
+LEFT JOIN public.region AS r ON r.region_id = ry.region_id
+LEFT JOIN public.income_level AS il ON il.income_level_id = ry.income_level_id;
+
+CREATE OR REPLACE VIEW v_rollup_decade AS
+SELECT i.id AS indicator_id
+    , i.name AS indicator_name
+    , rd.region_id
+    , r.region_value AS region_name
+    , rd.income_level_id
+    , il.income_level_value AS income_level_name
+    , rd.decade
+    , rd.mean_value
+    , rd.median_value
+    , rd.min_value
+    , rd.max_value
+    , rd.n_values
+FROM public.rollup_decade AS rd
+LEFT JOIN public.indicator AS i ON i.sk = rd.indicator_sk
+LEFT JOIN public.region AS r ON r.region_id = rd.region_id
+LEFT JOIN public.income_level AS il ON il.income_level_id = rd.income_level_id;